@@ -0,0 +1,74 @@
+"""Helpers shared by the benchmark scripts"""
+
+import os
+import sys
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+import whisper
+
+
+def procIO():
+  """Return this process' I/O counters from /proc/self/io as a dict, or None
+when they are not available (anything but Linux)"""
+  try:
+    fh = open('/proc/self/io')
+  except IOError:
+    return None
+  try:
+    counters = {}
+    for line in fh:
+      (name, value) = line.split(':')
+      counters[name] = int(value)
+    return counters
+  finally:
+    fh.close()
+
+
+def percentile(sortedValues, fraction):
+  if not sortedValues:
+    return None
+  index = int(round(fraction * (len(sortedValues) - 1)))
+  return sortedValues[index]
+
+
+def measure(operation, iterations, setup=None):
+  """Call operation(i) iterations times, running setup(i) untimed before each
+call when given. Returns a dict of throughput, latency and I/O per call"""
+  latencies = []
+  ioBytes = [0, 0, 0, 0]
+  for i in xrange(iterations):
+    if setup:
+      setup(i)
+    before = procIO()
+    start = time.time()
+    operation(i)
+    latencies.append(time.time() - start)
+    after = procIO()
+    if before and after:
+      # reading /proc/self/io is one read syscall of its own
+      ioBytes[0] += after['rchar'] - before['rchar']
+      ioBytes[1] += after['wchar'] - before['wchar']
+      ioBytes[2] += after['syscr'] - before['syscr'] - 1
+      ioBytes[3] += after['syscw'] - before['syscw']
+
+  total = sum(latencies)
+  latencies.sort()
+  result = {
+    'iterations' : iterations,
+    'ops_per_sec' : total and iterations / total or None,
+    'mean_ms' : 1000.0 * total / iterations,
+    'p50_ms' : 1000.0 * percentile(latencies, 0.50),
+    'p99_ms' : 1000.0 * percentile(latencies, 0.99),
+    'bytes_read' : None,
+    'bytes_written' : None,
+    'read_calls' : None,
+    'write_calls' : None,
+  }
+  if procIO() is not None:
+    result['bytes_read'] = ioBytes[0] / iterations
+    result['bytes_written'] = ioBytes[1] / iterations
+    result['read_calls'] = float(ioBytes[2]) / iterations
+    result['write_calls'] = float(ioBytes[3]) / iterations
+  return result
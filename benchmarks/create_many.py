@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Compare the ways of creating many whisper files on the local filesystem:
+a create() loop against create_many() with each layout method.
+
+Reports files per second and the disk space the files take. A method the
+filesystem or kernel does not support is reported as such.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import optparse
+
+from bench import whisper
+
+METHODS = ['clone', 'copy', 'fallocate', 'sparse', 'zero', 'auto']
+
+
+def diskUsage(paths):
+  return sum([os.stat(path).st_blocks * 512 for path in paths if os.path.exists(path)])
+
+
+def run(name, directory, count, create):
+  target = os.path.join(directory, name)
+  os.mkdir(target)
+  paths = [os.path.join(target, '%d.wsp' % i) for i in xrange(count)]
+  start = time.time()
+  try:
+    errors = create(paths)
+  except ValueError, e: #method not available at all
+    errors = [e]
+  elapsed = time.time() - start
+  errors = [e for e in errors if e is not None]
+  if errors:
+    print "%-22s not supported: %r" % (name, errors[0])
+  else:
+    print "%-22s %10.1f files/s %10.1f MB/s %10.1f MB on disk" % (
+      name, count / elapsed, whisper.info(paths[0]) and
+      count * os.stat(paths[0]).st_size / elapsed / 1048576,
+      diskUsage(paths) / 1048576.0)
+  shutil.rmtree(target)
+
+
+def main():
+  option_parser = optparse.OptionParser(usage='%prog [options]')
+  option_parser.add_option('--count', default=1000, type='int',
+    help="Files to create per method")
+  option_parser.add_option('--schema', default='1m:1d,5m:30d,1h:1y',
+    help="Comma separated retention definitions")
+  option_parser.add_option('--workers', default=4, type='int',
+    help="Threads used by create_many")
+  option_parser.add_option('--directory', default=None,
+    help="Where to create the files (default: the system temp directory)")
+  (options, args) = option_parser.parse_args()
+
+  archives = [whisper.parseRetentionDef(d) for d in options.schema.split(',')]
+  directory = tempfile.mkdtemp(prefix='whisper-create-', dir=options.directory)
+  try:
+    def loop(**kwargs):
+      def create(paths):
+        for path in paths:
+          whisper.create(path, archives, **kwargs)
+        return []
+      return create
+
+    run('create()', directory, options.count, loop())
+    run('create(sparse)', directory, options.count, loop(sparse=True))
+    if whisper.CAN_FALLOCATE:
+      run('create(fallocate)', directory, options.count, loop(useFallocate=True))
+
+    for method in METHODS:
+      create = lambda paths: whisper.create_many(paths, archives, method=method,
+                                                 workers=options.workers).values()
+      run('create_many(%s)' % method, directory, options.count, create)
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Compare the peak memory and time of reading a whole archive with fetch()
+and with iter_fetch(), as lists and as numpy arrays.
+
+Each mode runs in a fresh interpreter so its peak resident size (from
+getrusage, Unix only) is its own.
+"""
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import optparse
+import subprocess
+
+from bench import whisper, REPO
+
+MODES = ['fetch', 'iter_fetch', 'fetch-array', 'iter_fetch-array']
+
+
+def peakMemory():
+  usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin': #bytes there, kilobytes on Linux
+    usage /= 1024
+  return usage * 1024
+
+
+def child(mode, path, chunkPoints):
+  asArray = mode.endswith('-array')
+  baseline = peakMemory()
+  start = time.time()
+  known = 0
+  if mode.startswith('iter_fetch'):
+    chunks = whisper.iter_fetch(path, 0, chunkPoints=chunkPoints, as_array=asArray)
+  else:
+    chunks = [whisper.fetch(path, 0, as_array=asArray)]
+  for (timeInfo, values) in chunks:
+    if asArray:
+      known += int((values == values).sum())
+    else:
+      known += len(values) - values.count(None)
+  print "%d %f %d" % (known, time.time() - start, peakMemory() - baseline)
+
+
+def prefill(path, definition):
+  archive = whisper.parseRetentionDef(definition)
+  whisper.create(path, [archive])
+  (step, points) = archive
+  now = int(time.time())
+  for first in xrange(1, points, 10000):
+    whisper.update_many(path, [(now - i * step, float(i))
+                               for i in xrange(first, min(first + 10000, points))])
+
+
+def main():
+  option_parser = optparse.OptionParser(usage='%prog [options]')
+  option_parser.add_option('--retention', default='1m:2y',
+    help="Retention definition of the archive to read (default: 1m:2y)")
+  option_parser.add_option('--chunk-points', default=65536, type='int',
+    help="Points per iter_fetch chunk")
+  option_parser.add_option('--child', nargs=2, help=optparse.SUPPRESS_HELP)
+  (options, args) = option_parser.parse_args()
+
+  if options.child:
+    child(options.child[0], options.child[1], options.chunk_points)
+    return
+
+  path = os.path.join(tempfile.gettempdir(), 'whisper-iter-fetch-%d.wsp' % os.getpid())
+  prefill(path, options.retention)
+  try:
+    print "%-18s %10s %10s %12s" % ('mode', 'points', 'seconds', 'peak MB')
+    for mode in MODES:
+      if mode.endswith('-array') and not whisper.CAN_NUMPY:
+        continue
+      environment = dict(os.environ)
+      environment['PYTHONPATH'] = os.pathsep.join([REPO, environment.get('PYTHONPATH', '')])
+      output = subprocess.Popen([sys.executable, __file__, '--child', mode, path,
+                                 '--chunk-points', str(options.chunk_points)],
+                                stdout=subprocess.PIPE, env=environment).communicate()[0]
+      (known, seconds, peak) = output.split()
+      print "%-18s %10s %10.3f %12.1f" % (mode, known, float(seconds), int(peak) / 1048576.0)
+  finally:
+    os.unlink(path)
+
+
+if __name__ == '__main__':
+  main()
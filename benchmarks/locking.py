@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Measure how readers and writers in separate processes get in each other's
+way on a single file under each locking mode.
+
+Writers keep writing batches of recent points to the finest archive, which
+propagate to the coarser ones. Readers keep fetching a range long enough to be
+served by a coarser archive, like a dashboard rendering the last few days.
+"""
+
+import os
+import time
+import tempfile
+import optparse
+import multiprocessing
+
+from bench import whisper, percentile
+
+MODES = [
+  # name, LOCK, LOCK_READS, LOCK_RANGES
+  ('none', False, False, False),
+  ('flock writers', True, False, False),
+  ('flock', True, True, False),
+  ('ranges', True, True, True),
+]
+
+ARCHIVES = ['1s:6h', '1m:7d', '1h:1y']
+
+
+def worker(role, mode, path, options, start, results):
+  (name, lock, lockReads, lockRanges) = mode
+  whisper.LOCK = lock
+  whisper.LOCK_READS = lockReads
+  whisper.LOCK_RANGES = lockRanges
+  latencies = []
+  i = 0
+  while time.time() < start:
+    time.sleep(0.001)
+  stopAt = start + options.duration
+  while True:
+    before = time.time()
+    if before >= stopAt:
+      break
+    if role == 'writer':
+      now = int(before)
+      whisper.update_many(path, [(now - j, float(i)) for j in xrange(1, options.batch + 1)])
+    else:
+      whisper.fetch(path, before - options.read_range, before)
+    latencies.append(time.time() - before)
+    i += 1
+  results.put((role, latencies))
+
+
+def run(mode, path, options):
+  results = multiprocessing.Queue()
+  start = time.time() + 0.5 #give every process the time to start
+  processes = []
+  for (role, count) in (('writer', options.writers), ('reader', options.readers)):
+    for i in xrange(count):
+      process = multiprocessing.Process(target=worker, args=(role, mode, path, options, start, results))
+      process.start()
+      processes.append(process)
+
+  latencies = {'writer' : [], 'reader' : []}
+  for process in processes:
+    (role, measured) = results.get()
+    latencies[role].extend(measured)
+  for process in processes:
+    process.join()
+  return latencies
+
+
+def main():
+  option_parser = optparse.OptionParser(usage='%prog [options]')
+  option_parser.add_option('--writers', default=2, type='int',
+    help="Writer processes (default: 2)")
+  option_parser.add_option('--readers', default=4, type='int',
+    help="Reader processes (default: 4)")
+  option_parser.add_option('--duration', default=3.0, type='float',
+    help="Seconds to run each mode for (default: 3)")
+  option_parser.add_option('--batch', default=10, type='int',
+    help="Points per update_many (default: 10)")
+  option_parser.add_option('--read-range', default=3 * 86400, type='int',
+    help="Seconds fetched by each read (default: 3 days)")
+  (options, args) = option_parser.parse_args()
+
+  if not whisper.CAN_LOCK:
+    raise SystemExit("Locking needs the fcntl module")
+
+  path = os.path.join(tempfile.gettempdir(), 'whisper-locking-%d.wsp' % os.getpid())
+  whisper.create(path, [whisper.parseRetentionDef(d) for d in ARCHIVES])
+  now = int(time.time())
+  whisper.update_many(path, [(now - 60 * i, float(i)) for i in xrange(1, 7 * 1440)])
+  try:
+    print "%-14s %10s %10s %12s %12s %12s %12s" % ('mode', 'writes/s', 'reads/s',
+      'write p50', 'write p99', 'read p50', 'read p99')
+    for mode in MODES:
+      latencies = run(mode, path, options)
+      row = []
+      for role in ('writer', 'reader'):
+        row.append(len(latencies[role]) / options.duration)
+      for role in ('writer', 'reader'):
+        measured = sorted(latencies[role])
+        row.append(1000 * (percentile(measured, 0.5) or 0))
+        row.append(1000 * (percentile(measured, 0.99) or 0))
+      print "%-14s %10.1f %10.1f %10.3fms %10.3fms %10.3fms %10.3fms" % tuple([mode[0]] + row)
+  finally:
+    os.unlink(path)
+
+
+if __name__ == '__main__':
+  main()
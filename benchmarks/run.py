@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""Run the whisper benchmark suite and write the results as JSON, or compare
+two result files.
+
+Every operation is run against a few representative retention schemas. Each
+result records throughput, median and 99th percentile latency and, on Linux,
+the bytes and read/write calls per operation from /proc/self/io (memory-mapped
+access does not show up there). The resize benchmark runs bin/whisper-resize.py
+in a subprocess, so its latency includes interpreter startup and its I/O is
+not counted.
+
+  benchmarks/run.py --output before.json
+  ... change things ...
+  benchmarks/run.py --output after.json
+  benchmarks/run.py --compare before.json after.json
+"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import platform
+import tempfile
+import optparse
+import subprocess
+
+try:
+  import json
+except ImportError:
+  raise SystemExit('[ERROR] The benchmarks need python 2.6 or later')
+
+import bench
+from bench import whisper
+
+# Ignore SIGPIPE
+signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+# name, retention definitions, definitions to resize to
+SCHEMAS = [
+  ('tiered', ['10s:6h', '1m:7d', '10m:5y'], ['10s:1d', '1m:7d', '10m:5y']),
+  ('minutely', ['1m:1y'], ['1m:30d', '1h:1y']),
+  ('secondly', ['1s:1d', '1m:30d', '1h:1y'], ['1s:12h', '1m:30d', '1h:2y']),
+]
+
+UPDATE_MANY_BATCHES = [1, 10, 100, 1000]
+
+# Prefilled data never goes back further than this
+MAX_PREFILL = 2 * 86400
+
+
+class Schema(object):
+  def __init__(self, name, definitions, resizeDefinitions, directory):
+    self.name = name
+    self.definitions = definitions
+    self.resizeDefinitions = resizeDefinitions
+    self.archives = [whisper.parseRetentionDef(d) for d in definitions]
+    self.step = self.archives[0][0]
+    self.now = int(time.time())
+    self.window = min(self.step * self.archives[0][1] / 2, MAX_PREFILL)
+    # The oldest prefilled point becomes the finest archive's base interval
+    self.base = self.now - self.window
+    self.base -= self.base % self.step
+    self.directory = directory
+
+  def path(self, name):
+    return os.path.join(self.directory, '%s-%s.wsp' % (self.name, name))
+
+  def points(self, count, newest, valueOffset=0.0):
+    return [(newest - k * self.step, float(k) + valueOffset) for k in xrange(count)]
+
+  def prefill(self, path, valueOffset=0.0):
+    if os.path.exists(path):
+      os.unlink(path)
+    whisper.create(path, self.archives)
+    count = self.window / self.step
+    for first in xrange(0, count, 10000):
+      newest = self.now - 1 - first * self.step
+      whisper.update_many(path, self.points(min(10000, count - first), newest, valueOffset))
+
+
+def remove(path):
+  if os.path.exists(path):
+    os.unlink(path)
+
+
+def benchmarks(schema, scale):
+  """Yield (operation, iterations, function, setup) for a schema, preparing
+the files each one needs right before it runs"""
+  def iterations(n):
+    return max(1, int(n * scale))
+
+  path = schema.path('create')
+  setup = lambda i: remove(path)
+  yield ('create-zero', iterations(10),
+         lambda i: whisper.create(path, schema.archives), setup)
+  yield ('create-sparse', iterations(10),
+         lambda i: whisper.create(path, schema.archives, sparse=True), setup)
+  if whisper.CAN_FALLOCATE:
+    yield ('create-fallocate', iterations(10),
+           lambda i: whisper.create(path, schema.archives, useFallocate=True), setup)
+  remove(path)
+
+  path = schema.path('data')
+  schema.prefill(path)
+  slots = schema.window / schema.step - 1
+  yield ('update', iterations(2000),
+         lambda i: whisper.update(path, float(i), schema.now - schema.step * (1 + i % slots)), None)
+
+  for batch in UPDATE_MANY_BATCHES:
+    newest = lambda i: schema.now - 1 - schema.step * ((i * batch) % max(1, slots - batch))
+    yield ('update_many-%d' % batch, iterations(max(20, 2000 / batch)),
+           lambda i: whisper.update_many(path, schema.points(batch, newest(i))), None)
+
+  yield ('fetch-short', iterations(1000),
+         lambda i: whisper.fetch(path, schema.now - min(3600, schema.window), schema.now), None)
+  yield ('fetch-wrap', iterations(1000),
+         lambda i: whisper.fetch(path, schema.base - 30 * schema.step, schema.base + 30 * schema.step), None)
+  finestRetention = schema.archives[0][0] * schema.archives[0][1]
+  yield ('fetch-finest', iterations(20),
+         lambda i: whisper.fetch(path, schema.now - finestRetention + schema.step, schema.now), None)
+  yield ('fetch-full', iterations(5),
+         lambda i: whisper.fetch(path, 0, schema.now), None)
+  yield ('fetch-budget', iterations(20),
+         lambda i: whisper.fetch(path, schema.now - finestRetention + schema.step, schema.now,
+                                 maxDataPoints=800), None)
+
+  other = schema.path('other')
+  schema.prefill(other, valueOffset=0.5)
+  yield ('merge', iterations(3), lambda i: whisper.merge(other, path), None)
+  replicas = [schema.path('replica%d' % i) for i in xrange(3)]
+  for (i, replica) in enumerate(replicas):
+    schema.prefill(replica, valueOffset=0.25 * i)
+  schema.prefill(path)
+  yield ('merge-many', iterations(3), lambda i: whisper.merge_many(replicas, path), None)
+  for replica in replicas:
+    remove(replica)
+  schema.prefill(path)
+  yield ('diff', iterations(3), lambda i: whisper.diff(path, other), None)
+  remove(other)
+
+  resized = schema.path('resized')
+  script = os.path.join(bench.REPO, 'bin', 'whisper-resize.py')
+  environment = dict(os.environ)
+  environment['PYTHONPATH'] = os.pathsep.join([bench.REPO, environment.get('PYTHONPATH', '')])
+  devnull = open(os.devnull, 'w')
+  command = [sys.executable, script, path] + schema.resizeDefinitions + ['--newfile', resized]
+  yield ('resize', iterations(3),
+         lambda i: subprocess.check_call(command, stdout=devnull, env=environment),
+         lambda i: remove(resized))
+  devnull.close()
+  remove(resized)
+  remove(path)
+
+
+def gitRevision():
+  try:
+    process = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=bench.REPO,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.communicate()[0].strip()
+    if process.returncode == 0:
+      return output
+  except OSError:
+    pass
+  return None
+
+
+def run(options):
+  directory = tempfile.mkdtemp(prefix='whisper-bench-', dir=options.directory)
+  results = []
+  try:
+    for (name, definitions, resizeDefinitions) in SCHEMAS:
+      if options.schema and name not in options.schema:
+        continue
+      schema = Schema(name, definitions, resizeDefinitions, directory)
+      for (operation, iterations, function, setup) in benchmarks(schema, options.scale):
+        if options.operation and not [o for o in options.operation if operation.startswith(o)]:
+          continue
+        try:
+          result = bench.measure(function, iterations, setup)
+        except Exception, e:
+          # Keep going so results stay comparable with trees where an
+          # operation is broken
+          results.append({'schema' : name, 'operation' : operation, 'error' : repr(e)})
+          sys.stderr.write("%-10s %-18s failed: %r\n" % (name, operation, e))
+          continue
+        result['schema'] = name
+        result['operation'] = operation
+        results.append(result)
+        sys.stderr.write("%-10s %-18s %10.1f ops/s  p50 %8.3f ms  p99 %8.3f ms\n" % (
+          name, operation, result['ops_per_sec'] or 0, result['p50_ms'], result['p99_ms']))
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+  return {
+    'meta' : {
+      'time' : int(time.time()),
+      'revision' : gitRevision(),
+      'python' : platform.python_version(),
+      'implementation' : platform.python_implementation(),
+      'platform' : platform.platform(),
+      'schemas' : dict([(name, definitions) for (name, definitions, resize) in SCHEMAS]),
+      'scale' : options.scale,
+      'features' : {
+        'numpy' : whisper.CAN_NUMPY,
+        'fallocate' : whisper.CAN_FALLOCATE,
+        'pread' : getattr(whisper, 'CAN_PREAD', False),
+      },
+    },
+    'results' : results,
+  }
+
+
+def compare(oldPath, newPath, threshold):
+  """Print the change of every benchmark found in both files. Returns the
+number of benchmarks that got slower by more than threshold"""
+  old = json.load(open(oldPath))
+  new = json.load(open(newPath))
+  oldResults = dict([((r['schema'], r['operation']), r) for r in old['results']])
+
+  print "%s (%s) -> %s (%s)" % (oldPath, old['meta'].get('revision'), newPath, new['meta'].get('revision'))
+  print "%-10s %-18s %12s %12s %8s %10s %10s" % ('schema', 'operation', 'old ops/s', 'new ops/s', 'change', 'old p99', 'new p99')
+  regressions = 0
+  for result in new['results']:
+    key = (result['schema'], result['operation'])
+    if key not in oldResults:
+      continue
+    before = oldResults[key]
+    if not before.get('ops_per_sec') or not result.get('ops_per_sec'):
+      continue
+    change = result['ops_per_sec'] / before['ops_per_sec'] - 1
+    marker = ''
+    if change < -threshold:
+      marker = ' !'
+      regressions += 1
+    print "%-10s %-18s %12.1f %12.1f %+7.1f%% %9.3fms %9.3fms%s" % (
+      key[0], key[1], before['ops_per_sec'], result['ops_per_sec'], 100 * change,
+      before['p99_ms'], result['p99_ms'], marker)
+  return regressions
+
+
+def main():
+  option_parser = optparse.OptionParser(usage='''%prog [options]
+       %prog --compare old.json new.json''')
+  option_parser.add_option('--output', default=None,
+    help="Write the JSON results to this file instead of stdout")
+  option_parser.add_option('--schema', action='append', default=[],
+    help="Only run this schema (%s), may be repeated" % ', '.join([s[0] for s in SCHEMAS]))
+  option_parser.add_option('--operation', action='append', default=[],
+    help="Only run operations starting with this name, may be repeated")
+  option_parser.add_option('--scale', default=1.0, type='float',
+    help="Multiply every iteration count by this factor")
+  option_parser.add_option('--directory', default=None,
+    help="Where to create the benchmark files (default: the system temp directory)")
+  option_parser.add_option('--compare', action='store_true',
+    help="Compare two result files instead of running the benchmarks")
+  option_parser.add_option('--threshold', default=0.1, type='float',
+    help="Slowdown flagged as a regression by --compare (default: 0.1)")
+  (options, args) = option_parser.parse_args()
+
+  if options.compare:
+    if len(args) != 2:
+      option_parser.print_help()
+      sys.exit(1)
+    regressions = compare(args[0], args[1], options.threshold)
+    sys.exit(regressions and 1 or 0)
+
+  report = json.dumps(run(options), indent=2, sort_keys=True)
+  if options.output:
+    fh = open(options.output, 'w')
+    try:
+      fh.write(report + '\n')
+    finally:
+      fh.close()
+  else:
+    print report
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Count the I/O syscalls whisper issues per operation, with positional
+pread/pwrite and with the seek+read fallback.
+
+Read and write calls come from the syscr and syscw counters of
+/proc/self/io (Linux only), seeks are counted by handing whisper a file
+type that counts seek() and tell() calls, each of which costs an lseek.
+"""
+
+import os
+import time
+import tempfile
+import optparse
+
+from bench import whisper, procIO
+
+
+class CountingFile(file):
+  seeks = 0
+
+  def seek(self, *args):
+    CountingFile.seeks += 1
+    return file.seek(self, *args)
+
+  def tell(self):
+    CountingFile.seeks += 1
+    return file.tell(self)
+
+
+def ioCounters():
+  counters = procIO()
+  return (counters['syscr'], counters['syscw'])
+
+
+def measure(operation, iterations):
+  CountingFile.seeks = 0
+  (reads, writes) = ioCounters()
+  for i in xrange(iterations):
+    operation(i)
+  (endReads, endWrites) = ioCounters()
+  # reading /proc/self/io is itself one read
+  reads = endReads - reads - 1
+  writes = endWrites - writes
+  return (float(reads) / iterations,
+          float(writes) / iterations,
+          float(CountingFile.seeks) / iterations)
+
+
+def run(path, iterations, batchSize):
+  now = int(time.time())
+  archives = [(1, 3600), (60, 1440), (3600, 720)]
+  if os.path.exists(path):
+    os.unlink(path)
+  whisper.create(path, archives)
+  # half fill the finest archive so later writes and reads wrap around it
+  whisper.update_many(path, [(now - i, float(i)) for i in xrange(1, 1800)])
+
+  operations = [
+    ('update', lambda i: whisper.update(path, float(i), now - 1800 - (i % 1000))),
+    ('update_many(%d)' % batchSize, lambda i: whisper.update_many(path,
+      [(now - 2000 - j, float(j)) for j in xrange(batchSize)])),
+    ('fetch (one run)', lambda i: whisper.fetch(path, now - 600, now)),
+    ('fetch (wrapped)', lambda i: whisper.fetch(path, now - 3500, now)),
+    ('info', lambda i: whisper.info(path)),
+  ]
+
+  results = []
+  for (name, operation) in operations:
+    results.append((name, measure(operation, iterations)))
+  os.unlink(path)
+  return results
+
+
+def main():
+  option_parser = optparse.OptionParser(usage='%prog [options]')
+  option_parser.add_option('--iterations', default=200, type='int',
+    help="Operations to average over per measurement")
+  option_parser.add_option('--batch-size', default=60, type='int',
+    help="Points per update_many call")
+  (options, args) = option_parser.parse_args()
+
+  if procIO() is None:
+    raise SystemExit("/proc/self/io is required to count syscalls")
+
+  whisper.open = CountingFile
+  path = os.path.join(tempfile.gettempdir(), 'whisper-syscalls-%d.wsp' % os.getpid())
+  canPread = getattr(whisper, 'CAN_PREAD', False)
+
+  modes = [('seek+read', False)]
+  if canPread:
+    modes.append(('pread', True))
+
+  measurements = []
+  for (mode, usePread) in modes:
+    whisper.CAN_PREAD = usePread
+    measurements.append((mode, run(path, options.iterations, options.batch_size)))
+  whisper.CAN_PREAD = canPread
+
+  print "%-20s %-10s %8s %8s %8s %8s" % ('operation', 'mode', 'reads', 'writes', 'seeks', 'total')
+  for i in xrange(len(measurements[0][1])):
+    for (mode, results) in measurements:
+      (name, (reads, writes, seeks)) = results[i]
+      print "%-20s %-10s %8.1f %8.1f %8.1f %8.1f" % (name, mode, reads, writes, seeks, reads + writes + seeks)
+
+
+if __name__ == '__main__':
+  main()
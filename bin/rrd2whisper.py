@@ -19,10 +19,8 @@ except ImportError:
 # Ignore SIGPIPE
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-aggregationMethods = whisper.aggregationMethods
-
-# RRD doesn't have a 'sum' or 'total' type
-aggregationMethods.remove('sum')
+# The RRD consolidation functions, RRD doesn't have a 'sum' or 'total' type
+aggregationMethods = ['average', 'last', 'max', 'min']
 
 option_parser = optparse.OptionParser(usage='''%prog rrd_path''')
 option_parser.add_option(
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import signal
+import optparse
+
+try:
+  import whisper
+except ImportError:
+  raise SystemExit('[ERROR] Please make sure whisper is installed properly')
+
+# Ignore SIGPIPE
+signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+option_parser = optparse.OptionParser(usage='''%prog [options] path_a path_b
+
+When path_a and path_b are directories, every whisper file under either of them
+is compared with the file at the same place under the other one, and a JSON
+object is printed on its own line for each metric:
+
+  {"metric": "a.b.c", "status": "differs", "archives": [[0, 12, 8640], ...]}
+
+status is one of ok, differs, missing_a, missing_b or error, archives lists
+[archive, differing, total] for each archive of the metric.''')
+option_parser.add_option('--summary', default=False, action='store_true',
+  help="show summary of differences")
+option_parser.add_option('--ignore-empty', default=False, action='store_true',
+  help="skip comparison if either value is undefined")
+option_parser.add_option('--columns', default=False, action='store_true',
+  help="print output in simple columns")
+option_parser.add_option('--no-headers', default=False, action='store_true',
+  help="do not print column headers")
+option_parser.add_option('--workers', default=4, type='int',
+  help="processes comparing the files of two directories (default: 4)")
+option_parser.add_option('--differences-only', default=False, action='store_true',
+  help="only report the metrics of two directories that are not ok")
+
+(options, args) = option_parser.parse_args()
+
+if len(args) != 2:
+  option_parser.print_help()
+  sys.exit(1)
+
+(path_a, path_b) = args
+
+
+def print_diffs(diffs, pretty=True, headers=True):
+  if pretty:
+    h = "%7s %11s %13s %13s\n"
+    f = "%7s %11d %13s %13s\n"
+  else:
+    h = "%s %s %s %s\n"
+    f = "%s %d %s %s\n"
+  if headers:
+    sys.stdout.write(h % ('archive', 'timestamp', 'value_a', 'value_b'))
+  for (archive, points, total) in diffs:
+    if pretty:
+      sys.stdout.write('Archive %d (%d of %d datapoints differ)\n' % (archive, len(points), total))
+      sys.stdout.write(h % ('', 'timestamp', 'value_a', 'value_b'))
+    for (timestamp, value_a, value_b) in points:
+      if pretty:
+        sys.stdout.write(f % ('', timestamp, value_a, value_b))
+      else:
+        sys.stdout.write(f % (archive, timestamp, value_a, value_b))
+
+
+def print_summary(summary, pretty=True, headers=True):
+  if pretty:
+    f = "%7s %9s %9s\n"
+  else:
+    f = "%s %s %s\n"
+  if headers:
+    sys.stdout.write(f % ('archive', 'total', 'differing'))
+  for (archive, differing, total) in summary:
+    sys.stdout.write(f % (archive, total, differing))
+
+
+def find_whisper_files(root):
+  """The paths of the whisper files under root, relative to it"""
+  found = []
+  for (directory, subdirectories, filenames) in os.walk(root):
+    subdirectories.sort()
+    relative = os.path.relpath(directory, root)
+    for filename in sorted(filenames):
+      if filename.endswith('.wsp'):
+        found.append(os.path.normpath(os.path.join(relative, filename)))
+  return found
+
+
+def compare(relative):
+  """Compare relative under both roots, in a worker process"""
+  report = {
+    'metric' : relative[:-len('.wsp')].replace(os.sep, '.'),
+    'archives' : [],
+  }
+  files = [os.path.join(root, relative) for root in (path_a, path_b)]
+  if not os.path.exists(files[0]):
+    report['status'] = 'missing_a'
+  elif not os.path.exists(files[1]):
+    report['status'] = 'missing_b'
+  else:
+    try:
+      summary = whisper.diff_summary(files[0], files[1], ignore_empty=options.ignore_empty)
+    except Exception, e:
+      report['status'] = 'error'
+      report['error'] = str(e)
+    else:
+      report['archives'] = [list(archive) for archive in summary]
+      report['status'] = 'ok'
+      if [archive for archive in summary if archive[1]]:
+        report['status'] = 'differs'
+  return report
+
+
+def diff_trees():
+  try:
+    import json
+    import multiprocessing
+  except ImportError:
+    raise SystemExit('[ERROR] Comparing directories needs python 2.6 or later')
+
+  metrics = sorted(set(find_whisper_files(path_a)) | set(find_whisper_files(path_b)))
+  counts = {}
+  pool = multiprocessing.Pool(options.workers)
+  try:
+    for report in pool.imap_unordered(compare, metrics, 64):
+      counts[report['status']] = counts.get(report['status'], 0) + 1
+      if options.differences_only and report['status'] == 'ok':
+        continue
+      sys.stdout.write(json.dumps(report, sort_keys=True) + '\n')
+  finally:
+    pool.close()
+    pool.join()
+
+  sys.stderr.write('%d metrics: %s\n' % (len(metrics), ', '.join(
+    ['%d %s' % (counts[status], status) for status in sorted(counts)])))
+  if len(metrics) != counts.get('ok', 0):
+    sys.exit(1)
+
+
+if os.path.isdir(path_a) and os.path.isdir(path_b):
+  diff_trees()
+  sys.exit(0)
+
+for filename in (path_a, path_b):
+  if not os.path.exists(filename):
+    raise SystemExit('[ERROR] File "%s" does not exist!' % filename)
+
+try:
+  if options.summary:
+    print_summary(whisper.diff_summary(path_a, path_b, ignore_empty=options.ignore_empty),
+                  not options.columns, not options.no_headers)
+  else:
+    print_diffs(whisper.diff(path_a, path_b, ignore_empty=options.ignore_empty),
+                not options.columns, not options.no_headers)
+except NotImplementedError, e:
+  raise SystemExit('[ERROR] %s' % str(e))
@@ -1,20 +1,48 @@
 #!/usr/bin/env python
 
 import os
+import sys
 import mmap
 import struct
 import signal
 import optparse
+import itertools
 
 try:
   import whisper
 except ImportError:
   raise SystemExit('[ERROR] Please make sure whisper is installed properly')
 
+if whisper.CAN_NUMPY:
+  import numpy
+
 # Ignore SIGPIPE
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-option_parser = optparse.OptionParser(usage='''%prog path''')
+FORMATS = ['text', 'raw', 'csv', 'jsonl']
+
+# Points formatted and written at once
+BLOCK_POINTS = 65536
+
+option_parser = optparse.OptionParser(usage='''%prog [options] path
+
+The text format prints the header then every slot of each archive in the order
+they are stored. The other formats only output the points stored, ordered by
+time within each archive:
+
+  csv    an archive,timestamp,value header line, then one line per point
+  jsonl  {"archive": 0, "timestamp": 1400000000, "value": 1.5} per line,
+         with null for NaN and infinite values
+  raw    the points packed as in the file (whisper.pointFormat, 12 bytes
+         each), one archive after the other''')
+option_parser.add_option('--format', default='text', choices=FORMATS,
+  help="Output format: %s (default: text)" % ', '.join(FORMATS))
+option_parser.add_option('--archive', default=None, type='int',
+  help="Only dump the points of this archive, 0 being the finest")
+option_parser.add_option('--since', default=None, type='int',
+  help="Only dump the points at or after this unix epoch time")
+option_parser.add_option('--until', default=None, type='int',
+  help="Only dump the points before this unix epoch time")
 (options, args) = option_parser.parse_args()
 
 if len(args) != 1:
@@ -32,7 +60,7 @@ def read_header(map):
   try:
     (aggregationType,maxRetention,xFilesFactor,archiveCount) = struct.unpack(whisper.metadataFormat,map[:whisper.metadataSize])
   except:
-    raise CorruptWhisperFile("Unable to unpack header")
+    raise whisper.CorruptWhisperFile("Unable to unpack header", path)
 
   archives = []
   archiveOffset = whisper.metadataSize
@@ -41,7 +69,7 @@ def read_header(map):
     try:
       (offset, secondsPerPoint, points) = struct.unpack(whisper.archiveInfoFormat, map[archiveOffset:archiveOffset+whisper.archiveInfoSize])
     except:
-      raise CorruptWhisperFile("Unable to read archive %d metadata" % i)
+      raise whisper.CorruptWhisperFile("Unable to read archive %d metadata" % i, path)
 
     archiveInfo = {
       'offset' : offset,
@@ -79,20 +107,115 @@ def dump_archive_headers(archives):
     print '  size: %d' % archive['size']
     print
 
+def select(timestamps):
+  """Mask of the timestamps --since and --until let through"""
+  if options.since is None and options.until is None:
+    return None
+  since = options.since
+  if since is None:
+    since = 0
+  until = options.until
+  if until is None:
+    until = 1 << 32
+  if whisper.CAN_NUMPY:
+    return (timestamps >= since) & (timestamps < until)
+  return [since <= timestamp < until for timestamp in timestamps]
+
+def read_blocks(archive, ordered):
+  """Yield (slots, points, packed) for up to BLOCK_POINTS slots at a time, in
+slot order or, when ordered, only the slots holding a point in time order.
+points are (timestamp, value) tuples and packed the same points as stored in
+the file, or None without numpy"""
+  offset = archive['offset']
+  points = archive['points']
+
+  if whisper.CAN_NUMPY:
+    series = numpy.frombuffer(map, dtype=whisper.pointDtype, count=points, offset=offset)
+    timestamps = series['interval']
+    keep = select(timestamps)
+    if ordered:
+      # Empty slots have a zero timestamp
+      if keep is None:
+        keep = timestamps != 0
+      else:
+        keep &= timestamps != 0
+    if keep is None:
+      slots = numpy.arange(points)
+    else:
+      slots = numpy.flatnonzero(keep)
+    if ordered:
+      slots = slots[numpy.argsort(timestamps[slots], kind='mergesort')]
+    for start in xrange(0, len(slots), BLOCK_POINTS):
+      block = slots[start:start + BLOCK_POINTS]
+      selected = series[block]
+      yield (block.tolist(), selected.tolist(), selected.tostring())
+    return
+
+  # Slot order can be decoded a block at a time, time order needs the whole
+  # archive
+  blockPoints = BLOCK_POINTS
+  if ordered:
+    blockPoints = points
+  for first in xrange(0, points, blockPoints):
+    count = min(blockPoints, points - first)
+    start = offset + first * whisper.pointSize
+    flat = struct.unpack(whisper.pointFormat[0] + whisper.pointFormat[1:] * count,
+                         map[start:start + count * whisper.pointSize])
+    timestamps = flat[0::2]
+    stored = zip(timestamps, flat[1::2])
+    indexes = range(count)
+    keep = select(timestamps)
+    if keep is not None:
+      indexes = [i for i in indexes if keep[i]]
+    if ordered:
+      indexes = [i for (timestamp, i) in sorted([(timestamps[i], i) for i in indexes if timestamps[i]])]
+    for start in xrange(0, len(indexes), BLOCK_POINTS):
+      block = indexes[start:start + BLOCK_POINTS]
+      yield ([first + i for i in block], [stored[i] for i in block], None)
+
+def format_json(value):
+  if value - value != 0: #NaN and infinities have no JSON number
+    return 'null'
+  return repr(value)
+
 def dump_archives(archives):
+  write = sys.stdout.write
   for i,archive in enumerate(archives):
-    print 'Archive %d data:' %i
-    offset = archive['offset']
-    for point in xrange(archive['points']):
-      (timestamp, value) = struct.unpack(whisper.pointFormat, map[offset:offset+whisper.pointSize])
-      print '%d: %d, %10.35g' % (point, timestamp, value)
-      offset += whisper.pointSize
-    print
+    if options.archive is not None and i != options.archive:
+      continue
+
+    if options.format == 'text':
+      write('Archive %d data:\n' % i)
+      for (slots, points, packed) in read_blocks(archive, False):
+        write(''.join(['%d: %d, %10.35g\n' % (slot, timestamp, value)
+                       for (slot, (timestamp, value)) in itertools.izip(slots, points)]))
+      write('\n')
+      continue
+
+    for (slots, points, packed) in read_blocks(archive, True):
+      if options.format == 'raw':
+        if packed is None:
+          packFormat = whisper.pointFormat[0] + whisper.pointFormat[1:] * len(points)
+          packed = struct.pack(packFormat, *itertools.chain(*points))
+        write(packed)
+      elif options.format == 'csv':
+        lineFormat = '%d,%%d,%%r\n' % i
+        write(''.join([lineFormat % point for point in points]))
+      else:
+        lineFormat = '{"archive": %d, "timestamp": %%d, "value": %%s}\n' % i
+        write(''.join([lineFormat % (timestamp, format_json(value)) for (timestamp, value) in points]))
 
 if not os.path.exists(path):
   raise SystemExit('[ERROR] File "%s" does not exist!' % path)
 
 map = mmap_file(path)
 header = read_header(map)
-dump_header(header)
+if options.archive is not None and not 0 <= options.archive < len(header['archives']):
+  raise SystemExit('[ERROR] %s has no archive %d' % (path, options.archive))
+
+if options.format == 'text':
+  dump_header(header)
+  sys.stdout.flush()
+elif options.format == 'csv':
+  sys.stdout.write('archive,timestamp,value\n')
 dump_archives(header['archives'])
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
 import sys
+import glob
 import time
+import struct
 import signal
 import optparse
 
@@ -10,62 +12,275 @@ try:
 except ImportError:
   raise SystemExit('[ERROR] Please make sure whisper is installed properly')
 
+if whisper.CAN_NUMPY:
+  import numpy
+
 # Ignore SIGPIPE
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 now = int( time.time() )
 yesterday = now - (60 * 60 * 24)
 
-option_parser = optparse.OptionParser(usage='''%prog [options] path''')
+FORMATS = ['text', 'json', 'jsonl', 'csv', 'binary']
+
+# Files fetched at once before their output is written
+BATCH_PATHS = 256
+
+# Points formatted and written at once
+BLOCK_POINTS = 65536
+
+option_parser = optparse.OptionParser(usage='''%prog [options] path [path ...]
+
+Paths may be glob patterns such as 'servers/*/cpu.wsp', they are fetched
+concurrently and output in the order given, matches of a pattern sorted.
+
+  text    time and value separated by a tab on each line, preceded by the
+          path when there are several
+  json    a single object with start, end, step and values, one path only
+  jsonl   {"end": ..., "path": ..., "start": ..., "step": ..., "values": [...]}
+          for each path, null for missing, NaN and infinite values
+  csv     path,timestamp,value lines after a header line, empty values
+          for missing points
+  binary  (timestamp, value) points packed like whisper's (big-endian
+          32-bit unsigned timestamp, 64-bit float value), NaN for missing
+          values, one path after the other
+
+With --matrix, there is one row per timestamp with the value of each path in
+turn instead: timestamp,path,... columns for text and csv,
+{"timestamp": ..., "values": [...]} objects after a {"paths": [...]} line for
+jsonl, and big-endian 64-bit floats, the timestamp first, for binary.''')
 option_parser.add_option('--from', default=yesterday, type='int', dest='_from',
   help=("Unix epoch time of the beginning of "
         "your requested interval (default: 24 hours ago)"))
 option_parser.add_option('--until', default=now, type='int',
   help="Unix epoch time of the end of your requested interval (default: now)")
 option_parser.add_option('--json', default=False, action='store_true',
-  help="Output results in JSON form")
+  help="Output results in JSON form, the same as --format json")
 option_parser.add_option('--pretty', default=False, action='store_true',
   help="Show human-readable timestamps instead of unix times")
+option_parser.add_option('--format', default='text', choices=FORMATS,
+  help="Output format: %s (default: text)" % ', '.join(FORMATS))
+option_parser.add_option('--matrix', default=False, action='store_true',
+  help="Output one row per timestamp and one column per path")
+option_parser.add_option('--archive', default=None, type='int',
+  help="Read from this archive, 0 being the finest, instead of the finest one covering the interval")
+option_parser.add_option('--maxDataPoints', default=None, type='int',
+  help="Consolidate each series to at most this many points")
+option_parser.add_option('--as-array', default=False, action='store_true',
+  help="Fetch values as numpy arrays, faster for long series (requires numpy)")
+option_parser.add_option('--workers', default=8, type='int',
+  help="Threads reading files concurrently (default: 8)")
 
 (options, args) = option_parser.parse_args()
 
-if len(args) != 1:
+if len(args) < 1:
   option_parser.print_help()
   sys.exit(1)
 
-path = args[0]
+if options.json:
+  options.format = 'json'
+if options.as_array and not whisper.CAN_NUMPY:
+  option_parser.error("--as-array requires numpy")
+
+paths = []
+for pattern in args:
+  if glob.has_magic(pattern):
+    matches = sorted(glob.glob(pattern))
+    if not matches:
+      raise SystemExit('[ERROR] No file matches "%s"' % pattern)
+    paths.extend(matches)
+  else:
+    paths.append(pattern)
+
+if options.format == 'json' and (len(paths) > 1 or options.matrix):
+  option_parser.error("json output takes a single path, use --format jsonl")
 
 from_time = int( options._from )
 until_time = int( options.until )
 
 
-try:
-  (timeInfo, values) = whisper.fetch(path, from_time, until_time)
-except whisper.WhisperException, exc:
-  raise SystemExit('[ERROR] %s' % str(exc))
+def fetch_all(paths):
+  """Yield (path, result) in order, result being what whisper.fetch returns
+or the exception it raised"""
+  pool = None
+  if options.workers > 1 and len(paths) > 1:
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(options.workers, len(paths)))
+  try:
+    for i in xrange(0, len(paths), BATCH_PATHS):
+      batch = paths[i:i + BATCH_PATHS]
+      results = whisper.fetch_many(batch, from_time, until_time, options.as_array,
+                                   pool=pool, maxDataPoints=options.maxDataPoints,
+                                   archive_number=options.archive)
+      for (path, result) in zip(batch, results):
+        yield (path, result)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+def as_list(values):
+  """values with None for the missing ones, whether fetched as a list or array"""
+  if isinstance(values, list):
+    return values
+  values = values.tolist()
+  for (i, value) in enumerate(values):
+    if value != value: #NaN
+      values[i] = None
+  return values
 
+def format_time(t):
+  if options.pretty:
+    return time.ctime(t)
+  return str(t)
+
+def format_text(value):
+  if value is None:
+    return "None"
+  return "%f" % value
 
-(start,end,step) = timeInfo
+def json_value(value):
+  """value, or None where JSON has no number for it"""
+  if value is None or value - value != 0: #NaN and infinities
+    return None
+  return value
 
-if options.json:
-  values_json = str(values).replace('None','null')
-  print '''{
+def format_csv(value):
+  if value is None:
+    return ''
+  return repr(value)
+
+def quote_csv(field):
+  for special in ',"\r\n':
+    if special in field:
+      return '"%s"' % field.replace('"', '""')
+  return field
+
+def pack_points(timeInfo, values):
+  (start, end, step) = timeInfo
+  if whisper.CAN_NUMPY:
+    points = numpy.empty(len(values), dtype=whisper.pointDtype)
+    points['interval'] = numpy.arange(start, end, step)
+    points['value'] = numpy.array(values, dtype=float) #None becomes NaN
+    return points.tostring()
+  nan = float('nan')
+  flat = []
+  for (t, value) in zip(xrange(start, end, step), values):
+    if value is None:
+      value = nan
+    flat.extend((t, value))
+  return struct.pack(whisper.pointFormat[0] + whisper.pointFormat[1:] * len(values), *flat)
+
+def write_series(path, timeInfo, values):
+  write = sys.stdout.write
+  (start, end, step) = timeInfo
+  if options.format == 'binary':
+    for first in xrange(0, len(values), BLOCK_POINTS):
+      block = values[first:first + BLOCK_POINTS]
+      blockStart = start + first * step
+      write(pack_points((blockStart, blockStart + len(block) * step, step), block))
+    return
+
+  values = as_list(values)
+  if options.format in ('json', 'jsonl'):
+    values = [json_value(value) for value in values]
+
+  if options.format == 'json':
+    values_json = json.dumps(values)
+    print '''{
     "start" : %d,
     "end" : %d,
     "step" : %d,
     "values" : %s
   }''' % (start,end,step,values_json)
-  sys.exit(0)
-
-t = start
-for value in values:
-  if options.pretty:
-    timestr = time.ctime(t)
+  elif options.format == 'jsonl':
+    write(json.dumps({'path' : path, 'start' : start, 'end' : end, 'step' : step,
+                      'values' : values}, sort_keys=True) + '\n')
+  elif options.format == 'csv':
+    lineFormat = quote_csv(path).replace('%', '%%') + ',%d,%s\n'
+    for first in xrange(0, len(values), BLOCK_POINTS):
+      write(''.join([lineFormat % (start + (first + i) * step, format_csv(value))
+                     for (i, value) in enumerate(values[first:first + BLOCK_POINTS])]))
   else:
-    timestr = str(t)
-  if value is None:
-    valuestr = "None"
+    prefix = ''
+    if len(paths) > 1:
+      prefix = path + '\t'
+    for first in xrange(0, len(values), BLOCK_POINTS):
+      write(''.join(['%s%s\t%s\n' % (prefix, format_time(start + (first + i) * step), format_text(value))
+                     for (i, value) in enumerate(values[first:first + BLOCK_POINTS])]))
+
+def build_matrix(series):
+  """Align a list of (timeInfo, values), or None for no values, on the union
+of their timestamps. Returns the timestamps and a row of values for each"""
+  timestamps = set()
+  for fetched in series:
+    if fetched is not None:
+      timestamps.update(xrange(*fetched[0]))
+  timestamps = sorted(timestamps)
+  rowOf = dict([(t, i) for (i, t) in enumerate(timestamps)])
+
+  columns = []
+  for fetched in series:
+    column = [None] * len(timestamps)
+    if fetched is not None:
+      ((start, end, step), values) = fetched
+      for (t, value) in zip(xrange(start, end, step), as_list(values)):
+        column[rowOf[t]] = value
+    columns.append(column)
+  return (timestamps, zip(*columns))
+
+def write_matrix(paths, series):
+  write = sys.stdout.write
+  (timestamps, rows) = build_matrix(series)
+  if options.format == 'binary':
+    nan = float('nan')
+    rowFormat = '!' + 'd' * (len(paths) + 1)
+    for first in xrange(0, len(rows), BLOCK_POINTS):
+      write(''.join([struct.pack(rowFormat, t, *[value is None and nan or value for value in row])
+                     for (t, row) in zip(timestamps[first:first + BLOCK_POINTS],
+                                         rows[first:first + BLOCK_POINTS])]))
+  elif options.format == 'jsonl':
+    write(json.dumps({'paths' : paths}) + '\n')
+    for (t, row) in zip(timestamps, rows):
+      write(json.dumps({'timestamp' : t, 'values' : [json_value(value) for value in row]},
+                       sort_keys=True) + '\n')
+  elif options.format == 'csv':
+    write(','.join(['timestamp'] + [quote_csv(path) for path in paths]) + '\n')
+    for first in xrange(0, len(rows), BLOCK_POINTS):
+      write(''.join([','.join([str(t)] + [format_csv(value) for value in row]) + '\n'
+                     for (t, row) in zip(timestamps[first:first + BLOCK_POINTS],
+                                         rows[first:first + BLOCK_POINTS])]))
   else:
-    valuestr = "%f" % value
-  print "%s\t%s" % (timestr,valuestr)
-  t += step
+    write('\t'.join(['timestamp'] + paths) + '\n')
+    for first in xrange(0, len(rows), BLOCK_POINTS):
+      write(''.join(['\t'.join([format_time(t)] + [format_text(value) for value in row]) + '\n'
+                     for (t, row) in zip(timestamps[first:first + BLOCK_POINTS],
+                                         rows[first:first + BLOCK_POINTS])]))
+
+
+if options.format in ('json', 'jsonl'):
+  try:
+    import json
+  except ImportError:
+    raise SystemExit('[ERROR] JSON output needs python 2.6 or later')
+elif options.format == 'csv' and not options.matrix:
+  sys.stdout.write('path,timestamp,value\n')
+
+failed = 0
+series = []
+for (path, result) in fetch_all(paths):
+  if isinstance(result, Exception):
+    if len(paths) == 1:
+      raise SystemExit('[ERROR] %s' % str(result))
+    sys.stderr.write('[ERROR] %s: %s\n' % (path, result))
+    failed += 1
+    result = None
+  if options.matrix:
+    series.append(result)
+  elif result is not None:
+    write_series(path, *result)
+
+if options.matrix:
+  write_matrix(paths, series)
+if failed:
+  sys.exit(1)
@@ -14,7 +14,13 @@ except ImportError:
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 option_parser = optparse.OptionParser(
-    usage='''%prog [options] from_path to_path''')
+    usage='''%prog [options] from_path [from_path ...] to_path
+
+Merges every from_path into to_path in a single pass. A point held by several
+files is taken from the last from_path that has it, or with --fill from
+to_path or else the first from_path that has it.''')
+option_parser.add_option('--fill', default=False, action='store_true',
+  help="Only copy the points to_path does not have, keeping its own values")
 
 (options, args) = option_parser.parse_args()
 
@@ -22,11 +28,11 @@ if len(args) < 2:
   option_parser.print_help()
   sys.exit(1)
 
-path_from = args[0]
-path_to = args[1]
+paths_from = args[:-1]
+path_to = args[-1]
 
-for filename in (path_from, path_to):
+for filename in args:
    if not os.path.exists(filename):
        raise SystemExit('[ERROR] File "%s" does not exist!' % filename)
 
-whisper.merge(path_from, path_to)
+whisper.merge_many(paths_from, path_to, options.fill and 'fill' or 'overwrite')
@@ -2,9 +2,6 @@
 
 import os
 import sys
-import math
-import time
-import bisect
 import signal
 import optparse
 import traceback
@@ -17,8 +14,6 @@ except ImportError:
 # Ignore SIGPIPE
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
-now = int(time.time())
-
 option_parser = optparse.OptionParser(
     usage='''%prog path timePerPoint:timeToStore [timePerPoint:timeToStore]*
 
@@ -49,7 +44,7 @@ option_parser.add_option(
 option_parser.add_option(
     '--aggregate', action='store_true',
     help='Try to aggregate the values to fit the new archive better.'
-         ' Note that this will make things slower and use more memory.')
+         ' Note that this will make things slower.')
 
 (options, args) = option_parser.parse_args()
 
@@ -64,32 +59,9 @@ if not os.path.exists(path):
   option_parser.print_help()
   sys.exit(1)
 
-info = whisper.info(path)
-
 new_archives = [whisper.parseRetentionDef(retentionDef)
                 for retentionDef in args[1:]]
 
-old_archives = info['archives']
-# sort by precision, lowest to highest
-old_archives.sort(key=lambda a: a['secondsPerPoint'], reverse=True)
-
-if options.xFilesFactor is None:
-  xff = info['xFilesFactor']
-else:
-  xff = options.xFilesFactor
-
-if options.aggregationMethod is None:
-  aggregationMethod = info['aggregationMethod']
-else:
-  aggregationMethod = options.aggregationMethod
-
-print 'Retrieving all data from the archives'
-for archive in old_archives:
-  fromTime = now - archive['retention'] + archive['secondsPerPoint']
-  untilTime = now
-  timeinfo,values = whisper.fetch(path, fromTime, untilTime)
-  archive['data'] = (timeinfo,values)
-
 if options.newfile is None:
   tmpfile = path + '.tmp'
   if os.path.exists(tmpfile):
@@ -99,69 +71,18 @@ if options.newfile is None:
 else:
   newfile = options.newfile
 
-print 'Creating new whisper database: %s' % newfile
-whisper.create(newfile, new_archives, xFilesFactor=xff, aggregationMethod=aggregationMethod)
-size = os.stat(newfile).st_size
-print 'Created: %s (%d bytes)' % (newfile,size)
-
 if options.aggregate:
-  # This is where data will be interpolated (best effort)
-  print 'Migrating data with aggregation...'
-  all_datapoints = []
-  for archive in old_archives:
-    # Loading all datapoints into memory for fast querying
-    timeinfo, values = archive['data']
-    new_datapoints = zip( range(*timeinfo), values )
-    if all_datapoints:
-      last_timestamp = all_datapoints[-1][0]
-      slice_end = 0
-      for i,(timestamp,value) in enumerate(new_datapoints):
-        if timestamp > last_timestamp:
-          slice_end = i
-          break
-      all_datapoints += new_datapoints[i:]
-    else:
-      all_datapoints += new_datapoints
-
-  oldtimestamps = map( lambda p: p[0], all_datapoints)
-  oldvalues = map( lambda p: p[1], all_datapoints)
-
-  print "oldtimestamps: %s" % oldtimestamps
-  # Simply cleaning up some used memory
-  del all_datapoints
-
-  new_info = whisper.info(newfile)
-  new_archives = new_info['archives']
-
-  for archive in new_archives:
-    step = archive['secondsPerPoint']
-    fromTime = now - archive['retention'] + now % step
-    untilTime = now + now % step + step
-    print "(%s,%s,%s)" % (fromTime,untilTime, step)
-    timepoints_to_update = range(fromTime, untilTime, step)
-    print "timepoints_to_update: %s" % timepoints_to_update
-    newdatapoints = []
-    for tinterval in zip( timepoints_to_update[:-1], timepoints_to_update[1:] ):
-      # TODO: Setting lo= parameter for 'lefti' based on righti from previous
-      #       iteration. Obviously, this can only be done if
-      #       timepoints_to_update is always updated. Is it?
-      lefti = bisect.bisect_left(oldtimestamps, tinterval[0])
-      righti = bisect.bisect_left(oldtimestamps, tinterval[1], lo=lefti)
-      newvalues = oldvalues[lefti:righti]
-      if newvalues:
-        non_none = filter( lambda x: x is not None, newvalues)
-        if 1.0*len(non_none)/len(newvalues) >= xff:
-          newdatapoints.append([tinterval[0],
-                                whisper.aggregate(aggregationMethod,
-                                                  non_none)])
-    whisper.update_many(newfile, newdatapoints)
+  print 'Migrating data with aggregation to: %s' % newfile
 else:
-  print 'Migrating data without aggregation...'
-  for archive in old_archives:
-    timeinfo, values = archive['data']
-    datapoints = zip( range(*timeinfo), values )
-    datapoints = filter(lambda p: p[1] is not None, datapoints)
-    whisper.update_many(newfile, datapoints)
+  print 'Migrating data without aggregation to: %s' % newfile
+try:
+  whisper.resize(path, new_archives, xFilesFactor=options.xFilesFactor,
+                 aggregationMethod=options.aggregationMethod,
+                 aggregate=options.aggregate, newfile=newfile)
+except whisper.WhisperException, exc:
+  raise SystemExit('[ERROR] %s' % str(exc))
+size = os.stat(newfile).st_size
+print 'Created: %s (%d bytes)' % (newfile,size)
 
 if options.newfile is not None:
   sys.exit(0)
@@ -1,6 +1,5 @@
 #!/usr/bin/env python
-import sys, os, fnmatch
-from subprocess import call
+import sys, os, time, fnmatch, itertools, traceback
 from optparse import OptionParser
 
 option_parser = OptionParser(
@@ -30,7 +29,22 @@ option_parser.add_option(
     help="ask for comfirmation prior to resizing a whisper file")
 option_parser.add_option(
     '-x', '--extra_args', default='',
-    type='string', help="pass any additional arguments to the whisper-resize.py script")
+    type='string', help="additional whisper-resize.py arguments, --aggregate and --nobackup are understood")
+option_parser.add_option(
+    '--aggregate', default=False, action='store_true',
+    help="aggregate the values to fit the new archives better, like whisper-resize.py --aggregate")
+option_parser.add_option(
+    '--nobackup', default=False, action='store_true',
+    help="do not keep a .bak copy of the files resized")
+option_parser.add_option(
+    '--workers', default=1, type='int',
+    help="processes checking and resizing files in parallel (default: 1)")
+option_parser.add_option(
+    '--summary', default=False, action='store_true',
+    help="only print how many files need each change, not every file")
+option_parser.add_option(
+    '--progress', default=10.0, type='float',
+    help="seconds between throughput reports on stderr, 0 for none (default: 10)")
 
 (options, args) = option_parser.parse_args()
 
@@ -38,6 +52,17 @@ if len(args) < 2:
     option_parser.print_help()
     sys.exit(1)
 
+for extra_arg in options.extra_args.split():
+    if extra_arg == '--aggregate':
+        options.aggregate = True
+    elif extra_arg == '--nobackup':
+        options.nobackup = True
+    else:
+        raise SystemExit('[ERROR] Unsupported whisper-resize.py argument: %s' % extra_arg)
+
+if options.confirm and options.workers > 1:
+    raise SystemExit('[ERROR] --confirm asks about each file in turn, it can not be used with --workers')
+
 storagePath = args[0]
 configPath  = args[1]
 
@@ -76,95 +101,145 @@ settings.LOCAL_DATA_DIR = storagePath
 # import these once we have the settings figured out
 from carbon.storage import loadStorageSchemas, loadAggregationSchemas
 
-# Load the Defined Schemas from our config files
-schemas = loadStorageSchemas()
-agg_schemas = loadAggregationSchemas()
-
-# check to see if a metric needs to be resized based on the current config
-def processMetric(fullPath, schemas, agg_schemas):
+def getSchema(metric):
     """
-        method to process a given metric, and resize it if necessary
+        find the storage and aggregation settings carbon uses for a metric
 
         Parameters:
-            fullPath    - full path to the metric whisper file
-            schemas     - carbon storage schemas loaded from config
-            agg_schemas - carbon storage aggregation schemas load from confg
+            metric - the graphite metric name
 
+        Returns a tuple of the archive list, xFilesFactor and aggregationMethod
     """
-    schema_config_args = ''
-    schema_file_args   = ''
-    rebuild = False
-    messages = ''
-
-    # get archive info from whisper file
-    info = whisper.info(fullpath)
-
-    # get graphite metric name from fullPath
-    metric = getMetricFromPath(fullpath)
-
+    archive_config = None
     # loop the carbon-storage schemas
-    for schema in schemas:
+    for schema, config in storage_schemas:
         if schema.matches(metric):
-            # returns secondsPerPoint and points for this schema in tuple format
-            archive_config = [archive.getTuple() for archive in schema.archives]
+            archive_config = config
             break
 
+    xFilesFactor, aggregationMethod = None, None
     # loop through the carbon-aggregation schemas
     for agg_schema in agg_schemas:
         if agg_schema.matches(metric):
             xFilesFactor, aggregationMethod = agg_schema.archives
             break
 
-    # loop through the bucket tuples and convert to string format for resizing
-    for retention in archive_config:
-        current_schema = '%s:%s ' % (retention[0], retention[1])
-        schema_config_args += current_schema
+    return (archive_config, xFilesFactor, aggregationMethod)
+
+# check to see if a metric needs to be resized based on the current config
+def checkMetric(fullPath):
+    """
+        method to compare a given metric with its configured schemas
+
+        Parameters:
+            fullPath    - full path to the metric whisper file
+
+        Returns None when the metric is up to date, or a dict describing the
+        resize it needs
+    """
+    messages = ''
+
+    # get archive info from whisper file
+    info = whisper.info(fullPath)
+
+    # get graphite metric name from fullPath
+    metric = getMetricFromPath(fullPath)
+
+    archive_config, xFilesFactor, aggregationMethod = getSchema(metric)
+    if archive_config is None:
+        return None
+    if xFilesFactor is None:
+        xFilesFactor = info['xFilesFactor']
+    if aggregationMethod is None:
+        aggregationMethod = info['aggregationMethod']
 
-    # loop through the current files bucket sizes and convert to string format to compare for resizing
-    for fileRetention in info['archives']:
-        current_schema  = '%s:%s ' % (fileRetention['secondsPerPoint'], fileRetention['points'])
-        schema_file_args += current_schema
+    file_config = [(archive['secondsPerPoint'], archive['points']) for archive in info['archives']]
+    schema_config_args = ' '.join(['%s:%s' % retention for retention in archive_config])
+    schema_file_args = ' '.join(['%s:%s' % retention for retention in file_config])
 
     # check to see if the current and configured schemas are the same or rebuild
-    if (schema_config_args != schema_file_args):
-        rebuild = True
+    if (file_config != archive_config):
         messages += 'updating Retentions from: %s to: %s \n' % (schema_file_args, schema_config_args)
 
     # only care about the first two decimals in the comparison since there is floaty stuff going on.
     info_xFilesFactor = "{0:.2f}".format(info['xFilesFactor'])
     str_xFilesFactor =  "{0:.2f}".format(xFilesFactor)
 
-    # check to see if the current and configured aggregationMethods are the same
+    # check to see if the current and configured xFilesFactor are the same
     if (str_xFilesFactor != info_xFilesFactor):
-        rebuild = True
         messages += '%s xFilesFactor differs real: %s should be: %s \n' % (metric, info_xFilesFactor, str_xFilesFactor)
+
+    # check to see if the current and configured aggregationMethods are the same
     if (aggregationMethod != info['aggregationMethod']):
-        rebuild = True
         messages += '%s aggregation schema differs real: %s should be: %s \n' % (metric, info['aggregationMethod'], aggregationMethod)
 
-    # check to see if the current and configured xFilesFactor are the same
-    if (xFilesFactor != info['xFilesFactor']):
-        rebuild = True
-        messages += '%s xFilesFactor differs real: %s should be: %s \n' % (metric, info['xFilesFactor'], xFilesFactor)
-
-    # if we need to rebuild, lets do it.
-    if (rebuild == True):
-        cmd = 'whisper-resize.py %s %s --xFilesFactor=%s --aggregationMethod=%s %s' % (fullPath, options.extra_args, xFilesFactor, aggregationMethod, schema_config_args)
-        if (options.quiet != True or options.confirm == True):
-            print messages
-            print cmd
-
-        if (options.confirm == True):
-            options.doit = confirm("Would you like to run this command? [y/n]: ")
-            if (options.doit == False):
-                print "Skipping command \n"
-
-        if (options.doit == True):
-            exitcode = call(cmd, shell=True)
-            # if the command failed lets bail so we can take a look before proceeding
-            if (exitcode > 0):
-                print 'Error running: %s' % (cmd)
-                sys.exit(1)
+    if not messages:
+        return None
+
+    extra_args = ''
+    if options.aggregate:
+        extra_args += '--aggregate '
+    if options.nobackup:
+        extra_args += '--nobackup '
+    return {
+        'path': fullPath,
+        'change': (schema_file_args, info['xFilesFactor'], info['aggregationMethod'],
+                   schema_config_args, xFilesFactor, aggregationMethod),
+        'archives': archive_config,
+        'xFilesFactor': xFilesFactor,
+        'aggregationMethod': aggregationMethod,
+        'messages': messages,
+        'command': 'whisper-resize.py %s %s--xFilesFactor=%s --aggregationMethod=%s %s' % (
+            fullPath, extra_args, xFilesFactor, aggregationMethod, schema_config_args),
+    }
+
+def resizeMetric(resize):
+    """
+        resize a metric in place the way whisper-resize.py does, keeping a .bak
+        copy of it unless --nobackup was given
+
+        Parameters:
+            resize - the dict returned by checkMetric
+    """
+    path = resize['path']
+    if options.nobackup:
+        newfile = None
+    else:
+        newfile = path + '.tmp'
+        if os.path.exists(newfile):
+            os.unlink(newfile)
+    whisper.resize(path, resize['archives'], xFilesFactor=resize['xFilesFactor'],
+                   aggregationMethod=resize['aggregationMethod'],
+                   aggregate=options.aggregate, newfile=newfile)
+    if newfile is not None:
+        # link the backup rather than rename it so path never goes missing
+        backup = path + '.bak'
+        if os.path.exists(backup):
+            os.unlink(backup)
+        os.link(path, backup)
+        os.rename(newfile, path)
+        whisper.invalidateHeaderCache(path)
+
+def processMetric(fullPath):
+    """
+        method to process a given metric, and resize it if necessary, in a
+        worker process when --workers is more than 1
+
+        Parameters:
+            fullPath    - full path to the metric whisper file
+
+        Returns a tuple of the resize needed (or None), whether it was done and
+        the error that stopped it (or None)
+    """
+    resize = None
+    try:
+        resize = checkMetric(fullPath)
+        if resize is not None and options.doit and not options.confirm:
+            resizeMetric(resize)
+            return (resize, True, None)
+    except Exception:
+        return (resize, False, '%s: %s' % (fullPath, traceback.format_exc()))
+    return (resize, False, None)
 
 def getMetricFromPath(filePath):
     """
@@ -200,9 +275,81 @@ def confirm(question, error_response='Valid options : yes or no'):
             return False
         print error_response
 
-for root, _, files in os.walk(processPath):
-    # we only want to deal with non-hidden whisper files
-    for f in fnmatch.filter(files, '*.wsp'):
-        fullpath = os.path.join(root, f)
-        processMetric(fullpath, schemas, agg_schemas)
+def findMetrics(path):
+    for root, _, files in os.walk(path):
+        # we only want to deal with non-hidden whisper files
+        for f in fnmatch.filter(files, '*.wsp'):
+            yield os.path.join(root, f)
+
+# Load the Defined Schemas from our config files, with each storage schema's
+# archives converted to (secondsPerPoint, points) tuples once
+storage_schemas = [(schema, [archive.getTuple() for archive in schema.archives])
+                   for schema in loadStorageSchemas()]
+agg_schemas = loadAggregationSchemas()
+
+if options.workers > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(options.workers)
+    results = pool.imap_unordered(processMetric, findMetrics(processPath), 16)
+else:
+    pool = None
+    results = itertools.imap(processMetric, findMetrics(processPath))
+
+checked = resized = failed = 0
+changes = {}
+start = last_report = time.time()
 
+def reportProgress(final=False):
+    elapsed = time.time() - start
+    sys.stderr.write('%d files checked (%.1f/s), %d need resizing, %d resized, %d failed%s\n' % (
+        checked, checked / max(elapsed, 0.001), sum(changes.values()), resized, failed,
+        final and ' in %.1fs' % elapsed or ''))
+
+try:
+    for resize, done, error in results:
+        checked += 1
+        if resize is not None:
+            changes[resize['change']] = changes.get(resize['change'], 0) + 1
+            if not options.summary and (options.quiet != True or options.confirm == True):
+                print resize['messages']
+                print resize['command']
+
+            if options.confirm and options.doit:
+                if confirm("Would you like to run this command? [y/n]: "):
+                    try:
+                        resizeMetric(resize)
+                        done = True
+                    except Exception:
+                        error = '%s: %s' % (resize['path'], traceback.format_exc())
+                else:
+                    print "Skipping command \n"
+
+        if done:
+            resized += 1
+        if error is not None:
+            failed += 1
+            # if a resize failed lets bail so we can take a look before proceeding
+            print 'Error resizing %s' % error
+            break
+
+        if options.progress and time.time() - last_report >= options.progress:
+            reportProgress()
+            last_report = time.time()
+finally:
+    if pool is not None:
+        # the files being resized when a resize fails are left as they were,
+        # or with a stray .tmp file
+        pool.terminate()
+        pool.join()
+
+if options.summary:
+    print '%9s  %-40s %-40s' % ('files', 'from', 'to')
+    for change, count in sorted(changes.items(), key=lambda item: -item[1]):
+        (from_archives, from_xff, from_method, to_archives, to_xff, to_method) = change
+        print '%9d  %-40s %-40s' % (count,
+            '%s xff=%.2f %s' % (from_archives, from_xff, from_method),
+            '%s xff=%.2f %s' % (to_archives, to_xff, to_method))
+reportProgress(final=True)
+
+if failed:
+    sys.exit(1)
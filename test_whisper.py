@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 
 import os
+import csv
+import sys
+import json
 import time
+import signal
 import random
 import struct
+import threading
+import subprocess
 
 try:
     import unittest2 as unittest
@@ -12,6 +18,9 @@ except ImportError:
 
 import whisper
 
+if whisper.CAN_LOCK:
+    import fcntl
+
 
 class TestWhisper(unittest.TestCase):
     """
@@ -73,9 +82,54 @@ class TestWhisper(unittest.TestCase):
         self.assertEqual(whisper.aggregate('sum', [10, 2, 3, 4]), 19)
         # average of the list elements
         self.assertEqual(whisper.aggregate('average', [1, 2, 3, 4]), 2.5)
+        # average counting the missing values as zeros
+        self.assertEqual(whisper.aggregate('avg_zero', [1, 2, 3],
+                                           [1, None, 2, 3]), 1.5)
+        with self.assertRaises(ValueError):
+            whisper.aggregate('avg_zero', [10.0])
+        # the values furthest from and closest to zero
+        self.assertEqual(whisper.aggregate('absmax', [-7, 2, 5]), -7)
+        self.assertEqual(whisper.aggregate('absmin', [-7, 2, -1]), -1)
+        self.assertEqual(whisper.aggregate('count', [4, 0, 9]), 3)
+        self.assertEqual(whisper.aggregate('median', [5, 1, 3]), 3)
+        self.assertEqual(whisper.aggregate('median', [5, 1, 3, 4]), 3.5)
         with self.assertRaises(whisper.InvalidAggregationMethod):
             whisper.aggregate('derp', [12, 2, 3123, 1])
 
+    @unittest.skipIf(not whisper.CAN_NUMPY, "numpy is not installed")
+    def test_aggregate_array(self):
+        """batch aggregation agrees with aggregate() for every method"""
+        aggregateArray = getattr(whisper, '__aggregate_array')
+        rows = [[random.choice([None, random.uniform(-10, 10)])
+                 for i in range(6)] for j in range(50)]
+        rows.append([None] * 5 + [2.0])
+        values = whisper.numpy.array([[v is None and 99.0 or v for v in row]
+                                      for row in rows])
+        known = whisper.numpy.array([[v is not None for v in row]
+                                     for row in rows])
+        for method in whisper.aggregationMethods:
+            batch = aggregateArray(method, values, known).tolist()
+            for (row, value) in zip(rows, batch):
+                knownValues = [v for v in row if v is not None]
+                if knownValues:
+                    self.assertAlmostEqual(
+                        value, whisper.aggregate(method, knownValues, row))
+
+        # a method registered without an array function works row by row
+        whisper.registerAggregationMethod('spread', 200,
+                                          lambda k, n: max(k) - min(k))
+        try:
+            self.assertEqual(whisper.aggregationMethodToType['spread'], 200)
+            self.assertEqual(aggregateArray('spread', values[-2:], known[-2:])
+                             .tolist()[-1], 0.0)
+            with self.assertRaises(whisper.InvalidAggregationMethod):
+                whisper.registerAggregationMethod('other', 200, max)
+        finally:
+            del whisper.aggregationTypeToMethod[200]
+            del whisper.aggregationMethodToType['spread']
+            del whisper.aggregationFunctions['spread']
+            whisper.aggregationMethods.remove('spread')
+
     def test_create(self):
         """Create a db and use info() to validate"""
         retention = [(1, 60), (60, 60)]
@@ -134,6 +188,282 @@ class TestWhisper(unittest.TestCase):
         except Exception:
           pass
 
+    def test_merge_modes(self):
+        """merge copies points between archives starting at different slots"""
+        testdb = "test-%s" % self.db
+        emptydb = "empty-%s" % self.db
+        retention = [(1, 300), (60, 120)]
+        # the last second of a minute, so both files share one minute point
+        now = int(time.time())
+        now -= now % 60 + 1
+        for path in (self.db, testdb, emptydb):
+            whisper.create(path, retention)
+        try:
+            # source has [now-39, now-10], destination [now-49, now-20] with
+            # other values, so their base intervals differ
+            whisper.update_many(self.db, [(now - i, float(i))
+                                          for i in range(10, 40)])
+            whisper.update_many(testdb, [(now - i, -float(i))
+                                         for i in range(20, 50)])
+            whisper.update(testdb, 7.0, now - 3600)
+
+            self.assertEqual(whisper.merge(self.db, emptydb), 30 + 1)
+            self.assertEqual(whisper.fetch(emptydb, 0),
+                             whisper.fetch(self.db, 0))
+
+            fh_from = open(self.db, 'rb')
+            fh_to = open(testdb, 'rb+')
+            try:
+                self.assertEqual(whisper.file_merge(fh_from, fh_to, 'fill'),
+                                 10)
+                self.assertFalse(fh_from.closed or fh_to.closed)
+            finally:
+                fh_from.close()
+                fh_to.close()
+            (timeInfo, values) = whisper.fetch(testdb, now - 50, now)
+            points = dict(zip(range(*timeInfo), values))
+            for i in range(10, 50):
+                self.assertEqual(points[now - i], i < 20 and i or -i)
+
+            # the minute point is copied as it is, not recomputed
+            self.assertEqual(whisper.merge(self.db, testdb), 20 + 1)
+            (timeInfo, values) = whisper.fetch(testdb, now - 50, now)
+            points = dict(zip(range(*timeInfo), values))
+            for i in range(10, 50):
+                self.assertEqual(points[now - i], i < 40 and i or -i)
+            self.assertEqual(whisper.fetch(testdb, now - 3660, now - 3600)[1],
+                             [7.0])
+            self.assertEqual(whisper.fetch(testdb, 0)[1][-1],
+                             whisper.fetch(self.db, 0)[1][-1])
+            self.assertEqual(whisper.merge(self.db, testdb), 0)
+
+            with self.assertRaises(ValueError):
+                whisper.merge(self.db, testdb, 'newest')
+        finally:
+            for path in (self.db, testdb, emptydb):
+                os.unlink(path)
+
+    def test_dump_formats(self):
+        """whisper-dump output parses back to the points stored"""
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'bin', 'whisper-dump.py')
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join([
+            os.path.dirname(os.path.abspath(whisper.__file__)),
+            environment.get('PYTHONPATH', '')])
+
+        def dump(*args):
+            process = subprocess.Popen([sys.executable, script] + list(args) +
+                                       [self.db], stdout=subprocess.PIPE,
+                                       env=environment)
+            output = process.communicate()[0]
+            self.assertEqual(process.returncode, 0)
+            return output
+
+        self._removedb()
+        whisper.create(self.db, [(1, 60), (10, 60)])
+        now = int(time.time())
+        points = [(now - 3, 1.5), (now - 2, float('inf')), (now - 1, -2.25)]
+        whisper.update_many(self.db, points)
+        try:
+            rows = list(csv.reader(dump('--format', 'csv', '--archive', '0')
+                                   .splitlines()))
+            self.assertEqual(rows[0], ['archive', 'timestamp', 'value'])
+            self.assertEqual([(int(t), float(v)) for (a, t, v) in rows[1:]],
+                             points)
+
+            lines = dump('--format', 'jsonl', '--archive', '0').splitlines()
+            self.assertEqual([json.loads(line) for line in lines],
+                             [{'archive': 0, 'timestamp': t, 'value': v}
+                              for (t, v) in zip([t for (t, v) in points],
+                                                [1.5, None, -2.25])])
+
+            raw = dump('--format', 'raw', '--archive', '0',
+                       '--since', str(now - 2))
+            self.assertEqual([struct.unpack(whisper.pointFormat,
+                                            raw[i:i + whisper.pointSize])
+                              for i in range(0, len(raw), whisper.pointSize)],
+                             points[1:])
+        finally:
+            self._removedb()
+
+    def test_diff(self):
+        """diff lists the intervals with different values in each archive"""
+        testdb = "test-%s" % self.db
+        retention = [(1, 60), (10, 60)]
+        now = int(time.time())
+        for path in (self.db, testdb):
+            whisper.create(path, retention)
+        try:
+            whisper.update_many(self.db, [(now - t, float(t))
+                                          for t in range(1, 40)])
+            whisper.update_many(testdb, [(now - t, float(t % 30))
+                                         for t in range(20, 50)])
+            whisper.update(self.db, 5.0, now - 300)
+            whisper.update(testdb, 5.0, now - 300)
+
+            canNumpy = [False]
+            if whisper.CAN_NUMPY:
+                canNumpy.append(True)
+            for whisper.CAN_NUMPY in canNumpy:
+                diffs = whisper.diff(self.db, testdb)
+                self.assertEqual([(n, len(d), c) for (n, d, c) in diffs],
+                                 whisper.diff_summary(self.db, testdb))
+                (number, points, compared) = diffs[0]
+                self.assertEqual(compared, 49)
+                self.assertEqual(len(points), 49 - 10)
+                for (timestamp, fromValue, toValue) in points:
+                    t = now - timestamp
+                    self.assertEqual(fromValue, t < 40 and float(t) or None)
+                    if t >= 20:
+                        self.assertEqual(toValue, float(t % 30))
+                    else:
+                        self.assertEqual(toValue, None)
+                # the point at now - 300 only lives in the lower archive
+                self.assertEqual(diffs[1][0], 1)
+                self.assertTrue(diffs[1][2] >= 1)
+
+                summary = whisper.diff_summary(self.db, testdb,
+                                               ignore_empty=True)
+                self.assertEqual(summary[0], (0, 20 - 10, 20))
+        finally:
+            whisper.CAN_NUMPY = canNumpy[-1]
+            for path in (self.db, testdb):
+                os.unlink(path)
+
+    def test_resize(self):
+        """resize rewrites a file with other archives, one chunk at a time"""
+        resized = "resized-%s" % self.db
+        fresh = "fresh-%s" % self.db
+        now = int(time.time())
+        whisper.create(self.db, [(1, 60), (10, 60)])
+        try:
+            whisper.update_many(self.db, [(now - t, 1.0)
+                                          for t in range(1, 600)])
+
+            # the points are stored again as update_many would store them
+            archives = [(5, 12), (30, 20)]
+            whisper.resize(self.db, archives, newfile=resized, chunkPoints=7)
+            whisper.create(fresh, archives)
+            for step in (10, 1):
+                (timeInfo, values) = whisper.fetch(self.db, now - 60 * step,
+                                                   now)
+                whisper.update_many(fresh, [p for p in zip(range(*timeInfo),
+                                                           values)
+                                            if p[1] is not None])
+            for fromTime in (now - 59, now - 599):
+                self.assertEqual(whisper.fetch(resized, fromTime, now),
+                                 whisper.fetch(fresh, fromTime, now))
+            os.unlink(fresh)
+            os.unlink(resized)
+
+            # each interval sums the finest old points falling in it
+            for chunkPoints in (7, 1000):
+                whisper.resize(self.db, [(5, 120)], aggregationMethod='sum',
+                               aggregate=True, newfile=resized,
+                               chunkPoints=chunkPoints)
+                (timeInfo, values) = whisper.fetch(resized, now - 590,
+                                                   now - 10)
+                for (t, value) in zip(range(*timeInfo), values):
+                    if t > now - 55:
+                        self.assertEqual(value, 5.0)
+                    elif now - t > 70 and t % 10:
+                        self.assertEqual(value, None)
+                    elif now - t > 70:
+                        self.assertEqual(value, 1.0)
+                self.assertEqual(whisper.info(resized)['aggregationMethod'],
+                                 'sum')
+                os.unlink(resized)
+
+            # in place
+            whisper.resize(self.db, [(1, 120)])
+            self.assertEqual(whisper.info(self.db)['maxRetention'], 120)
+            self.assertEqual(whisper.fetch(self.db, now - 50, now - 1)[1],
+                             [1.0] * 49)
+        finally:
+            self._removedb()
+            for path in (resized, fresh):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def test_resize_cached_header(self):
+        """resizing in place drops the cached header of the path"""
+        cacheHeaders = whisper.CACHE_HEADERS
+        validate = whisper.HEADER_CACHE_VALIDATE
+        whisper.CACHE_HEADERS = True
+        whisper.HEADER_CACHE_VALIDATE = False
+        whisper.invalidateHeaderCache()
+        now = int(time.time())
+        try:
+            whisper.create(self.db, [(60, 10)])
+            whisper.update(self.db, 1.0, now - 60)
+            whisper.resize(self.db, [(300, 20), (3600, 5)])
+
+            whisper.update(self.db, 2.0, now - 10)
+            info = whisper.info(self.db)
+            self.assertEqual([a['secondsPerPoint'] for a in info['archives']],
+                             [300, 3600])
+            self.assertEqual(info['archives'][1]['offset'],
+                             info['archives'][0]['offset'] + 20 * whisper.pointSize)
+            (timeInfo, values) = whisper.fetch(self.db, now - 300, now)
+            self.assertEqual(timeInfo[2], 300)
+            self.assertEqual(values[-1], 2.0)
+        finally:
+            whisper.CACHE_HEADERS = cacheHeaders
+            whisper.HEADER_CACHE_VALIDATE = validate
+            whisper.invalidateHeaderCache()
+            self._removedb()
+
+    def test_merge_many(self):
+        """merge_many agrees with merging each replica in turn"""
+        replicas = ["replica%d-%s" % (i, self.db) for i in range(3)]
+        pairwise = "pairwise-%s" % self.db
+        retention = [(1, 120), (10, 60)]
+        now = int(time.time())
+        paths = replicas + [self.db, pairwise]
+        for path in paths:
+            whisper.create(path, retention)
+        try:
+            # each replica missed a different outage and has its own values
+            for (i, replica) in enumerate(replicas):
+                whisper.update_many(replica, [(now - t, float(t + i))
+                                              for t in range(1, 100)
+                                              if t // 10 % 3 != i])
+            for path in (self.db, pairwise):
+                whisper.update_many(path, [(now - t, -float(t))
+                                           for t in range(50, 110)])
+
+            for replica in replicas:
+                whisper.merge(replica, pairwise)
+            whisper.enableInstrumentation()
+            try:
+                copied = whisper.merge_many(replicas, self.db)
+            finally:
+                whisper.disableInstrumentation()
+            self.assertEqual(whisper.stats()['operations']['merge']['writes'],
+                             len(retention))
+            self.assertTrue(copied)
+            for fromTime in (now - 110, 0):
+                self.assertEqual(whisper.fetch(self.db, fromTime, now),
+                                 whisper.fetch(pairwise, fromTime, now))
+
+            # fill keeps the destination, then takes the first replica
+            os.unlink(self.db)
+            whisper.create(self.db, retention)
+            whisper.update_many(self.db, [(now - t, -float(t))
+                                          for t in range(50, 110)])
+            whisper.merge_many(replicas, self.db, 'fill')
+            (timeInfo, values) = whisper.fetch(self.db, now - 100, now - 1)
+            for (t, value) in zip(range(*timeInfo), values):
+                t = now - t
+                if t >= 50:
+                    self.assertEqual(value, -float(t))
+                else:
+                    self.assertEqual(value, float(t + (t // 10 % 3 == 0)))
+        finally:
+            for path in paths:
+                os.unlink(path)
+
     def test_fetch(self):
         """fetch info from database """
 
@@ -206,6 +536,761 @@ class TestWhisper(unittest.TestCase):
 
         self._removedb()
         
+    def test_whisperfile(self):
+        """update and fetch through a persistent WhisperFile handle"""
+        self._removedb()
+        whisper.create(self.db, [(1, 60), (10, 60)])
+        now = int(time.time())
+
+        wf = whisper.WhisperFile(self.db)
+        try:
+            self.assertEqual(wf.info(), whisper.info(self.db))
+            wf.update(1.0, now - 30)
+            wf.update_many([(now - i, float(i)) for i in range(1, 20)])
+            handle_fetch = wf.fetch(now - 50, now)
+        finally:
+            wf.close()
+
+        self.assertEqual(handle_fetch, whisper.fetch(self.db, now - 50, now))
+        (timeInfo, values) = handle_fetch
+        self.assertEqual(values[(now - 1 - timeInfo[0]) // timeInfo[2]], 1.0)
+        self.assertEqual(values[(now - 30 - timeInfo[0]) // timeInfo[2]], 1.0)
+
+        # the lower archive was propagated through the mapping too
+        (timeInfo, values) = whisper.fetch(self.db, now - 500, now)
+        self.assertEqual(timeInfo[2], 10)
+        self.assertTrue([v for v in values if v is not None])
+
+        self._removedb()
+
+    @unittest.skipIf(not whisper.CAN_NUMPY, "numpy is not installed")
+    def test_fetch_as_array(self):
+        """fetch values as a numpy array, wrapping around the archive"""
+        self._removedb()
+        whisper.create(self.db, [(1, 20)])
+        now = int(time.time())
+
+        # the first write sets the base of the archive, so reading the whole
+        # retention wraps around its end
+        whisper.update(self.db, 5.0, now - 5)
+        whisper.update_many(self.db, [(now - i, float(i))
+                                      for i in range(6, 19, 2)])
+
+        (timeInfo, values) = whisper.fetch(self.db, now - 19, now)
+        for wf in (None, whisper.WhisperFile(self.db, 'rb')):
+            if wf is None:
+                (arrayInfo, array) = whisper.fetch(self.db, now - 19, now,
+                                                   as_array=True)
+            else:
+                (arrayInfo, array) = wf.fetch(now - 19, now, as_array=True)
+                wf.close()
+            self.assertEqual(arrayInfo, timeInfo)
+            self.assertEqual(len(array), len(values))
+            self.assertEqual([None if v != v else v for v in array.tolist()],
+                             values)
+
+        self._removedb()
+
+    def test_iter_fetch(self):
+        """iterated chunks join up into what fetch returns"""
+        self._removedb()
+        whisper.create(self.db, [(1, 50), (10, 60)])
+        now = int(time.time())
+        self.assertEqual([values for (timeInfo, values)
+                          in whisper.iter_fetch(self.db, now - 45, now, 7)],
+                         [[None] * 7] * 6 + [[None] * 3])
+
+        # wrap the finest archive around its end
+        whisper.update(self.db, 1.0, now - 20)
+        whisper.update_many(self.db, [(now - i, float(i))
+                                      for i in range(1, 49, 3)])
+
+        (timeInfo, values) = whisper.fetch(self.db, now - 45, now)
+        wf = whisper.WhisperFile(self.db, 'rb')
+        try:
+            for chunks in (whisper.iter_fetch(self.db, now - 45, now, 7),
+                           wf.iter_fetch(now - 45, now, 7)):
+                chunks = list(chunks)
+                self.assertEqual([len(v) for (t, v) in chunks],
+                                 [7] * 6 + [3])
+                self.assertEqual(chunks[0][0][0], timeInfo[0])
+                self.assertEqual(chunks[-1][0][1], timeInfo[1])
+                self.assertEqual(sum([v for (t, v) in chunks], []), values)
+            if whisper.CAN_NUMPY:
+                arrays = [v for (t, v) in wf.iter_fetch(now - 45, now, 7,
+                                                        as_array=True)]
+                self.assertEqual([None if v != v else v for v in
+                                  whisper.numpy.concatenate(arrays).tolist()],
+                                 values)
+        finally:
+            wf.close()
+
+        self.assertEqual(list(whisper.iter_fetch(self.db, now + 10,
+                                                 now + 20)), [])
+        self._removedb()
+
+    def test_fetch_max_data_points(self):
+        """fetch consolidates to a maxDataPoints budget"""
+        self._removedb()
+        whisper.create(self.db, [(1, 600), (5, 600)], xFilesFactor=0.0)
+        now = int(time.time())
+        whisper.update_many(self.db, [(now - i, float(i))
+                                      for i in range(1, 600)])
+
+        # the finest archive that fits the budget is read as it is
+        self.assertEqual(whisper.fetch(self.db, now - 100, now,
+                                       maxDataPoints=100),
+                         whisper.fetch(self.db, now - 100, now))
+        (fullInfo, full) = whisper.fetch(self.db, now - 500, now,
+                                         maxDataPoints=100)
+        self.assertEqual(fullInfo[2], 5)
+
+        canNumpy = whisper.CAN_NUMPY
+        try:
+            results = []
+            for numpyPath in set([False, canNumpy]):
+                whisper.CAN_NUMPY = numpyPath
+                results.append(whisper.fetch(self.db, now - 500, now,
+                                             maxDataPoints=40,
+                                             aggregationMethod='max'))
+        finally:
+            whisper.CAN_NUMPY = canNumpy
+        self.assertEqual(results[0], results[-1])
+
+        (timeInfo, values) = results[0]
+        self.assertTrue(len(values) <= 40)
+        self.assertEqual(timeInfo[0] % timeInfo[2], 0)
+        self.assertEqual(len(values), (timeInfo[1] - timeInfo[0]) // timeInfo[2])
+        # each bucket holds the largest value of the coarsest archive in it
+        for (i, value) in enumerate(values):
+            start = timeInfo[0] + i * timeInfo[2]
+            known = [v for (t, v) in zip(range(*fullInfo), full)
+                     if start <= t < start + timeInfo[2] and v is not None]
+            self.assertEqual(value, known and max(known) or None)
+
+        self.assertRaises(whisper.InvalidAggregationMethod, whisper.fetch,
+                          self.db, now - 500, now, maxDataPoints=10,
+                          aggregationMethod='mode')
+        self._removedb()
+
+    def test_fetch_archive_number(self):
+        """fetch reads the requested archive, cut to its retention"""
+        self._removedb()
+        whisper.create(self.db, [(1, 60), (10, 60)], xFilesFactor=0.0)
+        now = int(time.time())
+        whisper.update_many(self.db, [(now - i, float(i))
+                                      for i in range(1, 60)])
+
+        self.assertEqual(whisper.fetch(self.db, now - 30, now,
+                                       archive_number=0),
+                         whisper.fetch(self.db, now - 30, now))
+        (timeInfo, values) = whisper.fetch(self.db, now - 30, now,
+                                           archive_number=1)
+        self.assertEqual(timeInfo[2], 10)
+        self.assertTrue([v for v in values if v is not None])
+        # the finest archive only goes back a minute
+        (timeInfo, values) = whisper.fetch(self.db, now - 300, now,
+                                           archive_number=0)
+        self.assertEqual(timeInfo[2], 1)
+        self.assertTrue(timeInfo[0] >= now - 61)
+        self.assertEqual(whisper.fetch(self.db, now - 300, now - 200,
+                                       archive_number=0), None)
+        self.assertRaises(ValueError, whisper.fetch, self.db, now - 30, now,
+                          archive_number=2)
+
+        # fetch_many passes the selection through
+        self.assertEqual(whisper.fetch_many([self.db], now - 500, now,
+                                            maxDataPoints=10,
+                                            archive_number=1),
+                         [whisper.fetch(self.db, now - 500, now,
+                                        maxDataPoints=10, archive_number=1)])
+        self._removedb()
+
+    def test_fetch_max_data_points_avg_zero(self):
+        """consolidated buckets count the slots of the range, with or
+        without numpy"""
+        self._removedb()
+        whisper.create(self.db, [(1, 600)], xFilesFactor=0.0,
+                       aggregationMethod='avg_zero')
+        now = int(time.time())
+        whisper.update_many(self.db, [(now - i, float(i % 10))
+                                      for i in range(1, 600) if i % 3])
+
+        canNumpy = whisper.CAN_NUMPY
+        try:
+            for (fromTime, maxDataPoints) in ((now - 100, 7), (now - 517, 9)):
+                results = []
+                for numpyPath in set([False, canNumpy]):
+                    whisper.CAN_NUMPY = numpyPath
+                    results.append(whisper.fetch(self.db, fromTime, now,
+                                                 maxDataPoints=maxDataPoints))
+                self.assertEqual(results[0][0], results[-1][0])
+                for (pure, array) in zip(results[0][1], results[-1][1]):
+                    self.assertAlmostEqual(pure, array)
+        finally:
+            whisper.CAN_NUMPY = canNumpy
+            self._removedb()
+
+    def test_update_many_runs(self):
+        """update_many writes each contiguous run at once, last value wins"""
+        self._removedb()
+        whisper.create(self.db, [(10, 600)])
+        now = int(time.time())
+        # two runs, one of which wraps around the end of the archive
+        points = [(now - 10 * i, float(i)) for i in range(1, 101)]
+        points += [(now - 10 * i, float(i)) for i in range(400, 600)]
+        whisper.update(self.db, 0.0, now - 5000)
+        whisper.enableInstrumentation()
+        try:
+            whisper.update_many(self.db, points)
+        finally:
+            whisper.disableInstrumentation()
+        self.assertEqual(whisper.stats()['operations']['update_many']['writes'],
+                         3)
+        (timeInfo, values) = whisper.fetch(self.db, now - 6000, now)
+        intervals = range(*timeInfo)
+        self.assertEqual(set([t for (t, v) in zip(intervals, values)
+                              if v is not None]),
+                         set([t - t % 10 for (t, v) in points]) &
+                         set(intervals))
+
+        # points falling in the same interval keep the newest
+        interval = now - now % 10 - 100
+        whisper.update_many(self.db, [(interval + 9, 1.0), (interval, 2.0),
+                                      (interval + 3, 3.0)])
+        (timeInfo, values) = whisper.fetch(self.db, interval - 1, interval)
+        self.assertEqual(values, [1.0])
+        self._removedb()
+
+    def test_update_many_propagation(self):
+        """a backfill propagates like the same points written one by one"""
+        testdb = "test-%s" % self.db
+        retention = [(1, 120), (10, 60), (60, 60)]
+        now = int(time.time())
+        points = [(now - i, float(i % 7)) for i in range(1, 110)
+                  if i % 5 != 0]
+
+        vectorize = [False]
+        if whisper.CAN_NUMPY:
+            vectorize.append(True)
+        for method in whisper.aggregationMethods:
+            self._removedb()
+            whisper.create(testdb, retention, xFilesFactor=0.5,
+                           aggregationMethod=method)
+            for (timestamp, value) in points:
+                whisper.update(testdb, value, timestamp)
+
+            for use_numpy in vectorize:
+                whisper.create(self.db, retention, xFilesFactor=0.5,
+                               aggregationMethod=method)
+                can_numpy = whisper.CAN_NUMPY
+                whisper.CAN_NUMPY = use_numpy
+                try:
+                    whisper.update_many(self.db, points)
+                finally:
+                    whisper.CAN_NUMPY = can_numpy
+
+                for fromTime in (now - 100, now - 500, now - 3000):
+                    self.assertEqual(whisper.fetch(self.db, fromTime, now),
+                                     whisper.fetch(testdb, fromTime, now))
+                self._removedb()
+            os.unlink(testdb)
+
+    def _fetchFinishes(self, fromTime, untilTime, timeout=1):
+        """Fetch from a child process, return whether it did within timeout"""
+        pid = os.fork()
+        if pid == 0:
+            signal.alarm(timeout)
+            try:
+                whisper.fetch(self.db, fromTime, untilTime)
+            finally:
+                os._exit(0)
+        return os.waitpid(pid, 0)[1] == 0
+
+    @unittest.skipIf(not (whisper.CAN_LOCK and hasattr(os, 'fork')),
+                     "fcntl and fork are required")
+    def test_read_locks(self):
+        """readers take shared locks, of the archives they read by ranges"""
+        self._removedb()
+        whisper.create(self.db, [(1, 60), (60, 60)])
+        now = int(time.time())
+        whisper.update_many(self.db, [(now - i, 1.0) for i in range(1, 50)])
+        (fine, coarse) = whisper.info(self.db)['archives']
+
+        settings = (whisper.LOCK, whisper.LOCK_READS, whisper.LOCK_RANGES)
+        whisper.LOCK = whisper.LOCK_READS = True
+        whisper.LOCK_RANGES = False
+        fh = open(self.db, 'r+b')
+        try:
+            # a writer holding the whole file holds off every reader
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            self.assertFalse(self._fetchFinishes(now - 30, now))
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            self.assertTrue(self._fetchFinishes(now - 30, now))
+
+            # by ranges, only the readers of the archive being written wait
+            whisper.LOCK_RANGES = True
+            fcntl.lockf(fh.fileno(), fcntl.LOCK_EX, fine['size'],
+                        fine['offset'])
+            self.assertFalse(self._fetchFinishes(now - 30, now))
+            self.assertTrue(self._fetchFinishes(now - 3000, now))
+        finally:
+            fh.close()
+            (whisper.LOCK, whisper.LOCK_READS, whisper.LOCK_RANGES) = settings
+        self._removedb()
+
+    @unittest.skipIf(not (whisper.CAN_LOCK and hasattr(os, 'fork')),
+                     "fcntl and fork are required")
+    def test_read_inside_write_lock(self):
+        """a locked read through a handle holding the write lock keeps it"""
+        self._removedb()
+        whisper.create(self.db, [(1, 60), (60, 60)])
+        now = int(time.time())
+
+        settings = (whisper.LOCK, whisper.LOCK_READS, whisper.LOCK_RANGES)
+        whisper.LOCK = whisper.LOCK_READS = True
+        try:
+            for ranges in (False, True):
+                whisper.LOCK_RANGES = ranges
+                fh = open(self.db, 'r+b')
+                try:
+                    whisper.file_update_many(fh, [(now - 1, 1.0)])
+                    (timeInfo, values) = whisper.file_fetch(fh, now - 30, now)
+                    self.assertEqual(values[-2:], [1.0, None])
+                    self.assertFalse(self._fetchFinishes(now - 30, now))
+                finally:
+                    fh.close()
+                self.assertTrue(self._fetchFinishes(now - 30, now))
+
+            # a handle that gave its write lock back locks its reads again
+            whisper.LOCK_RANGES = False
+            wsp = whisper.WhisperFile(self.db)
+            try:
+                wsp.update(2.0, now - 1)
+                self.assertFalse(wsp in whisper._writeLocked)
+                self.assertEqual(wsp.fetch(now - 30, now)[1][-2:], [2.0, None])
+                self.assertTrue(self._fetchFinishes(now - 30, now))
+            finally:
+                wsp.close()
+        finally:
+            (whisper.LOCK, whisper.LOCK_READS, whisper.LOCK_RANGES) = settings
+        self._removedb()
+
+    def test_header_cache(self):
+        """bounded header cache with validation and invalidation"""
+        testdb = "test-%s" % self.db
+        self._removedb()
+        whisper.create(self.db, [(1, 60)])
+        whisper.create(testdb, [(1, 60), (60, 60)])
+
+        cache_headers = whisper.CACHE_HEADERS
+        max_entries = whisper.HEADER_CACHE_MAX_ENTRIES
+        whisper.CACHE_HEADERS = True
+        whisper.HEADER_CACHE_MAX_ENTRIES = 1
+        whisper.invalidateHeaderCache()
+        try:
+            whisper.info(self.db)
+            whisper.info(self.db)
+            stats = whisper.headerCacheStats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+            # only one entry fits, reading another header evicts the first
+            whisper.info(testdb)
+            stats = whisper.headerCacheStats()
+            self.assertEqual((stats['entries'], stats['evictions']), (1, 1))
+
+            # modifying the header in place drops the cached copy
+            whisper.setAggregationMethod(testdb, 'max')
+            self.assertEqual(whisper.info(testdb)['aggregationMethod'], 'max')
+
+            # a file replaced behind the same path is detected
+            os.unlink(testdb)
+            whisper.create(testdb, [(1, 120)])
+            whisper.info(testdb)
+            os.rename(self.db, testdb)
+            self.assertEqual(whisper.info(testdb)['maxRetention'], 60)
+        finally:
+            whisper.CACHE_HEADERS = cache_headers
+            whisper.HEADER_CACHE_MAX_ENTRIES = max_entries
+            whisper.invalidateHeaderCache()
+            os.unlink(testdb)
+
+    def test_update_many_files(self):
+        """bulk update of several files with per-file errors"""
+        paths = ["test-%d-%s" % (i, self.db) for i in range(4)]
+        missing = os.path.join("test-dir", self.db)
+        retention = [(1, 60), (60, 60)]
+        for path in paths:
+            whisper.create(path, retention)
+        now = int(time.time())
+        points = [(now - i, float(i)) for i in range(10)]
+
+        try:
+            updates = dict((path, points) for path in paths)
+            updates[missing] = points
+            results = whisper.update_many_files(updates, workers=3)
+            self.assertEqual(sorted(results), sorted(updates))
+            for path in paths:
+                self.assertEqual(results[path], None)
+                self.assertEqual(whisper.fetch(path, now - 10, now)[1][-5:],
+                                 [4.0, 3.0, 2.0, 1.0, 0.0])
+            self.assertTrue(isinstance(results[missing], IOError))
+
+            # missing files are created when given an archive configuration
+            results = whisper.update_many_files({missing: points},
+                                                archiveList=retention)
+            self.assertEqual(results, {missing: None})
+            self.assertEqual(whisper.info(missing)['maxRetention'], 3600)
+        finally:
+            for path in paths + [missing]:
+                if os.path.exists(path):
+                    os.unlink(path)
+            if os.path.isdir("test-dir"):
+                os.rmdir("test-dir")
+
+    def test_write_cache(self):
+        """buffered writes are deduplicated, readable and flushed by policy"""
+        testdb = "test-%s" % self.db
+        self._removedb()
+        retention = [(10, 60), (60, 60)]
+        whisper.create(self.db, retention)
+        now = int(time.time())
+        now = now - now % 10
+
+        cache = whisper.WhisperWriteCache(maxPoints=5, archiveList=retention)
+        try:
+            # both points land in the same 10 second interval
+            cache.update(self.db, 1.0, now - 19)
+            cache.update(self.db, 2.0, now - 11)
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(whisper.fetch(self.db, now - 30, now)[1],
+                             [None, None, None])
+            self.assertEqual(cache.fetch(self.db, now - 30, now)[1],
+                             [2.0, None, None])
+
+            # the file is created on flush, until then reads come from the cache
+            cache.update_many(testdb, [(now - 10 * i, i) for i in range(3)])
+            self.assertEqual(cache.fetch(testdb, now - 30, now)[1],
+                             [2.0, 1.0, 0.0])
+
+            # going over maxPoints flushes the largest buffer first
+            cache.update_many(testdb, [(now - 10 * i, i) for i in range(3, 5)])
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(whisper.fetch(testdb, now - 50, now)[1],
+                             [4.0, 3.0, 2.0, 1.0, 0.0])
+
+            self.assertEqual(cache.flush(), {self.db: None})
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(whisper.fetch(self.db, now - 30, now)[1],
+                             [2.0, None, None])
+        finally:
+            self._removedb()
+            if os.path.exists(testdb):
+                os.unlink(testdb)
+
+    def test_write_cache_failed_flush(self):
+        """points of a path that fails to flush stay buffered for a retry"""
+        # a file where the directory of failing should be
+        blocker = "blocker-%s" % self.db
+        failing = os.path.join(blocker, "metric.wsp")
+        retention = [(10, 60)]
+        now = int(time.time())
+        now = now - now % 10
+        open(blocker, 'w').close()
+
+        cache = whisper.WhisperWriteCache(archiveList=retention)
+        try:
+            cache.update_many(self.db, [(now - 10, 1.0)])
+            cache.update_many(failing, [(now - 20, 2.0), (now - 10, 3.0)])
+            results = cache.flush()
+            self.assertEqual(results[self.db], None)
+            self.assertTrue(isinstance(results[failing], OSError))
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(cache.fetch(failing, now - 30, now)[1],
+                             [2.0, 3.0, None])
+
+            # newer points buffered meanwhile win over the requeued ones
+            cache.update(failing, 4.0, now - 10)
+            os.unlink(blocker)
+            self.assertEqual(cache.flush(), {failing: None})
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(whisper.fetch(failing, now - 30, now)[1],
+                             [2.0, 4.0, None])
+        finally:
+            self._removedb()
+            if os.path.isdir(blocker):
+                os.unlink(failing)
+                os.rmdir(blocker)
+            elif os.path.exists(blocker):
+                os.unlink(blocker)
+
+    def test_write_cache_concurrent_flush(self):
+        """flushes of the same path write in order, the last value wins"""
+        now = int(time.time())
+        now = now - now % 10
+        cache = whisper.WhisperWriteCache(archiveList=[(10, 60)])
+        started = threading.Event()
+        release = threading.Event()
+        update_many_files = whisper.update_many_files
+
+        def slowUpdate(*args, **kwargs):
+            if not started.isSet():
+                started.set()
+                release.wait(5)
+            return update_many_files(*args, **kwargs)
+
+        whisper.update_many_files = slowUpdate
+        try:
+            cache.update(self.db, 1.0, now - 10)
+            first = threading.Thread(target=cache.flush)
+            first.start()
+            started.wait(5)
+            cache.update(self.db, 2.0, now - 10)
+            second = threading.Thread(target=cache.flush)
+            second.start()
+            # the second flush must not write before the first one
+            time.sleep(0.2)
+            release.set()
+            first.join()
+            second.join()
+            self.assertEqual(cache.flushing, {})
+            self.assertEqual(whisper.fetch(self.db, now - 20, now)[1],
+                             [2.0, None])
+        finally:
+            whisper.update_many_files = update_many_files
+            release.set()
+            self._removedb()
+
+    def test_write_cache_fetch_future(self):
+        """fetching a future range of a path not written yet gives None"""
+        self._removedb()
+        now = int(time.time())
+        cache = whisper.WhisperWriteCache(archiveList=[(10, 60)])
+        cache.update(self.db, 1.0, now)
+        self.assertEqual(cache.fetch(self.db, now + 100, now + 200), None)
+        self.assertRaises(whisper.InvalidTimeInterval,
+                          cache.fetch, self.db, now - 10, now - 20)
+        self.assertFalse(os.path.exists(self.db))
+
+    def test_flush_scheduler(self):
+        """flush schedulers order and throttle the metrics to write"""
+        pending = {'a': (1, 5.0), 'b': (5, 10.0), 'c': (3, 20.0)}
+        self.assertEqual(whisper.LargestFirstScheduler().schedule(pending),
+                         ['b', 'c', 'a'])
+        self.assertEqual(whisper.OldestFirstScheduler().schedule(pending),
+                         ['a', 'b', 'c'])
+
+        throttled = whisper.LargestFirstScheduler(maxUpdatesPerSecond=2)
+        self.assertEqual(throttled.schedule(pending), ['b', 'c'])
+        self.assertEqual(throttled.schedule(pending), [])
+
+    def test_fetch_stitched(self):
+        """stitched fetch reads each archive for the range it covers best"""
+        self._removedb()
+        whisper.create(self.db, [(1, 60), (10, 60), (60, 60)])
+        now = int(time.time())
+        whisper.update_many(self.db, [(now - i, float(i))
+                                      for i in range(1, 3500)])
+
+        segments = whisper.fetch_stitched(self.db, now - 3000, now - 1)
+        self.assertEqual([timeInfo[2] for (timeInfo, values) in segments],
+                         [60, 10, 1])
+        for (older, newer) in zip(segments, segments[1:]):
+            self.assertEqual(older[0][1], newer[0][0])
+        for (timeInfo, values) in segments:
+            self.assertEqual(len(values),
+                             (timeInfo[1] - timeInfo[0]) // timeInfo[2])
+
+        # the newest segment is the full resolution data
+        (timeInfo, values) = segments[-1]
+        self.assertEqual(whisper.fetch(self.db, timeInfo[0] - 1, now - 1),
+                         segments[-1])
+
+        # a range inside the best archive gives the same as fetch
+        self.assertEqual(whisper.fetch_stitched(self.db, now - 30, now - 10),
+                         [whisper.fetch(self.db, now - 30, now - 10)])
+
+        # no data is lost next to the hand-over between two archives
+        realTime = time.time
+        time.time = lambda: now
+        try:
+            self.assertEqual(whisper.fetch_stitched(self.db, now - 59, now),
+                             [whisper.fetch(self.db, now - 59, now)])
+            for fromTime in (now - 90, now - 600, now - 1000, now - 3500):
+                stitched = whisper.fetch_stitched(self.db, fromTime, now)
+                (timeInfo, values) = whisper.fetch(self.db, fromTime, now)
+                self.assertEqual(stitched[0][0][0], timeInfo[0])
+                self.assertEqual(stitched[0][0][2], timeInfo[2])
+                self.assertEqual(stitched[0][1],
+                                 values[:len(stitched[0][1])])
+                for (older, newer) in zip(stitched, stitched[1:]):
+                    self.assertEqual(older[0][1], newer[0][0])
+                self.assertEqual(stitched[-1][0][2], 1)
+        finally:
+            time.time = realTime
+
+        # consolidated to a single series
+        (timeInfo, values) = whisper.fetch_stitched(self.db, now - 3000,
+                                                    now - 1, step=30)
+        self.assertEqual(timeInfo[2], 60)
+        self.assertEqual(timeInfo[0], segments[0][0][0])
+        self.assertEqual(len(values), (timeInfo[1] - timeInfo[0]) // 60)
+        self.assertEqual(values[:len(segments[0][1])], segments[0][1])
+
+        self._removedb()
+
+    def test_fetch_many(self):
+        """concurrent fetch of several files keeps the request order"""
+        paths = ["test-%d-%s" % (i, self.db) for i in range(5)]
+        now = int(time.time())
+        for (i, path) in enumerate(paths):
+            whisper.create(path, [(1, 60), (60, 60)])
+            whisper.update_many(path, [(now - j, float(i * j))
+                                       for j in range(1, 30)])
+        requested = paths[:2] + ["does-not-exist.wsp"] + paths[2:]
+
+        try:
+            results = whisper.fetch_many(requested, now - 40, now,
+                                         workers=3, batchSize=2)
+            self.assertEqual(len(results), len(requested))
+            self.assertTrue(isinstance(results[2], IOError))
+            for (path, result) in zip(requested, results):
+                if path in paths:
+                    self.assertEqual(result, whisper.fetch(path, now - 40,
+                                                           now))
+        finally:
+            for path in paths:
+                os.unlink(path)
+
+    def test_positional_io(self):
+        """pread/pwrite and the seek/read fallback write identical files"""
+        now = int(time.time())
+        # nothing near the 60 second boundary, the files are written a moment
+        # apart and must not pick different archives
+        single = [(now - i, float(i)) for i in [10] + range(70, 200)]
+        batch = [(now - i, float(i)) for i in range(1, 50)]
+        paths = ["pread-%s" % self.db, "seek-%s" % self.db]
+        canPread = whisper.CAN_PREAD
+
+        try:
+            for (path, usePread) in zip(paths, (True, False)):
+                whisper.CAN_PREAD = usePread and canPread
+                whisper.create(path, [(1, 60), (10, 60)])
+                for (t, v) in single:
+                    whisper.update(path, v, t)
+                # the batch wraps the finest archive
+                whisper.update_many(path, batch)
+
+            whisper.CAN_PREAD = canPread
+            self.assertEqual(open(paths[0], 'rb').read(),
+                             open(paths[1], 'rb').read())
+
+            # the file position is left alone
+            with open(paths[0], 'rb') as fh:
+                fh.seek(5)
+                whisper.file_fetch(fh, now - 50, now)
+                self.assertEqual(fh.tell(), 5)
+        finally:
+            whisper.CAN_PREAD = canPread
+            for path in paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def test_header_records(self):
+        """headers are read-only records, info() hands out plain dicts"""
+        archive = whisper.ArchiveInfo(40, 60, 1440)
+        self.assertEqual(archive.end, 40 + 1440 * whisper.pointSize)
+        self.assertEqual(archive['retention'], 86400)
+        self.assertEqual(archive, archive.asDict())
+        with self.assertRaises(AttributeError):
+            archive.points = 10
+        with self.assertRaises(KeyError):
+            archive['end']
+
+        whisper.create(self.db, [(1, 60), (60, 60)])
+        cacheHeaders = whisper.CACHE_HEADERS
+        whisper.CACHE_HEADERS = True
+        try:
+            info = whisper.info(self.db)
+            self.assertTrue(isinstance(info, dict))
+            # mutating what info() returned leaves the cached header alone
+            info['archives'].reverse()
+            info['archives'][0]['data'] = None
+            self.assertEqual(whisper.info(self.db)['archives'][0]['points'],
+                             60)
+            self.assertTrue('data' not in whisper.info(self.db)['archives'][1])
+        finally:
+            whisper.CACHE_HEADERS = cacheHeaders
+            whisper.invalidateHeaderCache()
+        self._removedb()
+
+    def test_create_many(self):
+        """bulk creation lays out the same files as create()"""
+        retention = [(1, 60), (60, 60)]
+        whisper.create(self.db, retention, xFilesFactor=0.2,
+                       aggregationMethod='max')
+        expected = open(self.db, 'rb').read()
+        methods = ['auto', 'zero', 'sparse']
+        if whisper.CAN_FALLOCATE:
+            methods.append('fallocate')
+        paths = ["%s-%s" % (method, self.db) for method in methods]
+
+        try:
+            for (method, path) in zip(methods, paths):
+                results = whisper.create_many([path, self.db], retention,
+                                              xFilesFactor=0.2,
+                                              aggregationMethod='max',
+                                              method=method, workers=2)
+                self.assertEqual(results[path], None)
+                self.assertTrue(isinstance(results[self.db],
+                                           whisper.InvalidConfiguration))
+                self.assertEqual(open(path, 'rb').read(), expected)
+            # no template is left behind
+            self.assertEqual([f for f in os.listdir('.')
+                              if f.startswith('.whisper-template-')], [])
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+        self._removedb()
+
+    def test_instrumentation(self):
+        """stats() counts operations with their I/O and latency"""
+        events = []
+        now = int(time.time())
+        whisper.enableInstrumentation(perMetric=True,
+                                      callback=lambda *a: events.append(a))
+        try:
+            whisper.create(self.db, [(1, 60), (60, 60)])
+            whisper.update(self.db, 1.0, now - 1)
+            whisper.update_many(self.db, [(now - i, float(i))
+                                          for i in range(2, 12)])
+            whisper.fetch(self.db, now - 30)
+        finally:
+            whisper.disableInstrumentation()
+
+        stats = whisper.stats()
+        operations = stats['operations']
+        self.assertEqual(operations['update']['calls'], 1)
+        self.assertEqual(operations['update']['points'], 1)
+        self.assertEqual(operations['update']['bytes_written'],
+                         whisper.pointSize)
+        self.assertEqual(operations['update_many']['points'], 10)
+        self.assertEqual(operations['fetch']['opens'], 1)
+        self.assertTrue(operations['fetch']['bytes_read'] > 0)
+        self.assertEqual(operations['fetch']['latency']['count'], 1)
+        self.assertTrue(operations['propagate']['calls'] >= 2)
+        self.assertTrue(stats['write_amplification'] >= whisper.pointSize)
+        self.assertEqual(stats['metrics'][self.db],
+                         stats['write_amplification'])
+        self.assertEqual([e[0] for e in events if e[0] != 'propagate'],
+                         ['create', 'update', 'update_many', 'fetch'])
+
+        # nothing more is collected once disabled
+        whisper.fetch(self.db, now - 30)
+        self.assertEqual(whisper.stats()['operations']['fetch']['calls'], 1)
+        self._removedb()
+
     def test_setAggregation(self):
         """Create a db, change aggregation, xFilesFactor, then use info() to validate"""
         retention = [(1, 60), (60, 60)]
@@ -25,7 +25,8 @@
 #		Archive = Point+
 #			Point = timestamp,value
 
-import os, struct, time, operator, itertools
+import os, errno, mmap, math, bisect, struct, time, operator, itertools, threading, weakref
+import __builtin__
 
 try:
   import fcntl
@@ -37,14 +38,36 @@ try:
   import ctypes
   import ctypes.util
   CAN_FALLOCATE = True
+  CAN_FADVISE = True
+  CAN_PREAD = True
+  CAN_COPY_FILE_RANGE = True
 except ImportError:
   CAN_FALLOCATE = False
+  CAN_FADVISE = False
+  CAN_PREAD = False
+  CAN_COPY_FILE_RANGE = False
+
+try:
+  import numpy
+  CAN_NUMPY = True
+except ImportError:
+  CAN_NUMPY = False
 
 fallocate = None
+fadvise = None
+pread = None
+pwrite = None
+copy_file_range = None
+POSIX_FADV_WILLNEED = 3
+# ioctl cloning a whole file into another (a reflink), Linux only
+FICLONE = 0x40049409
 
 if CAN_FALLOCATE: 
   libc_name = ctypes.util.find_library('c')
-  libc = ctypes.CDLL(libc_name)
+  try:
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+  except TypeError, e: #python 2.5 has no errno support in ctypes
+    libc = ctypes.CDLL(libc_name)
   c_off64_t = ctypes.c_int64
   c_off_t = ctypes.c_int
 
@@ -66,13 +89,126 @@ if CAN_FALLOCATE:
       if res != 0:
         raise IOError(res, 'fallocate')
     fallocate = _py_fallocate
+
+  try:
+    _fadvise = libc.posix_fadvise64
+    _fadvise.restype = ctypes.c_int
+    _fadvise.argtypes = [ctypes.c_int, c_off64_t, c_off64_t, ctypes.c_int]
+  except AttributeError, e:
+    try:
+      _fadvise = libc.posix_fadvise
+      _fadvise.restype = ctypes.c_int
+      _fadvise.argtypes = [ctypes.c_int, c_off_t, c_off_t, ctypes.c_int]
+    except AttributeError, e:
+      CAN_FADVISE = False
+
+  if CAN_FADVISE:
+    def _py_fadvise(fd, offset, len_, advice):
+      res = _fadvise(fd.fileno(), offset, len_, advice)
+      if res != 0:
+        raise IOError(res, 'fadvise')
+    fadvise = _py_fadvise
+
+  try:
+    _get_errno = ctypes.get_errno #missing before python 2.6
+    _pread = libc.pread64
+    _pread.restype = ctypes.c_ssize_t
+    _pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, c_off64_t]
+    _pwrite = libc.pwrite64
+    _pwrite.restype = ctypes.c_ssize_t
+    _pwrite.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, c_off64_t]
+  except AttributeError, e:
+    CAN_PREAD = False
+
+  if CAN_PREAD:
+    def _py_pread_into(fd, buf, position, offset, len_):
+      address = ctypes.addressof(buf) + position
+      done = 0
+      while done < len_:
+        res = _pread(fd.fileno(), address + done, len_ - done, offset + done)
+        if res < 0:
+          err = _get_errno()
+          if err == errno.EINTR:
+            continue
+          raise IOError(err, 'pread')
+        if res == 0: #end of file
+          break
+        done += res
+      return done
+
+    def _py_pread(fd, offset, len_):
+      buf = ctypes.create_string_buffer(len_)
+      read = _py_pread_into(fd, buf, 0, offset, len_)
+      return buf.raw[:read]
+
+    def _py_pwrite(fd, offset, data):
+      if isinstance(data, bytearray):
+        data = (ctypes.c_char * len(data)).from_buffer(data)
+      address = ctypes.cast(data, ctypes.c_void_p).value
+      done = 0
+      while done < len(data):
+        res = _pwrite(fd.fileno(), address + done, len(data) - done, offset + done)
+        if res < 0:
+          err = _get_errno()
+          if err == errno.EINTR:
+            continue
+          raise IOError(err, 'pwrite')
+        done += res
+    pread = _py_pread
+    pwrite = _py_pwrite
+
+  try:
+    _get_errno = ctypes.get_errno #missing before python 2.6
+    _copy_file_range = libc.copy_file_range
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(c_off64_t), ctypes.c_int,
+                                 ctypes.POINTER(c_off64_t), ctypes.c_size_t, ctypes.c_uint]
+  except AttributeError, e:
+    CAN_COPY_FILE_RANGE = False
+
+  if CAN_COPY_FILE_RANGE:
+    def _py_copy_file_range(src, srcOffset, dst, dstOffset, len_):
+      srcOffset = c_off64_t(srcOffset)
+      dstOffset = c_off64_t(dstOffset)
+      remaining = len_
+      while remaining > 0:
+        res = _copy_file_range(src.fileno(), ctypes.byref(srcOffset), dst.fileno(),
+                               ctypes.byref(dstOffset), remaining, 0)
+        if res < 0:
+          err = _get_errno()
+          if err == errno.EINTR:
+            continue
+          raise IOError(err, 'copy_file_range')
+        if res == 0: #end of the source file
+          break
+        remaining -= res
+      return len_ - remaining
+    copy_file_range = _py_copy_file_range
   del libc
   del libc_name
 
 LOCK = False
+# With LOCK on, readers take shared locks too, so a fetch never sees an update
+# that is half written, at the cost of waiting for the writers. On whole files
+# a steady stream of overlapping reads can hold writers off indefinitely, use
+# LOCK_RANGES with it on busy files
+LOCK_READS = False
+# With LOCK on, updates and reads lock only the archive regions they touch,
+# with fcntl record locks instead of flock on the whole file, so reading one
+# archive does not wait for a write to another. Record locks are held per
+# process: they do not keep the threads of a process apart, and closing any
+# handle on a file releases all the locks the process holds on it. Every
+# process sharing the files must use the same mode, flock and record locks
+# ignore each other
+LOCK_RANGES = False
 CACHE_HEADERS = False
 AUTOFLUSH = False
-__headerCache = {}
+
+# Limits for the header cache used when CACHE_HEADERS is on, 0 means unbounded
+HEADER_CACHE_MAX_ENTRIES = 100000
+HEADER_CACHE_MAX_BYTES = 0
+# Check cached headers against the file's device, inode and size on every use
+HEADER_CACHE_VALIDATE = True
 
 longFormat = "!L"
 longSize = struct.calcsize(longFormat)
@@ -81,21 +217,22 @@ floatSize = struct.calcsize(floatFormat)
 valueFormat = "!d"
 valueSize = struct.calcsize(valueFormat)
 pointFormat = "!Ld"
-pointSize = struct.calcsize(pointFormat)
+pointStruct = struct.Struct(pointFormat)
+pointSize = pointStruct.size
 metadataFormat = "!2LfL"
 metadataSize = struct.calcsize(metadataFormat)
 archiveInfoFormat = "!3L"
 archiveInfoSize = struct.calcsize(archiveInfoFormat)
+headerPageSize = 4096
+
+if CAN_NUMPY:
+  pointDtype = numpy.dtype([('interval', '>u4'), ('value', '>f8')])
 
-aggregationTypeToMethod = dict({
-  1: 'average',
-  2: 'sum',
-  3: 'last',
-  4: 'max',
-  5: 'min'
-})
-aggregationMethodToType = dict([[v,k] for k,v in aggregationTypeToMethod.items()])
-aggregationMethods = aggregationTypeToMethod.values()
+# Filled in by registerAggregationMethod() further down
+aggregationTypeToMethod = {}
+aggregationMethodToType = {}
+aggregationMethods = []
+aggregationFunctions = {}
 
 debug = startBlock = endBlock = lambda *a,**k: None
 
@@ -176,23 +313,508 @@ class CorruptWhisperFile(WhisperException):
   def __str__(self):
     return "%s (%s)" % (self.error, self.path)
 
+
+class ReadOnlyRecord(object):
+  """Base of the immutable header types. Fields are read as attributes, and
+also as items so a record reads like the dicts info() returns."""
+  __slots__ = ()
+  # The fields of the dict view, in the order they are passed to __init__
+  fields = ()
+  # Setters of the slots in __slots__ order, filled in by __recordSetters()
+  # once the class exists. Calling them directly is much cheaper than going
+  # through object.__setattr__ and headers are built on every uncached read
+  setters = ()
+
+  def __setattr__(self, name, value):
+    raise AttributeError("%s is read-only" % self.__class__.__name__)
+
+  __delattr__ = __setattr__
+
+  def __getitem__(self, key):
+    if key in self.fields:
+      return getattr(self, key)
+    raise KeyError(key)
+
+  def get(self, key, default=None):
+    if key in self.fields:
+      return getattr(self, key)
+    return default
+
+  def keys(self):
+    return list(self.fields)
+
+  def values(self):
+    return [getattr(self, name) for name in self.fields]
+
+  def items(self):
+    return [(name, getattr(self, name)) for name in self.fields]
+
+  def __iter__(self):
+    return iter(self.fields)
+
+  def __contains__(self, key):
+    return key in self.fields
+
+  def __len__(self):
+    return len(self.fields)
+
+  def __nonzero__(self): #cheaper than the default of calling __len__
+    return True
+
+  def __eq__(self, other):
+    if not isinstance(other, (ReadOnlyRecord, dict)):
+      return NotImplemented
+    if sorted(other.keys()) != sorted(self.fields):
+      return False
+    for name in self.fields:
+      (mine, theirs) = (getattr(self, name), other[name])
+      if isinstance(mine, tuple): #the dicts hold lists
+        mine = list(mine)
+      if isinstance(theirs, tuple):
+        theirs = list(theirs)
+      if mine != theirs:
+        return False
+    return True
+
+  def __ne__(self, other):
+    equal = self.__eq__(other)
+    if equal is NotImplemented:
+      return equal
+    return not equal
+
+  def __hash__(self):
+    return hash(tuple(self.values()))
+
+  def __reduce__(self):
+    return (self.__class__, tuple(self.values()))
+
+  def __repr__(self):
+    return "%s(%s)" % (self.__class__.__name__,
+                       ', '.join(['%s=%r' % item for item in self.items()]))
+
+
+class ArchiveInfo(ReadOnlyRecord):
+  """ArchiveInfo(offset,secondsPerPoint,points)
+
+One archive of a whisper file. retention and size (in bytes) are derived, as
+is end, the offset just past the archive, which is not part of the dict view.
+"""
+  __slots__ = ('offset', 'secondsPerPoint', 'points', 'retention', 'size', 'end')
+  fields = ('offset', 'secondsPerPoint', 'points', 'retention', 'size')
+
+  def __init__(self, offset, secondsPerPoint, points):
+    (setOffset, setSecondsPerPoint, setPoints, setRetention, setSize, setEnd) = self.setters
+    size = points * pointSize
+    setOffset(self, offset)
+    setSecondsPerPoint(self, secondsPerPoint)
+    setPoints(self, points)
+    setRetention(self, secondsPerPoint * points)
+    setSize(self, size)
+    setEnd(self, offset + size)
+
+  def __reduce__(self):
+    return (ArchiveInfo, (self.offset, self.secondsPerPoint, self.points))
+
+  def asDict(self):
+    return {
+      'offset' : self.offset,
+      'secondsPerPoint' : self.secondsPerPoint,
+      'points' : self.points,
+      'retention' : self.retention,
+      'size' : self.size,
+    }
+
+
+class Header(ReadOnlyRecord):
+  """Header(aggregationMethod,maxRetention,xFilesFactor,archives)
+
+The parsed header of a whisper file, archives being a tuple of ArchiveInfo
+ordered from the finest to the coarsest. size, the size of the whole file, is
+derived and not part of the dict view.
+"""
+  __slots__ = ('aggregationMethod', 'maxRetention', 'xFilesFactor', 'archives', 'size')
+  fields = ('aggregationMethod', 'maxRetention', 'xFilesFactor', 'archives')
+
+  def __init__(self, aggregationMethod, maxRetention, xFilesFactor, archives):
+    (setAggregationMethod, setMaxRetention, setXFilesFactor, setArchives, setSize) = self.setters
+    archives = tuple(archives)
+    size = metadataSize
+    for archive in archives:
+      if archive.end > size:
+        size = archive.end
+    setAggregationMethod(self, aggregationMethod)
+    setMaxRetention(self, maxRetention)
+    setXFilesFactor(self, xFilesFactor)
+    setArchives(self, archives)
+    setSize(self, size)
+
+  def asDict(self):
+    """Return the header as the plain, mutable dicts info() returns"""
+    return {
+      'aggregationMethod' : self.aggregationMethod,
+      'maxRetention' : self.maxRetention,
+      'xFilesFactor' : self.xFilesFactor,
+      'archives' : [archive.asDict() for archive in self.archives],
+    }
+
+
+def __recordSetters(cls):
+  cls.setters = tuple([cls.__dict__[name].__set__ for name in cls.__slots__])
+
+__recordSetters(ArchiveInfo)
+__recordSetters(Header)
+
+
+class HeaderCache(object):
+  """Least-recently-used cache of parsed headers, keyed by path.
+
+Each entry keeps the signature of the file it was read from so a header can be
+dropped when the file behind a path has been replaced, and the cache is held
+to a number of entries and an estimated number of bytes.
+"""
+  # Rough in-memory cost of a cached Header, with its cache entry, and of each
+  # of its ArchiveInfo
+  headerBytes = 320
+  archiveBytes = 224
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    self.lock.acquire()
+    try:
+      self.entries = {}
+      # Circular doubly linked list of [previous, next, key, header, signature, size]
+      # links, the most recently used entry sits just before the root
+      self.root = []
+      self.root[:] = [self.root, self.root, None, None, None, 0]
+      self.bytes = 0
+      self.hits = self.misses = self.evictions = self.invalidations = 0
+    finally:
+      self.lock.release()
+
+  def get(self, key, signature=None):
+    self.lock.acquire()
+    try:
+      link = self.entries.get(key)
+      if link is None:
+        self.misses += 1
+        return None
+      if signature is not None and link[4] != signature:
+        self.__remove(link)
+        self.invalidations += 1
+        self.misses += 1
+        return None
+
+      self.__unlink(link)
+      self.__append(link)
+      self.hits += 1
+      return link[3]
+    finally:
+      self.lock.release()
+
+  def put(self, key, header, signature=None, maxEntries=0, maxBytes=0):
+    size = self.headerBytes + self.archiveBytes * len(header.archives)
+    self.lock.acquire()
+    try:
+      link = self.entries.get(key)
+      if link is not None:
+        self.__remove(link)
+      link = [None, None, key, header, signature, size]
+      self.entries[key] = link
+      self.__append(link)
+      self.bytes += size
+
+      while self.entries and ((maxEntries and len(self.entries) > maxEntries) or
+                              (maxBytes and self.bytes > maxBytes)):
+        self.__remove(self.root[1])
+        self.evictions += 1
+    finally:
+      self.lock.release()
+
+  def invalidate(self, key):
+    self.lock.acquire()
+    try:
+      link = self.entries.get(key)
+      if link is not None:
+        self.__remove(link)
+        self.invalidations += 1
+    finally:
+      self.lock.release()
+
+  def stats(self):
+    self.lock.acquire()
+    try:
+      return {
+        'entries' : len(self.entries),
+        'bytes' : self.bytes,
+        'hits' : self.hits,
+        'misses' : self.misses,
+        'evictions' : self.evictions,
+        'invalidations' : self.invalidations,
+      }
+    finally:
+      self.lock.release()
+
+  def __append(self, link):
+    last = self.root[0]
+    link[0] = last
+    link[1] = self.root
+    last[1] = link
+    self.root[0] = link
+
+  def __unlink(self, link):
+    link[0][1] = link[1]
+    link[1][0] = link[0]
+
+  def __remove(self, link):
+    self.__unlink(link)
+    del self.entries[link[2]]
+    self.bytes -= link[5]
+
+
+__headerCache = HeaderCache()
+
+
+def headerCacheStats():
+  """headerCacheStats()
+
+Returns a dict with the number of entries and estimated bytes held by the
+header cache, along with its hit, miss, eviction and invalidation counters
+"""
+  return __headerCache.stats()
+
+
+def invalidateHeaderCache(path=None):
+  """invalidateHeaderCache(path=None)
+
+Drops the cached header of path, or every cached header if path is None.
+Functions that modify a header in place do this themselves.
+"""
+  if path is None:
+    __headerCache.clear()
+  else:
+    __headerCache.invalidate(path)
+
+class Instruments(object):
+  """Counters and latency histograms collected while instrumentation is on,
+see enableInstrumentation()"""
+  fields = ('calls', 'errors', 'points', 'opens', 'header_reads', 'reads',
+            'writes', 'syscalls', 'bytes_read', 'bytes_written')
+
+  def __init__(self, perMetric=False, callback=None):
+    self.perMetric = perMetric
+    self.callback = callback
+    self.since = time.time()
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.operations = {}
+    self.latencies = {}
+    self.metrics = {}
+    self.points = 0
+    self.pointBytes = 0
+
+  def frame(self, operation):
+    """Return the frame of a new operation on this thread, or None when
+operation is already running (update calling file_update for instance)"""
+    frames = getattr(self.local, 'frames', None)
+    if frames is None:
+      frames = self.local.frames = []
+    if frames and frames[-1][0] == operation:
+      return None
+    frame = [operation, dict.fromkeys(self.fields, 0), 0, time.time()]
+    frames.append(frame)
+    return frame
+
+  def count(self, name, value=1):
+    frames = getattr(self.local, 'frames', None)
+    if frames:
+      frames[-1][1][name] += value
+      if name == 'bytes_written':
+        frames[-1][2] += value
+    else: #outside of any instrumented operation
+      self.lock.acquire()
+      try:
+        counters = self.operations.setdefault('other', dict.fromkeys(self.fields, 0))
+        counters[name] += value
+      finally:
+        self.lock.release()
+
+  def io(self, kind, calls, size, syscalls):
+    """Count calls reads or writes (kind) of size bytes in total"""
+    self.count(kind + 's', calls)
+    self.count('syscalls', syscalls)
+    if kind == 'read':
+      self.count('bytes_read', size)
+    else:
+      self.count('bytes_written', size)
+
+  def finish(self, frame, path, points, error):
+    (operation, counters, written, started) = frame
+    seconds = time.time() - started
+    counters['calls'] = 1
+    counters['points'] = points
+    if error:
+      counters['errors'] = 1
+
+    frames = self.local.frames
+    frames.pop()
+    if frames: #bytes written by nested operations count towards the caller
+      frames[-1][2] += written
+    bucket = 1 << max(0, math.frexp(seconds * 1000000)[1])
+
+    self.lock.acquire()
+    try:
+      totals = self.operations.setdefault(operation, dict.fromkeys(self.fields, 0))
+      for (name, value) in counters.iteritems():
+        totals[name] += value
+      histogram = self.latencies.setdefault(operation, {'count' : 0, 'total' : 0.0, 'max' : 0.0, 'buckets' : {}})
+      histogram['count'] += 1
+      histogram['total'] += seconds
+      histogram['max'] = max(histogram['max'], seconds)
+      histogram['buckets'][bucket] = histogram['buckets'].get(bucket, 0) + 1
+      if points and not frames:
+        self.points += points
+        self.pointBytes += written
+        if self.perMetric:
+          metric = self.metrics.setdefault(path, [0, 0])
+          metric[0] += points
+          metric[1] += written
+    finally:
+      self.lock.release()
+
+    if self.callback:
+      self.callback(operation, path, seconds, counters)
+
+  def snapshot(self):
+    self.lock.acquire()
+    try:
+      operations = {}
+      for (operation, totals) in self.operations.iteritems():
+        operations[operation] = dict(totals)
+        if operation in self.latencies:
+          histogram = dict(self.latencies[operation])
+          histogram['buckets'] = dict(histogram['buckets'])
+          operations[operation]['latency'] = histogram
+      snapshot = {
+        'since' : self.since,
+        'operations' : operations,
+        'write_amplification' : None,
+      }
+      if self.points:
+        snapshot['write_amplification'] = float(self.pointBytes) / self.points
+      if self.perMetric:
+        snapshot['metrics'] = dict([(path, float(written) / points)
+                                    for (path, (points, written)) in self.metrics.iteritems()])
+      return snapshot
+    finally:
+      self.lock.release()
+
+
+__instruments = None
+__collected = None
+
+
+def enableInstrumentation(perMetric=False, callback=None):
+  """enableInstrumentation(perMetric=False, callback=None)
+
+Starts collecting counters and latencies for every whisper operation,
+discarding anything collected before. See stats() for what is collected.
+
+perMetric also keeps the write amplification of every file updated, which
+costs memory for each distinct path.
+callback, if given, is called as callback(operation,path,seconds,counters)
+at the end of every operation on the thread that ran it, with the counters
+of that call alone.
+"""
+  global __instruments, __collected, open
+  __instruments = __collected = Instruments(perMetric, callback)
+  open = __countedOpen
+
+
+def disableInstrumentation():
+  """disableInstrumentation()
+
+Stops collecting, what was collected so far stays available from stats()
+"""
+  global __instruments, open
+  __instruments = None
+  open = __builtin__.open
+
+
+def stats():
+  """stats()
+
+Returns a snapshot of what was collected since instrumentation was last
+enabled, or None if it never was. The snapshot is a dict with:
+
+operations: counters for each operation (create, info, update, update_many,
+fetch, propagate, merge, diff), each a dict of calls, errors, points, opens,
+header_reads, reads, writes, syscalls (reads, writes and seeks that reached
+the kernel, a WhisperFile's mapped I/O has none), bytes_read, bytes_written
+and latency, a histogram with the count, total and max seconds plus buckets
+mapping an upper bound in microseconds (a power of 2) to a number of calls.
+I/O is counted against the innermost operation, so update and update_many
+exclude what their propagation to lower archives reads and writes. I/O
+outside any of these operations is counted under 'other'.
+write_amplification: bytes written per point updated, propagation included.
+metrics: write amplification of each path, when enabled with perMetric.
+header_cache: the headerCacheStats() counters.
+"""
+  if __collected is None:
+    return None
+  snapshot = __collected.snapshot()
+  snapshot['header_cache'] = __headerCache.stats()
+  return snapshot
+
+
+def __countedOpen(*args, **kwargs):
+  fh = __builtin__.open(*args, **kwargs)
+  if __instruments:
+    __instruments.count('opens')
+  return fh
+
+
+def __instrumented(operation, points=None):
+  """Decorate a function as an instrumented operation. The first argument of
+the function is its path or file object, points(args) counts the points it
+updates"""
+  def decorate(function):
+    def instrumented(*args, **kwargs):
+      instruments = __instruments
+      if not instruments:
+        return function(*args, **kwargs)
+      frame = instruments.frame(operation)
+      if frame is None:
+        return function(*args, **kwargs)
+
+      error = True
+      try:
+        result = function(*args, **kwargs)
+        error = False
+        return result
+      finally:
+        path = None
+        if args:
+          path = getattr(args[0], 'name', args[0])
+        pointCount = 0
+        if points and not error:
+          pointCount = points(args)
+        instruments.finish(frame, path, pointCount, error)
+    instrumented.__name__ = function.__name__
+    instrumented.__doc__ = function.__doc__
+    return instrumented
+  return decorate
+
+
 def enableDebug():
-  global open, debug, startBlock, endBlock
-  class open(file):
-    def __init__(self,*args,**kwargs):
-      file.__init__(self,*args,**kwargs)
-      self.writeCount = 0
-      self.readCount = 0
-
-    def write(self,data):
-      self.writeCount += 1
-      debug('WRITE %d bytes #%d' % (len(data),self.writeCount))
-      return file.write(self,data)
-
-    def read(self,bytes):
-      self.readCount += 1
-      debug('READ %d bytes #%d' % (bytes,self.readCount))
-      return file.read(self,bytes)
+  """enableDebug()
+
+Prints every whisper operation with its duration and I/O as it finishes.
+Built on enableInstrumentation(), so stats() is available as well.
+"""
+  global debug, startBlock, endBlock
 
   def debug(message):
     print 'DEBUG :: %s' % message
@@ -205,52 +827,194 @@ def enableDebug():
   def endBlock(name):
     debug("%s took %.5f seconds" % (name,time.time() - __timingBlocks.pop(name)))
 
+  def debugOperation(operation, path, seconds, counters):
+    debug("%s %s took %.5f seconds, %d reads (%d bytes), %d writes (%d bytes)" % (
+      operation, path, seconds, counters['reads'], counters['bytes_read'],
+      counters['writes'], counters['bytes_written']))
+
+  enableInstrumentation(callback=debugOperation)
+
+
+def __pread(fh, offset, size):
+  """Read size bytes at offset without touching the file position"""
+  if isinstance(fh, WhisperFile):
+    data = fh.map[offset:offset + size]
+    syscalls = 0
+  elif CAN_PREAD:
+    data = pread(fh, offset, size)
+    syscalls = 1
+  else:
+    fh.seek(offset)
+    data = fh.read(size)
+    syscalls = 2
+  if __instruments:
+    __instruments.io('read', 1, len(data), syscalls)
+  return data
+
+
+def __preadRanges(fh, ranges):
+  """Read a list of (offset,size) ranges and return them concatenated. With
+pread available the ranges land in one preallocated buffer, so a read that
+wraps around an archive costs two syscalls and no intermediate strings"""
+  if __instruments:
+    syscalls = len(ranges)
+    if isinstance(fh, WhisperFile):
+      syscalls = 0
+    elif not CAN_PREAD:
+      syscalls *= 2
+    __instruments.io('read', len(ranges), sum([size for (offset,size) in ranges]), syscalls)
+
+  if isinstance(fh, WhisperFile):
+    return ''.join([fh.map[offset:offset + size] for (offset,size) in ranges])
+  if not CAN_PREAD:
+    chunks = []
+    for (offset,size) in ranges:
+      fh.seek(offset)
+      chunks.append(fh.read(size))
+    return ''.join(chunks)
+
+  buf = ctypes.create_string_buffer(sum([size for (offset,size) in ranges]))
+  position = 0
+  for (offset,size) in ranges:
+    read = _py_pread_into(fh, buf, position, offset, size)
+    position += read
+    if read < size: #end of file
+      break
+  return buf.raw[:position]
+
+
+def __pwrite(fh, offset, data):
+  """Write data at offset without touching the file position"""
+  if isinstance(fh, WhisperFile):
+    fh.map[offset:offset + len(data)] = str(data)
+    syscalls = 0
+  elif CAN_PREAD:
+    pwrite(fh, offset, data)
+    syscalls = 1
+  else:
+    fh.seek(offset)
+    fh.write(data)
+    syscalls = 2
+  if __instruments:
+    __instruments.io('write', 1, len(data), syscalls)
+
+
+# Handles holding a write lock. Taking a shared lock to read through one of them
+# would downgrade that lock, and releasing it would drop it altogether
+_writeLocked = weakref.WeakKeyDictionary()
+
+
+def __lockFile(fh):
+  """Lock all of fh for writing when LOCK is on"""
+  if not LOCK:
+    return
+  if LOCK_RANGES:
+    fcntl.lockf(fh.fileno(), fcntl.LOCK_EX)
+  else:
+    fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+  _writeLocked[fh] = True
+
+
+def __lockUpdate(fh):
+  """Lock all of fh for an update when locking whole files, __lockArchive locks
+the regions written when locking ranges"""
+  if LOCK and not LOCK_RANGES:
+    fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+    _writeLocked[fh] = True
+
+
+def __lockArchive(fh, archive):
+  """Lock the region of archive for writing when locking ranges, updates lock
+the whole file up front otherwise. Updates write the archives from the finest
+to the coarsest, so locking them as they go cannot deadlock"""
+  if LOCK and LOCK_RANGES:
+    fcntl.lockf(fh.fileno(), fcntl.LOCK_EX, archive.size, archive.offset)
+    _writeLocked[fh] = True
+
+
+def __lockRead(fh, archive):
+  """Take a shared lock for reading archive when LOCK_READS is on, unless fh
+already holds a write lock. Returns True if a lock was taken, to be released
+with __unlockRead"""
+  if not (LOCK and LOCK_READS) or fh in _writeLocked:
+    return False
+  if LOCK_RANGES:
+    fcntl.lockf(fh.fileno(), fcntl.LOCK_SH, archive.size, archive.offset)
+  else:
+    fcntl.flock(fh.fileno(), fcntl.LOCK_SH)
+  return True
+
+
+def __unlockRead(fh, archive):
+  if LOCK_RANGES:
+    fcntl.lockf(fh.fileno(), fcntl.LOCK_UN, archive.size, archive.offset)
+  else:
+    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
 
 def __readHeader(fh):
-  info = __headerCache.get(fh.name)
-  if info:
-    return info
+  if isinstance(fh, WhisperFile) and fh.header is not None:
+    return fh.header
 
-  originalOffset = fh.tell()
-  fh.seek(0)
-  packedMetadata = fh.read(metadataSize)
+  if CACHE_HEADERS:
+    signature = None
+    if HEADER_CACHE_VALIDATE:
+      signature = __fileSignature(fh)
+    info = __headerCache.get(fh.name, signature)
+    if info:
+      return info
+
+  if __instruments:
+    __instruments.count('header_reads')
+
+  #A single read of the first page covers the header of any sensible file
+  packedHeader = __pread(fh, 0, headerPageSize)
 
   try:
-    (aggregationType,maxRetention,xff,archiveCount) = struct.unpack(metadataFormat,packedMetadata)
+    (aggregationType,maxRetention,xff,archiveCount) = struct.unpack(metadataFormat,packedHeader[:metadataSize])
   except:
     raise CorruptWhisperFile("Unable to read header", fh.name)
 
   archives = []
 
   for i in xrange(archiveCount):
-    packedArchiveInfo = fh.read(archiveInfoSize)
+    infoOffset = metadataSize + (i * archiveInfoSize)
+    if infoOffset + archiveInfoSize <= len(packedHeader):
+      packedArchiveInfo = packedHeader[infoOffset:infoOffset + archiveInfoSize]
+    else: #The header runs past the first page
+      packedArchiveInfo = __pread(fh, infoOffset, archiveInfoSize)
     try:
       (offset,secondsPerPoint,points) = struct.unpack(archiveInfoFormat,packedArchiveInfo)
     except:
       raise CorruptWhisperFile("Unable to read archive%d metadata" % i, fh.name)
 
-    archiveInfo = {
-      'offset' : offset,
-      'secondsPerPoint' : secondsPerPoint,
-      'points' : points,
-      'retention' : secondsPerPoint * points,
-      'size' : points * pointSize,
-    }
-    archives.append(archiveInfo)
-
-  fh.seek(originalOffset)
-  info = {
-    'aggregationMethod' : aggregationTypeToMethod.get(aggregationType, 'average'),
-    'maxRetention' : maxRetention,
-    'xFilesFactor' : xff,
-    'archives' : archives,
-  }
+    archives.append(ArchiveInfo(offset, secondsPerPoint, points))
+
+  info = Header(aggregationTypeToMethod.get(aggregationType, 'average'), maxRetention, xff, archives)
   if CACHE_HEADERS:
-    __headerCache[fh.name] = info
+    __headerCache.put(fh.name, info, signature, HEADER_CACHE_MAX_ENTRIES, HEADER_CACHE_MAX_BYTES)
+  if isinstance(fh, WhisperFile):
+    fh.header = info
 
   return info
 
 
+def __fileSignature(fh):
+  # The modification time is left out on purpose as every data write changes
+  # it, headers modified in place are invalidated explicitly instead
+  st = os.fstat(fh.fileno())
+  return (st.st_dev, st.st_ino, st.st_size)
+
+
+def __readBaseInterval(fh, archive):
+  if isinstance(fh, WhisperFile):
+    return fh.baseInterval(archive)
+
+  packedPoint = __pread(fh, archive.offset, pointSize)
+  (baseInterval,baseValue) = pointStruct.unpack(packedPoint)
+  return baseInterval
+
+
 def setAggregationMethod(path, aggregationMethod, xFilesFactor=None):
   """setAggregationMethod(path,aggregationMethod,xFilesFactor=None)
 
@@ -262,8 +1026,7 @@ xFilesFactor specifies the fraction of data points in a propagation interval tha
   try:
 
     fh = open(path,'r+b')
-    if LOCK:
-      fcntl.flock( fh.fileno(), fcntl.LOCK_EX )
+    __lockFile(fh)
 
     packedMetadata = fh.read(metadataSize)
 
@@ -298,8 +1061,7 @@ xFilesFactor specifies the fraction of data points in a propagation interval tha
       fh.flush()
       os.fsync(fh.fileno())
 
-      if CACHE_HEADERS and fh.name in __headerCache:
-        del __headerCache[fh.name]
+    __headerCache.invalidate(fh.name)
 
   finally:
     if fh:
@@ -359,6 +1121,7 @@ def validateArchiveList(archiveList):
         (i + 1, pointsPerConsolidation, i, archivePoints))
 
 
+@__instrumented('create')
 def create(path,archiveList,xFilesFactor=None,aggregationMethod=None,sparse=False,useFallocate=False):
   """create(path,archiveList,xFilesFactor=0.5,aggregationMethod='average')
 
@@ -379,43 +1142,24 @@ aggregationMethod specifies the function to use when propogating data (see ``whi
   #Looks good, now we create the file and write the header
   if os.path.exists(path):
     raise InvalidConfiguration("File %s already exists!" % path)
+  __headerCache.invalidate(path)
   fh = None
   try:
     fh = open(path,'wb')
-    if LOCK:
-      fcntl.flock( fh.fileno(), fcntl.LOCK_EX )
-
-    aggregationType = struct.pack( longFormat, aggregationMethodToType.get(aggregationMethod, 1) )
-    oldest = max([secondsPerPoint * points for secondsPerPoint,points in archiveList])
-    maxRetention = struct.pack( longFormat, oldest )
-    xFilesFactor = struct.pack( floatFormat, float(xFilesFactor) )
-    archiveCount = struct.pack(longFormat, len(archiveList))
-    packedMetadata = aggregationType + maxRetention + xFilesFactor + archiveCount
-    fh.write(packedMetadata)
-    headerSize = metadataSize + (archiveInfoSize * len(archiveList))
-    archiveOffsetPointer = headerSize
+    __lockFile(fh)
 
-    for secondsPerPoint,points in archiveList:
-      archiveInfo = struct.pack(archiveInfoFormat, archiveOffsetPointer, secondsPerPoint, points)
-      fh.write(archiveInfo)
-      archiveOffsetPointer += (points * pointSize)
+    (packedHeader, fileSize) = __packHeader(archiveList, xFilesFactor, aggregationMethod)
+    fh.write(packedHeader)
 
     #If configured to use fallocate and capable of fallocate use that, else
     #attempt sparse if configure or zero pre-allocate if sparse isn't configured.
     if CAN_FALLOCATE and useFallocate:
-      remaining = archiveOffsetPointer - headerSize
-      fallocate(fh, headerSize, remaining)
+      layout = 'fallocate'
     elif sparse:
-      fh.seek(archiveOffsetPointer - 1)
-      fh.write('\x00')
+      layout = 'sparse'
     else:
-      remaining = archiveOffsetPointer - headerSize
-      chunksize = 16384
-      zeroes = '\x00' * chunksize
-      while remaining > chunksize:
-        fh.write(zeroes)
-        remaining -= chunksize
-      fh.write(zeroes[:remaining])
+      layout = 'zero'
+    __allocate(fh, len(packedHeader), fileSize - len(packedHeader), layout)
 
     if AUTOFLUSH:
       fh.flush()
@@ -424,55 +1168,358 @@ aggregationMethod specifies the function to use when propogating data (see ``whi
     if fh:
       fh.close()
 
-def aggregate(aggregationMethod, knownValues):
-  if aggregationMethod == 'average':
-    return float(sum(knownValues)) / float(len(knownValues))
-  elif aggregationMethod == 'sum':
-    return float(sum(knownValues))
-  elif aggregationMethod == 'last':
-    return knownValues[len(knownValues)-1]
-  elif aggregationMethod == 'max':
-    return max(knownValues)
-  elif aggregationMethod == 'min':
-    return min(knownValues)
+
+def __packHeader(archiveList, xFilesFactor, aggregationMethod):
+  """Return the packed header of a file holding archiveList, which must already
+be validated, and the size of the whole file"""
+  aggregationType = aggregationMethodToType.get(aggregationMethod, 1)
+  oldest = max([secondsPerPoint * points for secondsPerPoint,points in archiveList])
+  headerSize = metadataSize + (archiveInfoSize * len(archiveList))
+
+  packed = [struct.pack(metadataFormat, aggregationType, oldest, float(xFilesFactor), len(archiveList))]
+  archiveOffsetPointer = headerSize
+  for secondsPerPoint,points in archiveList:
+    packed.append(struct.pack(archiveInfoFormat, archiveOffsetPointer, secondsPerPoint, points))
+    archiveOffsetPointer += (points * pointSize)
+
+  return (''.join(packed), archiveOffsetPointer)
+
+
+def __allocate(fh, offset, size, layout):
+  """Lay out size bytes of empty archives at offset, where fh is positioned.
+layout is one of 'fallocate', 'sparse' or 'zero'"""
+  if layout == 'fallocate':
+    fallocate(fh, offset, size)
+  elif layout == 'sparse':
+    fh.seek(offset + size - 1)
+    fh.write('\x00')
+  else:
+    remaining = size
+    chunksize = 16384
+    zeroes = '\x00' * chunksize
+    while remaining > chunksize:
+      fh.write(zeroes)
+      remaining -= chunksize
+    fh.write(zeroes[:remaining])
+
+
+def create_many(paths,archiveList,xFilesFactor=None,aggregationMethod=None,method='auto',workers=4,pool=None):
+  """create_many(paths,archiveList,xFilesFactor=None,aggregationMethod=None,method='auto',workers=4,pool=None)
+
+Creates a whisper file at each of paths, all with the same configuration, in
+parallel. The header is packed once and every file is laid out the same way.
+
+paths is a list of strings, their directories must exist
+archiveList, xFilesFactor and aggregationMethod are as for create()
+method is how each file's content is produced:
+  'clone'      reflink a template file (FICLONE), sharing its blocks until
+               they are written; needs a filesystem such as btrfs or XFS
+  'copy'       copy a template file within the kernel with copy_file_range
+  'fallocate'  write the header and posix_fallocate the rest
+  'sparse'     write the header and leave the rest as a hole
+  'zero'       write the header and zero-fill the rest, like create()
+  'auto'       clone where possible, otherwise fallocate where available,
+               otherwise copy, otherwise zero-fill
+workers is the number of threads used, unless pool (a multiprocessing.pool.ThreadPool) is given
+
+Template files are created next to the first new file on each filesystem and
+removed before returning. Returns a dict mapping each path to None, or to
+the exception raised creating it.
+"""
+  if xFilesFactor is None:
+    xFilesFactor = 0.5
+  if aggregationMethod is None:
+    aggregationMethod = 'average'
+  archiveList = list(archiveList)
+  validateArchiveList(archiveList)
+  (packedHeader, fileSize) = __packHeader(archiveList, xFilesFactor, aggregationMethod)
+
+  if method == 'auto':
+    # Without a reflink copy_file_range copies every byte, which is no faster
+    # than zero-filling and slower than fallocate
+    if CAN_FALLOCATE:
+      templateMethods = ['clone']
+      fallback = 'fallocate'
+    else:
+      templateMethods = ['clone', 'copy']
+      fallback = 'zero'
+  elif method in ('clone', 'copy'):
+    templateMethods = [method]
+    fallback = None
+  elif method in ('fallocate', 'sparse', 'zero'):
+    templateMethods = []
+    fallback = method
+  else:
+    raise ValueError("Unknown creation method %s" % method)
+  if 'copy' in templateMethods and not CAN_COPY_FILE_RANGE:
+    templateMethods.remove('copy')
+  if 'clone' in templateMethods and not CAN_LOCK:
+    templateMethods.remove('clone')
+  if (not templateMethods and not fallback) or (fallback == 'fallocate' and not CAN_FALLOCATE):
+    raise ValueError("Creation method %s is not available" % method)
+
+  # One template per filesystem, mapping its device to [path, file object,
+  # template methods it supports]
+  templates = {}
+  templatesLock = threading.Lock()
+
+  def template(path):
+    directory = os.path.dirname(path) or '.'
+    device = os.stat(directory).st_dev
+    templatesLock.acquire()
+    try:
+      if device not in templates:
+        import tempfile
+        (fd, templatePath) = tempfile.mkstemp(prefix='.whisper-template-', suffix='.wsp', dir=directory)
+        fh = os.fdopen(fd, 'r+b')
+        try:
+          fh.write(packedHeader)
+          if CAN_FALLOCATE:
+            __allocate(fh, len(packedHeader), fileSize - len(packedHeader), 'fallocate')
+          else:
+            __allocate(fh, len(packedHeader), fileSize - len(packedHeader), 'zero')
+          fh.flush()
+        except:
+          fh.close()
+          os.unlink(templatePath)
+          raise
+        templates[device] = [templatePath, fh, list(templateMethods)]
+      return templates[device]
+    finally:
+      templatesLock.release()
+
+  def fromTemplate(fh, path):
+    """Fill fh from the template on path's filesystem, returns False if
+that cannot be done there"""
+    (templatePath, templateFile, methods) = template(path)
+    for templateMethod in list(methods):
+      try:
+        if templateMethod == 'clone':
+          fcntl.ioctl(fh.fileno(), FICLONE, templateFile.fileno())
+          return True
+        if copy_file_range(templateFile, 0, fh, 0, fileSize) == fileSize:
+          return True
+        raise IOError(errno.EIO, "Short copy from template %s" % templatePath)
+      except (IOError, OSError), e:
+        if method != 'auto' or e.errno not in __unsupportedErrors:
+          raise
+        templatesLock.acquire()
+        try:
+          if templateMethod in methods:
+            methods.remove(templateMethod)
+        finally:
+          templatesLock.release()
+    return False
+
+  def createFile(path):
+    created = False
+    try:
+      if os.path.exists(path):
+        raise InvalidConfiguration("File %s already exists!" % path)
+      __headerCache.invalidate(path)
+      fh = open(path, 'wb')
+      created = True
+      try:
+        __lockFile(fh)
+        if not (templateMethods and fromTemplate(fh, path)):
+          if fallback is None:
+            raise IOError(errno.EOPNOTSUPP, "Creation method %s is not supported for %s" % (method, path))
+          fh.truncate(0)
+          fh.write(packedHeader)
+          __allocate(fh, len(packedHeader), fileSize - len(packedHeader), fallback)
+        if AUTOFLUSH:
+          fh.flush()
+          os.fsync(fh.fileno())
+      finally:
+        fh.close()
+    except Exception, e:
+      if created: #don't leave a truncated file behind
+        try:
+          os.unlink(path)
+        except OSError:
+          pass
+      return (path, e)
+    return (path, None)
+
+  ownPool = pool is None and workers > 1
+  if ownPool:
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+  try:
+    if pool is None:
+      return dict(map(createFile, paths))
+    return dict(pool.map(createFile, paths))
+  finally:
+    if ownPool:
+      pool.close()
+      pool.join()
+    for (templatePath, templateFile, methods) in templates.values():
+      templateFile.close()
+      os.unlink(templatePath)
+
+
+# errno values meaning a filesystem or kernel cannot clone or copy a file range
+__unsupportedErrors = set([errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS])
+
+
+def registerAggregationMethod(aggregationMethod, aggregationType, function, arrayFunction=None):
+  """registerAggregationMethod(aggregationMethod,aggregationType,function,arrayFunction=None)
+
+aggregationMethod is the name of the method
+aggregationType is the number stored in the header of the files using it
+function(knownValues, neighborValues) aggregates the values of one interval,
+knownValues being the values that are set and neighborValues all of them, with
+None for the missing ones, or None when the caller only has the known values
+arrayFunction(values, known), if given, aggregates each row of the 2d numpy
+array values only considering the entries set in the boolean array known, and
+is what batch propagation and consolidation use. Without it they call function
+row by row
+
+Registering a method again replaces its functions
+"""
+  aggregationType = int(aggregationType)
+  if not 0 < aggregationType < 2 ** 32:
+    raise InvalidAggregationMethod("Aggregation type %d does not fit in a header" % aggregationType)
+  owner = aggregationTypeToMethod.get(aggregationType)
+  if owner is not None and owner != aggregationMethod:
+    raise InvalidAggregationMethod("Aggregation type %d is already used by %s" %
+          (aggregationType, owner))
+
+  if aggregationMethod in aggregationMethodToType:
+    del aggregationTypeToMethod[aggregationMethodToType[aggregationMethod]]
   else:
+    aggregationMethods.append(aggregationMethod)
+  aggregationTypeToMethod[aggregationType] = aggregationMethod
+  aggregationMethodToType[aggregationMethod] = aggregationType
+  aggregationFunctions[aggregationMethod] = (function, arrayFunction)
+
+
+def aggregate(aggregationMethod, knownValues, neighborValues=None):
+  """aggregate(aggregationMethod,knownValues,neighborValues=None)
+
+Aggregates the known values of an interval with aggregationMethod. Methods
+that count missing values, like avg_zero, need neighborValues too: every value
+of the interval with None for the missing ones. avg_zero raises ValueError
+without them
+"""
+  try:
+    function = aggregationFunctions[aggregationMethod][0]
+  except KeyError:
     raise InvalidAggregationMethod("Unrecognized aggregation method %s" %
             aggregationMethod)
+  return function(knownValues, neighborValues)
 
 
+def __aggregate_array(aggregationMethod, values, known, slots=None):
+  """Aggregate each row of the 2d array values, only considering the entries
+that are set in the boolean array known. slots, if given, marks the entries
+that are slots of the interval at all, the others being padding: rows with
+padding are aggregated over their slots by the scalar function, so methods
+counting missing values see as many as the interval has"""
+  try:
+    (function, arrayFunction) = aggregationFunctions[aggregationMethod]
+  except KeyError:
+    raise InvalidAggregationMethod("Unrecognized aggregation method %s" %
+            aggregationMethod)
+  if arrayFunction is not None:
+    result = arrayFunction(values, known)
+    if slots is None:
+      return result
+    rows = numpy.flatnonzero(~slots.all(axis=1))
+  else:
+    result = numpy.empty(len(values))
+    rows = xrange(len(values))
+
+  for i in rows:
+    neighborValues = values[i].tolist()
+    for j in numpy.flatnonzero(~known[i]):
+      neighborValues[j] = None
+    if slots is not None:
+      neighborValues = [v for (v, slot) in zip(neighborValues, slots[i]) if slot]
+    knownValues = [v for v in neighborValues if v is not None]
+    if knownValues:
+      result[i] = function(knownValues, neighborValues)
+    else:
+      result[i] = numpy.nan
+  return result
+
+
+def __median(knownValues, neighborValues):
+  ordered = sorted(knownValues)
+  middle = len(ordered) / 2
+  if len(ordered) % 2:
+    return ordered[middle]
+  return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+def __average_array(values, known):
+  return numpy.where(known, values, 0.0).sum(axis=1) / numpy.maximum(known.sum(axis=1), 1)
+
+def __last_array(values, known):
+  lastIndex = values.shape[1] - 1 - known[:, ::-1].argmax(axis=1)
+  return values[numpy.arange(len(values)), lastIndex]
+
+def __absmax_array(values, known):
+  index = numpy.where(known, numpy.abs(values), -1.0).argmax(axis=1)
+  return values[numpy.arange(len(values)), index]
+
+def __absmin_array(values, known):
+  index = numpy.where(known, numpy.abs(values), numpy.inf).argmin(axis=1)
+  return values[numpy.arange(len(values)), index]
+
+def __median_array(values, known):
+  #Missing values become NaN, which sorts after everything else
+  ordered = numpy.sort(numpy.where(known, values, numpy.nan), axis=1)
+  counts = known.sum(axis=1)
+  rows = numpy.arange(len(values))
+  return (ordered[rows, numpy.maximum(counts - 1, 0) / 2] + ordered[rows, counts / 2]) / 2.0
+
+registerAggregationMethod('average', 1,
+  lambda knownValues, neighborValues: float(sum(knownValues)) / float(len(knownValues)),
+  __average_array)
+registerAggregationMethod('sum', 2,
+  lambda knownValues, neighborValues: float(sum(knownValues)),
+  lambda values, known: numpy.where(known, values, 0.0).sum(axis=1))
+registerAggregationMethod('last', 3,
+  lambda knownValues, neighborValues: knownValues[len(knownValues)-1],
+  __last_array)
+registerAggregationMethod('max', 4,
+  lambda knownValues, neighborValues: max(knownValues),
+  lambda values, known: numpy.where(known, values, -numpy.inf).max(axis=1))
+registerAggregationMethod('min', 5,
+  lambda knownValues, neighborValues: min(knownValues),
+  lambda values, known: numpy.where(known, values, numpy.inf).min(axis=1))
+def __avg_zero(knownValues, neighborValues):
+  if neighborValues is None:
+    raise ValueError("avg_zero needs neighborValues, every value of the interval")
+  return float(sum(knownValues)) / float(len(neighborValues))
+
+# Averages over every point of the interval, the missing ones counting as 0
+registerAggregationMethod('avg_zero', 6, __avg_zero,
+  lambda values, known: numpy.where(known, values, 0.0).sum(axis=1) / float(values.shape[1]))
+# The value furthest from (closest to) zero, keeping its sign
+registerAggregationMethod('absmax', 7,
+  lambda knownValues, neighborValues: max(knownValues, key=abs),
+  __absmax_array)
+registerAggregationMethod('absmin', 8,
+  lambda knownValues, neighborValues: min(knownValues, key=abs),
+  __absmin_array)
+registerAggregationMethod('count', 9,
+  lambda knownValues, neighborValues: float(len(knownValues)),
+  lambda values, known: known.sum(axis=1).astype(numpy.float64))
+registerAggregationMethod('median', 10, __median, __median_array)
+
+
+@__instrumented('propagate')
 def __propagate(fh,header,timestamp,higher,lower):
-  aggregationMethod = header['aggregationMethod']
-  xff = header['xFilesFactor']
+  aggregationMethod = header.aggregationMethod
+  xff = header.xFilesFactor
 
-  lowerIntervalStart = timestamp - (timestamp % lower['secondsPerPoint'])
-  lowerIntervalEnd = lowerIntervalStart + lower['secondsPerPoint']
+  lowerIntervalStart = timestamp - (timestamp % lower.secondsPerPoint)
+  lowerIntervalEnd = lowerIntervalStart + lower.secondsPerPoint
 
-  fh.seek(higher['offset'])
-  packedPoint = fh.read(pointSize)
-  (higherBaseInterval,higherBaseValue) = struct.unpack(pointFormat,packedPoint)
-
-  if higherBaseInterval == 0:
-    higherFirstOffset = higher['offset']
-  else:
-    timeDistance = lowerIntervalStart - higherBaseInterval
-    pointDistance = timeDistance / higher['secondsPerPoint']
-    byteDistance = pointDistance * pointSize
-    higherFirstOffset = higher['offset'] + (byteDistance % higher['size'])
-
-  higherPoints = lower['secondsPerPoint'] / higher['secondsPerPoint']
-  higherSize = higherPoints * pointSize
-  relativeFirstOffset = higherFirstOffset - higher['offset']
-  relativeLastOffset = (relativeFirstOffset + higherSize) % higher['size']
-  higherLastOffset = relativeLastOffset + higher['offset']
-  fh.seek(higherFirstOffset)
-
-  if higherFirstOffset < higherLastOffset: #we don't wrap the archive
-    seriesString = fh.read(higherLastOffset - higherFirstOffset)
-  else: #We do wrap the archive
-    higherEnd = higher['offset'] + higher['size']
-    seriesString = fh.read(higherEnd - higherFirstOffset)
-    fh.seek(higher['offset'])
-    seriesString += fh.read(higherLastOffset - higher['offset'])
+  higherBaseInterval = __readBaseInterval(fh, higher)
+  higherPoints = lower.secondsPerPoint / higher.secondsPerPoint
+  seriesString = __archive_read(fh, higher, higherBaseInterval, lowerIntervalStart, higherPoints)
 
   #Now we unpack the series data we just read
   byteOrder,pointTypes = pointFormat[0],pointFormat[1:]
@@ -483,7 +1530,7 @@ def __propagate(fh,header,timestamp,higher,lower):
   #And finally we construct a list of values
   neighborValues = [None] * points
   currentInterval = lowerIntervalStart
-  step = higher['secondsPerPoint']
+  step = higher.secondsPerPoint
 
   for i in xrange(0,len(unpackedSeries),2):
     pointTime = unpackedSeries[i]
@@ -498,22 +1545,19 @@ def __propagate(fh,header,timestamp,higher,lower):
 
   knownPercent = float(len(knownValues)) / float(len(neighborValues))
   if knownPercent >= xff: #we have enough data to propagate a value!
-    aggregateValue = aggregate(aggregationMethod, knownValues)
-    myPackedPoint = struct.pack(pointFormat,lowerIntervalStart,aggregateValue)
-    fh.seek(lower['offset'])
-    packedPoint = fh.read(pointSize)
-    (lowerBaseInterval,lowerBaseValue) = struct.unpack(pointFormat,packedPoint)
+    aggregateValue = aggregate(aggregationMethod, knownValues, neighborValues)
+    myPackedPoint = pointStruct.pack(lowerIntervalStart,aggregateValue)
+    __lockArchive(fh, lower)
+    lowerBaseInterval = __readBaseInterval(fh, lower)
 
     if lowerBaseInterval == 0: #First propagated update to this lower archive
-      fh.seek(lower['offset'])
-      fh.write(myPackedPoint)
+      __pwrite(fh, lower.offset, myPackedPoint)
     else: #Not our first propagated update to this lower archive
       timeDistance = lowerIntervalStart - lowerBaseInterval
-      pointDistance = timeDistance / lower['secondsPerPoint']
+      pointDistance = timeDistance / lower.secondsPerPoint
       byteDistance = pointDistance * pointSize
-      lowerOffset = lower['offset'] + (byteDistance % lower['size'])
-      fh.seek(lowerOffset)
-      fh.write(myPackedPoint)
+      lowerOffset = lower.offset + (byteDistance % lower.size)
+      __pwrite(fh, lowerOffset, myPackedPoint)
 
     return True
 
@@ -521,6 +1565,7 @@ def __propagate(fh,header,timestamp,higher,lower):
     return False
 
 
+@__instrumented('update', lambda args: 1)
 def update(path,value,timestamp=None):
   """update(path,value,timestamp=None)
 
@@ -537,9 +1582,9 @@ timestamp is either an int or float
     if fh:
       fh.close()
 
+@__instrumented('update', lambda args: 1)
 def file_update(fh, value, timestamp):
-  if LOCK:
-    fcntl.flock( fh.fileno(), fcntl.LOCK_EX )
+  __lockUpdate(fh)
 
   header = __readHeader(fh)
   now = int( time.time() )
@@ -548,33 +1593,29 @@ def file_update(fh, value, timestamp):
 
   timestamp = int(timestamp)
   diff = now - timestamp
-  if not ((diff < header['maxRetention']) and diff >= 0):
+  if not ((diff < header.maxRetention) and diff >= 0):
     raise TimestampNotCovered("Timestamp not covered by any archives in "
       "this database.")
 
-  for i,archive in enumerate(header['archives']): #Find the highest-precision archive that covers timestamp
-    if archive['retention'] < diff: continue
-    lowerArchives = header['archives'][i+1:] #We'll pass on the update to these lower precision archives later
+  for i,archive in enumerate(header.archives): #Find the highest-precision archive that covers timestamp
+    if archive.retention < diff: continue
+    lowerArchives = header.archives[i+1:] #We'll pass on the update to these lower precision archives later
     break
 
   #First we update the highest-precision archive
-  myInterval = timestamp - (timestamp % archive['secondsPerPoint'])
-  myPackedPoint = struct.pack(pointFormat,myInterval,value)
-  fh.seek(archive['offset'])
-  packedPoint = fh.read(pointSize)
-  (baseInterval,baseValue) = struct.unpack(pointFormat,packedPoint)
+  myInterval = timestamp - (timestamp % archive.secondsPerPoint)
+  myPackedPoint = pointStruct.pack(myInterval,value)
+  __lockArchive(fh, archive)
+  baseInterval = __readBaseInterval(fh, archive)
 
   if baseInterval == 0: #This file's first update
-    fh.seek(archive['offset'])
-    fh.write(myPackedPoint)
-    baseInterval,baseValue = myInterval,value
+    __pwrite(fh, archive.offset, myPackedPoint)
   else: #Not our first update
     timeDistance = myInterval - baseInterval
-    pointDistance = timeDistance / archive['secondsPerPoint']
+    pointDistance = timeDistance / archive.secondsPerPoint
     byteDistance = pointDistance * pointSize
-    myOffset = archive['offset'] + (byteDistance % archive['size'])
-    fh.seek(myOffset)
-    fh.write(myPackedPoint)
+    myOffset = archive.offset + (byteDistance % archive.size)
+    __pwrite(fh, myOffset, myPackedPoint)
 
   #Now we propagate the update to lower-precision archives
   higher = archive
@@ -589,6 +1630,7 @@ def file_update(fh, value, timestamp):
 
 
 
+@__instrumented('update_many', lambda args: len(args[1]))
 def update_many(path,points):
   """update_many(path,points)
 
@@ -607,20 +1649,74 @@ points is a list of (timestamp,value) points
       fh.close()
 
 
+def update_many_files(updates,archiveList=None,xFilesFactor=None,aggregationMethod=None,workers=4,pool=None):
+  """update_many_files(updates,archiveList=None,xFilesFactor=None,aggregationMethod=None,workers=4,pool=None)
+
+updates is a dict mapping paths to lists of (timestamp,value) points
+archiveList, if given, is used to create missing files (along with xFilesFactor and aggregationMethod, see ``whisper.create``)
+workers is the number of threads writing files concurrently
+pool is an optional multiprocessing.pool.ThreadPool to reuse across calls instead of starting new workers
+
+Files are written in device and inode order. A failure only affects its own
+file: returns a dict mapping each path to None if it was updated or to the
+exception that stopped its update.
+"""
+  work = []
+  for path,points in updates.items():
+    try:
+      st = os.stat(path)
+      sortKey = (0, st.st_dev, st.st_ino)
+    except OSError:
+      sortKey = (1, path) #missing files go last, update_many reports them if we can't create them
+    work.append( (sortKey, path, points, archiveList, xFilesFactor, aggregationMethod) )
+  work.sort()
+
+  if pool is not None:
+    return dict( pool.map(__update_file, work) )
+  if workers <= 1 or len(work) <= 1:
+    return dict( map(__update_file, work) )
+
+  from multiprocessing.pool import ThreadPool
+  pool = ThreadPool(min(workers, len(work)))
+  try:
+    return dict( pool.map(__update_file, work) )
+  finally:
+    pool.close()
+    pool.join()
+
+
+def __update_file(work):
+  (sortKey, path, points, archiveList, xFilesFactor, aggregationMethod) = work
+  try:
+    if archiveList is not None and not os.path.exists(path):
+      directory = os.path.dirname(path)
+      if directory and not os.path.isdir(directory):
+        try:
+          os.makedirs(directory)
+        except OSError:
+          if not os.path.isdir(directory): #lost a race to create it, that's fine
+            raise
+      create(path, list(archiveList), xFilesFactor, aggregationMethod) #create() sorts the list it is given in place
+    update_many(path, points)
+  except Exception, e:
+    return (path, e)
+  return (path, None)
+
+
+@__instrumented('update_many', lambda args: len(args[1]))
 def file_update_many(fh, points):
-  if LOCK:
-    fcntl.flock( fh.fileno(), fcntl.LOCK_EX )
+  __lockUpdate(fh)
 
   header = __readHeader(fh)
   now = int( time.time() )
-  archives = iter( header['archives'] )
+  archives = iter( header.archives )
   currentArchive = archives.next()
   currentPoints = []
 
   for point in points:
     age = now - point[0]
 
-    while currentArchive['retention'] < age: #we can't fit any more points in this archive
+    while currentArchive.retention < age: #we can't fit any more points in this archive
       if currentPoints: #commit all the points we've found that it can fit
         currentPoints.reverse() #put points in chronological order
         __archive_update_many(fh,header,currentArchive,currentPoints)
@@ -631,12 +1727,12 @@ def file_update_many(fh, points):
         currentArchive = None
         break
 
-    if not currentArchive:
+    if currentArchive is None:
       break #drop remaining points that don't fit in the database
 
     currentPoints.append(point)
 
-  if currentArchive and currentPoints: #don't forget to commit after we've checked all the archives
+  if currentArchive is not None and currentPoints: #don't forget to commit after we've checked all the archives
     currentPoints.reverse()
     __archive_update_many(fh,header,currentArchive,currentPoints)
 
@@ -647,72 +1743,189 @@ def file_update_many(fh, points):
 
 
 def __archive_update_many(fh,header,archive,points):
-  step = archive['secondsPerPoint']
-  alignedPoints = [ (timestamp - (timestamp % step), value)
-                    for (timestamp,value) in points ]
-  alignedPoints = dict(alignedPoints).items() # Take the last val of duplicates
-  #Create a packed string for each contiguous sequence of points
-  packedStrings = []
+  step = archive.secondsPerPoint
+  #points are in chronological order, so aligning them keeps the intervals
+  #sorted and the last point of each interval is the one to keep
+  alignedPoints = []
   previousInterval = None
-  currentString = ""
-  for (interval,value) in alignedPoints:
-    if (not previousInterval) or (interval == previousInterval + step):
-      currentString += struct.pack(pointFormat,interval,value)
-      previousInterval = interval
+  for (timestamp,value) in points:
+    interval = timestamp - (timestamp % step)
+    if interval == previousInterval:
+      alignedPoints[-1] = (interval,value)
     else:
-      numberOfPoints = len(currentString) / pointSize
-      startInterval = previousInterval - (step * (numberOfPoints-1))
-      packedStrings.append( (startInterval,currentString) )
-      currentString = struct.pack(pointFormat,interval,value)
+      alignedPoints.append( (interval,value) )
       previousInterval = interval
-  if currentString:
-    numberOfPoints = len(currentString) / pointSize
-    startInterval = previousInterval - (step * (numberOfPoints-1))
-    packedStrings.append( (startInterval,currentString) )
+  #Create a packed string for each contiguous sequence of points
+  packedStrings = __pack_runs(alignedPoints, step)
+  __archive_write(fh, archive, packedStrings)
+
+  #Now we propagate the updates to lower-precision archives
+  higher = archive
+  lowerArchives = [arc for arc in header.archives if arc.secondsPerPoint > archive.secondsPerPoint]
+  intervals = [interval for (interval,value) in alignedPoints]
+
+  for lower in lowerArchives:
+    lowerStep = lower.secondsPerPoint
+    lowerIntervals = []
+    previousInterval = None
+    for interval in intervals: #sorted, so equal lower intervals are adjacent
+      interval -= interval % lowerStep
+      if interval != previousInterval:
+        lowerIntervals.append(interval)
+        previousInterval = interval
+    if not __propagate_many(fh, header, lowerIntervals, higher, lower):
+      break
+    higher = lower
+    intervals = lowerIntervals
+
+
+def __pack_runs(alignedPoints, step):
+  """Pack sorted, unique (interval,value) points into a (startInterval,packedString)
+pair for each run of contiguous intervals. All the points are packed with a
+single call and the runs are slices of the result"""
+  if not alignedPoints:
+    return []
+  byteOrder,pointTypes = pointFormat[0],pointFormat[1:]
+  packed = struct.pack(byteOrder + (pointTypes * len(alignedPoints)), *itertools.chain(*alignedPoints))
+
+  packedStrings = []
+  runStart = 0
+  expected = alignedPoints[0][0]
+  for (i, (interval,value)) in enumerate(alignedPoints):
+    if interval != expected:
+      packedStrings.append( (alignedPoints[runStart][0], packed[runStart * pointSize:i * pointSize]) )
+      runStart = i
+    expected = interval + step
+  packedStrings.append( (alignedPoints[runStart][0], packed[runStart * pointSize:]) )
+  return packedStrings
+
+
+def __archive_write(fh, archive, packedStrings):
+  step = archive.secondsPerPoint
+  __lockArchive(fh, archive)
 
   #Read base point and determine where our writes will start
-  fh.seek(archive['offset'])
-  packedBasePoint = fh.read(pointSize)
-  (baseInterval,baseValue) = struct.unpack(pointFormat,packedBasePoint)
+  baseInterval = __readBaseInterval(fh, archive)
   if baseInterval == 0: #This file's first update
     baseInterval = packedStrings[0][0] #use our first string as the base, so we start at the start
 
   #Write all of our packed strings in locations determined by the baseInterval
   for (interval,packedString) in packedStrings:
-    timeDistance = interval - baseInterval
-    pointDistance = timeDistance / step
-    byteDistance = pointDistance * pointSize
-    myOffset = archive['offset'] + (byteDistance % archive['size'])
-    fh.seek(myOffset)
-    archiveEnd = archive['offset'] + archive['size']
-    bytesBeyond = (myOffset + len(packedString)) - archiveEnd
-
-    if bytesBeyond > 0:
-      fh.write( packedString[:-bytesBeyond] )
-      assert fh.tell() == archiveEnd, "archiveEnd=%d fh.tell=%d bytesBeyond=%d len(packedString)=%d" % (archiveEnd,fh.tell(),bytesBeyond,len(packedString))
-      fh.seek( archive['offset'] )
-      fh.write( packedString[-bytesBeyond:] ) #safe because it can't exceed the archive (retention checking logic above)
-    else:
-      fh.write(packedString)
+    index = ((interval - baseInterval) / step) % archive.points
+    __archive_write_slots(fh, archive, index, packedString)
 
-  #Now we propagate the updates to lower-precision archives
-  higher = archive
-  lowerArchives = [arc for arc in header['archives'] if arc['secondsPerPoint'] > archive['secondsPerPoint']]
 
-  for lower in lowerArchives:
-    fit = lambda i: i - (i % lower['secondsPerPoint'])
-    lowerIntervals = [fit(p[0]) for p in alignedPoints]
-    uniqueLowerIntervals = set(lowerIntervals)
-    propagateFurther = False
-    for interval in uniqueLowerIntervals:
-      if __propagate(fh, header, interval, higher, lower):
-        propagateFurther = True
-
-    if not propagateFurther:
-      break
-    higher = lower
+def __archive_write_slots(fh, archive, index, packedString):
+  """Write packed points to consecutive slots of archive from slot index on,
+wrapping around the archive's end"""
+  myOffset = archive.offset + index * pointSize
+  bytesBeyond = (myOffset + len(packedString)) - (archive.offset + archive.size)
+
+  if bytesBeyond > 0:
+    __pwrite(fh, myOffset, packedString[:-bytesBeyond])
+    __pwrite(fh, archive.offset, packedString[-bytesBeyond:]) #safe because it can't exceed the archive (retention checking logic above)
+  else:
+    __pwrite(fh, myOffset, packedString)
+
+
+def __archive_read(fh, archive, baseInterval, fromInterval, points):
+  """Read the packed contents of points consecutive slots of archive, starting
+with the slot that fromInterval maps to and wrapping around the archive's end"""
+  fromIndex = ((fromInterval - baseInterval) / archive.secondsPerPoint) % archive.points
+  return __archive_read_slots(fh, archive, fromIndex, points)
+
+
+def __archive_read_slots(fh, archive, fromIndex, points):
+  """Read points consecutive slots of archive from slot fromIndex on, wrapping
+around the archive's end"""
+  fromOffset = archive.offset + fromIndex * pointSize
+  if fromIndex + points <= archive.points:
+    return __pread(fh, fromOffset, points * pointSize)
+
+  return __preadRanges(fh, [
+    (fromOffset, (archive.points - fromIndex) * pointSize),
+    (archive.offset, (fromIndex + points - archive.points) * pointSize),
+  ])
+
+
+@__instrumented('propagate')
+def __propagate_many(fh,header,lowerIntervals,higher,lower):
+  """Propagate each of the sorted, unique lowerIntervals from higher to lower.
+
+Each run of contiguous lower intervals is aggregated from a single read of the
+higher archive, and the results are written to the lower archive as coalesced
+contiguous runs. Returns True if any interval was propagated.
+"""
+  aggregationMethod = header.aggregationMethod
+  xff = header.xFilesFactor
+  step = higher.secondsPerPoint
+  lowerStep = lower.secondsPerPoint
+  higherPoints = lowerStep / step
+  #A single read must not go around the higher archive more than once
+  maxIntervals = higher.points / higherPoints
+  higherBaseInterval = __readBaseInterval(fh, higher)
+  byteOrder,pointTypes = pointFormat[0],pointFormat[1:]
+
+  propagated = []
+  for (runStart, runLength) in __interval_runs(lowerIntervals, lowerStep, maxIntervals):
+    seriesString = __archive_read(fh, higher, higherBaseInterval, runStart, runLength * higherPoints)
+
+    if CAN_NUMPY and runLength > 1:
+      series = numpy.frombuffer(seriesString, dtype=pointDtype).reshape(runLength, higherPoints)
+      expected = numpy.arange(runStart, runStart + runLength * lowerStep, step).reshape(runLength, higherPoints)
+      known = series['interval'] == expected
+      knownCount = known.sum(axis=1)
+      mask = (knownCount > 0) & (knownCount / float(higherPoints) >= xff)
+      if not mask.any():
+        continue
+      values = __aggregate_array(aggregationMethod, series['value'], known)
+      intervals = numpy.arange(runStart, runStart + runLength * lowerStep, lowerStep)
+      propagated.extend(zip(intervals[mask].tolist(), values[mask].tolist()))
+      continue
+
+    unpackedSeries = struct.unpack(byteOrder + (pointTypes * runLength * higherPoints), seriesString)
+    currentInterval = runStart
+    i = 0
+    for lowerInterval in xrange(runStart, runStart + runLength * lowerStep, lowerStep):
+      neighborValues = [None] * higherPoints
+      for j in xrange(higherPoints):
+        if unpackedSeries[i] == currentInterval:
+          neighborValues[j] = unpackedSeries[i+1]
+        currentInterval += step
+        i += 2
+
+      knownValues = [v for v in neighborValues if v is not None]
+      if not knownValues:
+        continue
+      knownPercent = float(len(knownValues)) / float(higherPoints)
+      if knownPercent >= xff: #we have enough data to propagate a value!
+        propagated.append( (lowerInterval, aggregate(aggregationMethod, knownValues, neighborValues)) )
+
+  if not propagated:
+    return False
+
+  __archive_write(fh, lower, __pack_runs(propagated, lowerStep))
+  return True
+
+
+def __interval_runs(intervals, step, maxLength):
+  """Split sorted, unique intervals into (startInterval,length) runs of at most
+maxLength contiguous intervals"""
+  runs = []
+  runStart = previousInterval = None
+  for interval in intervals:
+    if runStart is not None and interval == previousInterval + step and (interval - runStart) / step < maxLength:
+      previousInterval = interval
+      continue
+    if runStart is not None:
+      runs.append( (runStart, (previousInterval - runStart) / step + 1) )
+    runStart = previousInterval = interval
+  if runStart is not None:
+    runs.append( (runStart, (previousInterval - runStart) / step + 1) )
+  return runs
 
 
+@__instrumented('info')
 def info(path):
   """info(path)
 
@@ -721,18 +1934,37 @@ path is a string
   fh = None
   try:
     fh = open(path,'rb')
-    return __readHeader(fh)
+    return file_info(fh)
   finally:
     if fh:
       fh.close()
   return None
 
-def fetch(path,fromTime,untilTime=None):
-  """fetch(path,fromTime,untilTime=None)
+@__instrumented('info')
+def file_info(fh):
+  """file_info(fh)
+
+Returns the header of fh as plain dicts the caller is free to modify
+"""
+  return __readHeader(fh).asDict()
+
+@__instrumented('fetch')
+def fetch(path,fromTime,untilTime=None,as_array=False,maxDataPoints=None,aggregationMethod=None,archive_number=None):
+  """fetch(path,fromTime,untilTime=None,as_array=False,maxDataPoints=None,aggregationMethod=None,archive_number=None)
 
 path is a string
 fromTime is an epoch time
 untilTime is also an epoch time, but defaults to now.
+as_array returns the values as a numpy float64 array with NaN for missing
+points instead of a list with None (requires numpy)
+maxDataPoints, if given, is the most values to return. The finest archive that
+fits the range in as many points is read, or the coarsest one if none does,
+and its values are then consolidated into buckets of a multiple of its step
+aggregationMethod overrides the file's aggregation method for that
+consolidation (see ``whisper.aggregationMethods``)
+archive_number, if given, is the archive to read from, 0 being the finest,
+instead of the finest one that covers the range. The range is cut to that
+archive's retention
 
 Returns a tuple of (timeInfo, valueList)
 where timeInfo is itself a tuple of (fromTime, untilTime, step)
@@ -742,14 +1974,112 @@ Returns None if no data can be returned
   fh = None
   try:
     fh = open(path,'rb')
-    return file_fetch(fh, fromTime, untilTime)
+    return file_fetch(fh, fromTime, untilTime, as_array, maxDataPoints, aggregationMethod, archive_number)
   finally:
     if fh:
       fh.close()
 
-def file_fetch(fh, fromTime, untilTime):
+@__instrumented('fetch')
+def file_fetch(fh, fromTime, untilTime, as_array=False, maxDataPoints=None, aggregationMethod=None, archive_number=None):
+  if as_array and not CAN_NUMPY:
+    raise ImportError("numpy is required to fetch values as an array")
+  if maxDataPoints is not None and maxDataPoints < 1:
+    raise ValueError("maxDataPoints must be at least 1, not %r" % (maxDataPoints,))
+  if aggregationMethod is not None and aggregationMethod not in aggregationMethods:
+    raise InvalidAggregationMethod("Unrecognized aggregation method: %s" %
+          aggregationMethod)
+
   header = __readHeader(fh)
+  if archive_number is not None and not 0 <= archive_number < len(header.archives):
+    raise ValueError("archive_number must be from 0 to %d, not %r" %
+                     (len(header.archives) - 1, archive_number))
   now = int( time.time() )
+  timeRange = __fetchRange(header, fromTime, untilTime, now)
+  if timeRange is None:
+    return None
+  (fromTime, untilTime) = timeRange
+  selected = __fetchArchive(header, fromTime, untilTime, now, maxDataPoints, archive_number)
+  if selected is None:
+    return None
+  (archive, fromTime) = selected
+
+  if not maxDataPoints or __fetchPoints(archive, fromTime, untilTime) <= maxDataPoints:
+    return __archive_fetch(fh, archive, fromTime, untilTime, as_array)
+
+  # Consolidate arrays whenever numpy is there, it saves building the full
+  # list of values only to throw most of it away
+  (timeInfo, values) = __archive_fetch(fh, archive, fromTime, untilTime, CAN_NUMPY)
+  return __consolidateToBudget(timeInfo, values, maxDataPoints,
+                               aggregationMethod or header.aggregationMethod, as_array)
+
+def __fetchArchive(header, fromTime, untilTime, now, maxDataPoints=None, archive_number=None):
+  """The archive to read fromTime to untilTime from, and fromTime cut to its
+retention. Returns (archive, fromTime), or None if the archive does not reach
+back to untilTime"""
+  if archive_number is not None:
+    archive = header.archives[archive_number]
+    oldestTime = now - archive.retention
+    if untilTime < oldestTime:
+      return None
+    return (archive, max(fromTime, oldestTime))
+
+  diff = now - fromTime
+  for archive in header.archives:
+    if archive.retention >= diff:
+      if not maxDataPoints or __fetchPoints(archive, fromTime, untilTime) <= maxDataPoints:
+        break
+  return (archive, fromTime)
+
+def __fetchPoints(archive, fromTime, untilTime):
+  """The number of values __archive_fetch returns from archive for the range"""
+  step = archive.secondsPerPoint
+  return (untilTime - (untilTime % step)) / step - (fromTime - (fromTime % step)) / step
+
+def __consolidateToBudget(timeInfo, values, maxDataPoints, aggregationMethod, as_array):
+  """Aggregate values into at most maxDataPoints buckets of a multiple of
+their step. Buckets are aligned on multiples of their own step so that the
+same points are grouped together whatever the requested range"""
+  (fromInterval, untilInterval, step) = timeInfo
+  valuesPerPoint = (len(values) + maxDataPoints - 1) / maxDataPoints
+  while True:
+    bucketStep = step * valuesPerPoint
+    bucketFrom = fromInterval - (fromInterval % bucketStep)
+    bucketUntil = untilInterval - (untilInterval % bucketStep)
+    if bucketUntil < untilInterval:
+      bucketUntil += bucketStep
+    if (bucketUntil - bucketFrom) / bucketStep <= maxDataPoints:
+      break
+    valuesPerPoint += 1
+
+  if not CAN_NUMPY:
+    points = itertools.izip(xrange(fromInterval, untilInterval, step), values)
+    return __consolidate(points, bucketFrom, bucketUntil, bucketStep, aggregationMethod)
+
+  buckets = (bucketUntil - bucketFrom) / bucketStep
+  lead = (fromInterval - bucketFrom) / step
+  series = numpy.empty(buckets * valuesPerPoint)
+  series.fill(numpy.nan)
+  series[lead:lead + len(values)] = values
+  series = series.reshape(buckets, valuesPerPoint)
+  # the first and last buckets can reach beyond the values fetched
+  slots = numpy.zeros(buckets * valuesPerPoint, dtype=bool)
+  slots[lead:lead + len(values)] = True
+  slots = slots.reshape(buckets, valuesPerPoint)
+  known = ~numpy.isnan(series)
+  consolidated = __aggregate_array(aggregationMethod, series, known, slots)
+  consolidated[~known.any(axis=1)] = numpy.nan
+
+  if not as_array:
+    consolidated = consolidated.tolist()
+    for (i, value) in enumerate(consolidated):
+      if value != value: #NaN
+        consolidated[i] = None
+  timeInfo = (bucketFrom, bucketUntil, bucketStep)
+  return (timeInfo, consolidated)
+
+def __fetchRange(header, fromTime, untilTime, now):
+  """Clamp the requested range to what the file can hold. Returns the adjusted
+(fromTime, untilTime), or None if there is nothing to return"""
   if untilTime is None:
     untilTime = now
   fromTime = int(fromTime)
@@ -761,7 +2091,7 @@ def file_fetch(fh, fromTime, untilTime):
   if (fromTime > untilTime):
     raise InvalidTimeInterval("Invalid time interval: from time '%s' is after until time '%s'" % (fromTime, untilTime))
 
-  oldestTime = now - header['maxRetention']
+  oldestTime = now - header.maxRetention
   # Range is in the future
   if fromTime > now:
     return None
@@ -775,53 +2105,270 @@ def file_fetch(fh, fromTime, untilTime):
   if untilTime > now:
     untilTime = now
 
-  diff = now - fromTime
-  for archive in header['archives']:
-    if archive['retention'] >= diff:
+  return (fromTime, untilTime)
+
+@__instrumented('fetch')
+def fetch_stitched(path,fromTime,untilTime=None,step=None):
+  """fetch_stitched(path,fromTime,untilTime=None,step=None)
+
+path is a string
+fromTime is an epoch time
+untilTime is also an epoch time, but defaults to now.
+step, if given, consolidates the result to a single series of that resolution
+
+Reads every archive for the part of the range that no higher-precision archive
+covers, so recent data comes back at full resolution however far back the
+range goes.
+
+Returns a list of (timeInfo, valueList) segments ordered from oldest to newest,
+or with step a single (timeInfo, valueList) tuple whose step is the lowest
+multiple of step that every archive read divides (values within a step are
+combined with the file's aggregation method).
+
+Returns None if no data can be returned
+"""
+  fh = None
+  try:
+    fh = open(path,'rb')
+    return file_fetch_stitched(fh, fromTime, untilTime, step)
+  finally:
+    if fh:
+      fh.close()
+
+@__instrumented('fetch')
+def file_fetch_stitched(fh, fromTime, untilTime, step=None):
+  header = __readHeader(fh)
+  now = int( time.time() )
+  timeRange = __fetchRange(header, fromTime, untilTime, now)
+  if timeRange is None:
+    return None
+  (fromTime, untilTime) = timeRange
+
+  segments = []
+  archives = header.archives
+  limit = None
+  for i,archive in enumerate(archives):
+    archiveStep = archive.secondsPerPoint
+    fromInterval = fromTime - (fromTime % archiveStep) + archiveStep
+    untilInterval = untilTime - (untilTime % archiveStep) + archiveStep
+    if limit is not None:
+      untilInterval = min(untilInterval, limit)
+
+    # The next archive takes over from the first of its own intervals that
+    # starts after this archive's retention, unless it has no interval of the
+    # range before that
+    boundary = None
+    if i + 1 < len(archives):
+      nextStep = archives[i+1].secondsPerPoint
+      oldest = now - archive.retention
+      boundary = oldest - (oldest % nextStep) + nextStep
+      if fromTime - (fromTime % nextStep) + nextStep >= boundary:
+        boundary = None
+
+    if boundary is None or fromInterval >= boundary:
+      if fromInterval < untilInterval:
+        segments.append( __archive_fetch(fh, archive, fromInterval - archiveStep, untilInterval - archiveStep) )
       break
 
-  return __archive_fetch(fh, archive, fromTime, untilTime)
+    if boundary < untilInterval:
+      segments.append( __archive_fetch(fh, archive, boundary - archiveStep, untilInterval - archiveStep) )
+    limit = boundary
+
+  if not segments:
+    return None
+  segments.reverse()
+  if step is None:
+    return segments
+
+  step = int(step)
+  coarsest = max([timeInfo[2] for (timeInfo, values) in segments])
+  if step % coarsest:
+    step = step * coarsest / __gcd(step, coarsest)
+  points = []
+  for ((segmentFrom, segmentUntil, segmentStep), values) in segments:
+    points.extend(itertools.izip(xrange(segmentFrom, segmentUntil, segmentStep), values))
+  fromInterval = segments[0][0][0] - (segments[0][0][0] % step)
+  untilInterval = segments[-1][0][1] - (segments[-1][0][1] % step)
+  if untilInterval < segments[-1][0][1]:
+    untilInterval += step
+  return __consolidate(points, fromInterval, untilInterval, step, header.aggregationMethod)
+
+def __gcd(a, b):
+  while b:
+    (a, b) = (b, a % b)
+  return a
+
+def __consolidate(points, fromInterval, untilInterval, step, aggregationMethod):
+  """Aggregate the known values of the (timestamp,value) points into buckets
+of step seconds from fromInterval to untilInterval"""
+  buckets = [None] * ((untilInterval - fromInterval) / step)
+  for (timestamp, value) in points:
+    index = (timestamp - fromInterval) / step
+    if buckets[index] is None:
+      buckets[index] = [value]
+    else:
+      buckets[index].append(value)
+
+  valueList = [None] * len(buckets)
+  for (i, neighborValues) in enumerate(buckets):
+    if neighborValues:
+      knownValues = [v for v in neighborValues if v is not None]
+      if knownValues:
+        valueList[i] = aggregate(aggregationMethod, knownValues, neighborValues)
+
+  timeInfo = (fromInterval, untilInterval, step)
+  return (timeInfo, valueList)
+
+def fetch_many(paths,fromTime,untilTime=None,as_array=False,workers=8,pool=None,batchSize=256,
+               maxDataPoints=None,aggregationMethod=None,archive_number=None):
+  """fetch_many(paths,fromTime,untilTime=None,as_array=False,workers=8,pool=None,batchSize=256,maxDataPoints=None,aggregationMethod=None,archive_number=None)
+
+paths is a list of strings
+fromTime, untilTime, as_array, maxDataPoints, aggregationMethod and
+archive_number are the same as for ``whisper.fetch``
+workers is the number of threads reading files concurrently
+pool is an optional multiprocessing.pool.ThreadPool to reuse across calls instead of starting new workers
+batchSize is the number of files opened and hinted ahead of being read
+
+Before reading a batch of files, the kernel is asked to read ahead the byte
+ranges each fetch will need (where posix_fadvise is available).
+
+Returns a list with, for each path in order, what ``whisper.fetch`` returns
+for it or the exception that the fetch raised
+"""
+  if untilTime is None:
+    untilTime = int( time.time() ) #the same range for every file
+
+  ownPool = None
+  if pool is None and workers > 1 and len(paths) > 1:
+    from multiprocessing.pool import ThreadPool
+    pool = ownPool = ThreadPool(min(workers, len(paths)))
+  mapper = pool and pool.map or map
+
+  results = []
+  try:
+    for i in xrange(0, len(paths), batchSize):
+      batch = [(path, fromTime, untilTime, as_array, maxDataPoints, aggregationMethod, archive_number)
+               for path in paths[i:i+batchSize]]
+      results.extend( mapper(__fetch_read, mapper(__fetch_open, batch)) )
+  finally:
+    if ownPool is not None:
+      ownPool.close()
+      ownPool.join()
+  return results
+
+def __fetch_open(request):
+  (path, fromTime, untilTime, as_array, maxDataPoints, aggregationMethod, archive_number) = request
+  fh = None
+  try:
+    fh = open(path,'rb')
+    if CAN_FADVISE:
+      __advise_fetch(fh, fromTime, untilTime, maxDataPoints, archive_number)
+  except Exception, e:
+    if fh:
+      fh.close()
+    return (None, e, request)
+  return (fh, None, request)
+
+def __fetch_read(opened):
+  (fh, error, (path, fromTime, untilTime, as_array, maxDataPoints, aggregationMethod, archive_number)) = opened
+  if error is not None:
+    return error
+  try:
+    try:
+      return file_fetch(fh, fromTime, untilTime, as_array, maxDataPoints, aggregationMethod, archive_number)
+    except Exception, e:
+      return e
+  finally:
+    fh.close()
 
-def __archive_fetch(fh, archive, fromTime, untilTime):
+def __advise_fetch(fh, fromTime, untilTime, maxDataPoints=None, archive_number=None):
+  """Ask the kernel to start reading the ranges a file_fetch of fromTime to
+untilTime will read from fh"""
+  header = __readHeader(fh)
+  if archive_number is not None and not 0 <= archive_number < len(header.archives):
+    return #file_fetch raises the error
+  now = int( time.time() )
+  timeRange = __fetchRange(header, fromTime, untilTime, now)
+  if timeRange is None:
+    return
+  (fromTime, untilTime) = timeRange
+  selected = __fetchArchive(header, fromTime, untilTime, now, maxDataPoints, archive_number)
+  if selected is None:
+    return
+  (archive, fromTime) = selected
+
+  baseInterval = __readBaseInterval(fh, archive)
+  if baseInterval == 0:
+    return
+
+  step = archive.secondsPerPoint
+  fromInterval = fromTime - (fromTime % step) + step
+  untilInterval = untilTime - (untilTime % step) + step
+  fromOffset = archive.offset + (((fromInterval - baseInterval) / step) % archive.points) * pointSize
+  untilOffset = archive.offset + (((untilInterval - baseInterval) / step) % archive.points) * pointSize
+  if fromOffset < untilOffset:
+    ranges = [(fromOffset, untilOffset - fromOffset)]
+  else:
+    ranges = [(fromOffset, archive.offset + archive.size - fromOffset),
+              (archive.offset, untilOffset - archive.offset)]
+  for (offset, length) in ranges:
+    if length > 0: #a length of 0 would advise up to the end of the file
+      fadvise(fh, offset, length, POSIX_FADV_WILLNEED)
+
+def __archive_fetch(fh, archive, fromTime, untilTime, as_array=False):
   """
 Fetch data from a single archive. Note that checks for validity of the time
 period requested happen above this level so it's possible to wrap around the
 archive on a read and request data older than the archive's retention
 """
-  fromInterval = int( fromTime - (fromTime % archive['secondsPerPoint']) ) + archive['secondsPerPoint']
-  untilInterval = int( untilTime - (untilTime % archive['secondsPerPoint']) ) + archive['secondsPerPoint']
-  fh.seek(archive['offset'])
-  packedPoint = fh.read(pointSize)
-  (baseInterval,baseValue) = struct.unpack(pointFormat,packedPoint)
+  fromInterval = int( fromTime - (fromTime % archive.secondsPerPoint) ) + archive.secondsPerPoint
+  untilInterval = int( untilTime - (untilTime % archive.secondsPerPoint) ) + archive.secondsPerPoint
+  step = archive.secondsPerPoint
+  timeInfo = (fromInterval,untilInterval,step)
 
-  if baseInterval == 0:
-    step = archive['secondsPerPoint']
-    points = (untilInterval - fromInterval) / step
-    timeInfo = (fromInterval,untilInterval,step)
-    valueList = [None] * points
-    return (timeInfo,valueList)
-
-  #Determine fromOffset
-  timeDistance = fromInterval - baseInterval
-  pointDistance = timeDistance / archive['secondsPerPoint']
-  byteDistance = pointDistance * pointSize
-  fromOffset = archive['offset'] + (byteDistance % archive['size'])
-
-  #Determine untilOffset
-  timeDistance = untilInterval - baseInterval
-  pointDistance = timeDistance / archive['secondsPerPoint']
-  byteDistance = pointDistance * pointSize
-  untilOffset = archive['offset'] + (byteDistance % archive['size'])
-
-  #Read all the points in the interval
-  fh.seek(fromOffset)
-  if fromOffset < untilOffset: #If we don't wrap around the archive
-    seriesString = fh.read(untilOffset - fromOffset)
-  else: #We do wrap around the archive, so we need two reads
-    archiveEnd = archive['offset'] + archive['size']
-    seriesString = fh.read(archiveEnd - fromOffset)
-    fh.seek(archive['offset'])
-    seriesString += fh.read(untilOffset - archive['offset'])
+  locked = __lockRead(fh, archive)
+  try:
+    baseInterval = __readBaseInterval(fh, archive)
+    if baseInterval == 0:
+      points = (untilInterval - fromInterval) / step
+      return (timeInfo, __archive_empty(points, as_array))
+
+    #Read all the points in the interval, wrapping around the archive if needed
+    fromIndex = ((fromInterval - baseInterval) / step) % archive.points
+    untilIndex = ((untilInterval - baseInterval) / step) % archive.points
+    points = (untilIndex - fromIndex) % archive.points or archive.points
+    return (timeInfo, __archive_values(fh, archive, baseInterval, fromInterval, points, as_array))
+  finally:
+    if locked:
+      __unlockRead(fh, archive)
+
+def __archive_empty(points, as_array):
+  if as_array:
+    valueList = numpy.empty(points)
+    valueList.fill(numpy.nan)
+    return valueList
+  return [None] * points
+
+def __archive_values(fh, archive, baseInterval, fromInterval, points, as_array):
+  """Read the values of points consecutive intervals of archive starting at
+fromInterval, with None (NaN in arrays) for the intervals that have no data"""
+  step = archive.secondsPerPoint
+  if as_array:
+    if isinstance(fh, WhisperFile):
+      #View the whole archive in place and let take() do the wrap-around
+      fromIndex = ((fromInterval - baseInterval) / step) % archive.points
+      series = numpy.frombuffer(fh.map, dtype=pointDtype, count=archive.points, offset=archive.offset)
+      series = series.take(numpy.arange(fromIndex, fromIndex + points), mode='wrap')
+    else:
+      seriesString = __archive_read(fh, archive, baseInterval, fromInterval, points)
+      series = numpy.frombuffer(seriesString, dtype=pointDtype)
+
+    #Points whose timestamp is not the one expected at their position are stale
+    expected = numpy.arange(fromInterval, fromInterval + points * step, step)
+    return numpy.where(series['interval'] == expected, series['value'], numpy.nan)
+
+  seriesString = __archive_read(fh, archive, baseInterval, fromInterval, points)
 
   #Now we unpack the series data we just read (anything faster than unpack?)
   byteOrder,pointTypes = pointFormat[0],pointFormat[1:]
@@ -832,7 +2379,6 @@ archive on a read and request data older than the archive's retention
   #And finally we construct a list of values (optimize this!)
   valueList = [None] * points #pre-allocate entire list for speed
   currentInterval = fromInterval
-  step = archive['secondsPerPoint']
 
   for i in xrange(0,len(unpackedSeries),2):
     pointTime = unpackedSeries[i]
@@ -841,82 +2387,938 @@ archive on a read and request data older than the archive's retention
       valueList[i/2] = pointValue #in-place reassignment is faster than append()
     currentInterval += step
 
-  timeInfo = (fromInterval,untilInterval,step)
-  return (timeInfo,valueList)
+  return valueList
+
+def iter_fetch(path,fromTime,untilTime=None,chunkPoints=65536,as_array=False):
+  """iter_fetch(path,fromTime,untilTime=None,chunkPoints=65536,as_array=False)
 
-def merge(path_from, path_to):
-  """ Merges the data from one whisper file into another. Each file must have
-  the same archive configuration
+path is a string
+fromTime, untilTime and as_array are the same as for ``whisper.fetch``
+chunkPoints is the most points read and returned at once
+
+Generates what ``whisper.fetch`` returns one (timeInfo, valueList) chunk at a
+time, oldest first, so memory use does not grow with the length of the range.
+Joined together the chunks make up the values fetch returns. Nothing is
+generated if fetch would return None.
+
+The file is opened when iteration starts and closed when it ends or the
+generator is closed. A chunk reflects the file at the time it is read
 """
-  fh_from = open(path_from, 'rb')
-  fh_to = open(path_to, 'rb+')
-  return file_merge(fh_from, fh_to)
+  fh = open(path,'rb')
+  try:
+    for chunk in file_iter_fetch(fh, fromTime, untilTime, chunkPoints, as_array):
+      yield chunk
+  finally:
+    fh.close()
 
-def file_merge(fh_from, fh_to):
-  headerFrom = __readHeader(fh_from)
-  headerTo = __readHeader(fh_to)
+def file_iter_fetch(fh, fromTime, untilTime, chunkPoints=65536, as_array=False):
+  if as_array and not CAN_NUMPY:
+    raise ImportError("numpy is required to fetch values as an array")
+  if chunkPoints < 1:
+    raise ValueError("chunkPoints must be at least 1, not %r" % (chunkPoints,))
 
-  if headerFrom['archives'] != headerTo['archives']:
-    raise NotImplementedError("%s and %s archive configurations are unalike. " \
-    "Resize the input before merging" % (fh_from.name, fh_to.name))
+  header = __readHeader(fh)
+  now = int( time.time() )
+  timeRange = __fetchRange(header, fromTime, untilTime, now)
+  if timeRange is None:
+    return
+  (fromTime, untilTime) = timeRange
 
-  archives = headerFrom['archives']
-  archives.sort(key=operator.itemgetter('retention'))
+  diff = now - fromTime
+  for archive in header.archives:
+    if archive.retention >= diff:
+      break
 
-  now = int(time.time())
-  untilTime = now
-  for archive in archives:
-    fromTime = now - archive['retention']
-    (timeInfo, values) = __archive_fetch(fh_from, archive, fromTime, untilTime)
-    (start, end, archive_step) = timeInfo
-    pointsToWrite = list(itertools.ifilter(
-      lambda points: points[1] is not None,
-      itertools.izip(xrange(start, end, archive_step), values)))
-    __archive_update_many(fh_to, headerTo, archive, pointsToWrite)
-    untilTime = fromTime
-    fh_from.close()
-    fh_to.close()
+  for chunk in __archive_chunks(fh, archive, fromTime, untilTime, chunkPoints, as_array):
+    yield chunk
+
+def __archive_chunks(fh, archive, fromTime, untilTime, chunkPoints, as_array):
+  """Fetch data from a single archive like __archive_fetch, chunkPoints points
+at a time. Yields (timeInfo, valueList) for each chunk"""
+  step = archive.secondsPerPoint
+  fromInterval = int( fromTime - (fromTime % step) ) + step
+  untilInterval = int( untilTime - (untilTime % step) ) + step
+  baseInterval = __readBaseInterval(fh, archive)
+
+  for chunkFrom in xrange(fromInterval, untilInterval, chunkPoints * step):
+    chunkUntil = min(chunkFrom + chunkPoints * step, untilInterval)
+    points = (chunkUntil - chunkFrom) / step
+    if baseInterval == 0:
+      valueList = __archive_empty(points, as_array)
+    else:
+      #Each chunk is read under its own lock, none is held while the caller
+      #has the generator suspended
+      locked = __lockRead(fh, archive)
+      try:
+        valueList = __archive_values(fh, archive, baseInterval, chunkFrom, points, as_array)
+      finally:
+        if locked:
+          __unlockRead(fh, archive)
+    yield ((chunkFrom, chunkUntil, step), valueList)
+
+@__instrumented('merge')
+def merge(path_from, path_to, mode='overwrite'):
+  """merge(path_from,path_to,mode='overwrite')
+
+path_from and path_to are strings of files with the same archive configuration
+mode is 'overwrite' to copy every point of path_from into path_to, replacing
+the points both files have, or 'fill' to only copy the points path_to lacks
+
+Each archive is copied as it is, lower archives are not recomputed from the
+merged data. Returns the number of points copied
+"""
+  return merge_many([path_from], path_to, mode)
+
+@__instrumented('merge')
+def file_merge(fh_from, fh_to, mode='overwrite'):
+  return file_merge_many([fh_from], fh_to, mode)
+
+@__instrumented('merge')
+def merge_many(paths_from, path_to, mode='overwrite'):
+  """merge_many(paths_from,path_to,mode='overwrite')
+
+paths_from is a list of files with the same archive configuration as path_to,
+such as replicas of a metric each missing some of its points. Each slot of
+path_to ends up with the latest interval any of the files has for it, and all
+files are read in step so path_to is only written once
+mode decides between files holding the same interval: 'overwrite' takes the
+value of the last file of paths_from that has it, like merging each file in
+turn, while 'fill' keeps the value of path_to or else the first file of
+paths_from that has it
+
+Returns the number of points written to path_to
+"""
+  fhs_from = []
+  fh_to = None
+  try:
+    for path_from in paths_from:
+      fhs_from.append(open(path_from, 'rb'))
+    fh_to = open(path_to, 'rb+')
+    return file_merge_many(fhs_from, fh_to, mode)
+  finally:
+    for fh_from in fhs_from:
+      fh_from.close()
+    if fh_to:
+      fh_to.close()
+
+@__instrumented('merge')
+def file_merge_many(fhs_from, fh_to, mode='overwrite'):
+  if mode not in ('overwrite', 'fill'):
+    raise ValueError("Unknown merge mode %r, use 'overwrite' or 'fill'" % (mode,))
+  __lockUpdate(fh_to)
+  headerTo = __readHeader(fh_to)
+  for fh_from in fhs_from:
+    if __readHeader(fh_from).archives != headerTo.archives:
+      raise NotImplementedError("%s and %s archive configurations are unalike. " \
+      "Resize the input before merging" % (fh_from.name, fh_to.name))
 
+  copied = 0
+  for archive in headerTo.archives:
+    copied += __archive_merge(fhs_from, fh_to, archive, mode)
+
+  if AUTOFLUSH:
+    fh_to.flush()
+    os.fsync(fh_to.fileno())
+  return copied
+
+# Points compared at once by merge, and the most unchanged points between two
+# copied ones that are rewritten rather than splitting the write
+mergeBlockPoints = 65536
+mergeGapPoints = 256
+
+def __archive_merge(fhs_from, fh_to, archive, mode):
+  """Copy the points of archive in each of fhs_from to the slots of fh_to that
+should take them. The same interval can sit in different slots of each file,
+an archive starts wherever its first point was written"""
+  step = archive.secondsPerPoint
+  bases = []
+  for fh_from in fhs_from:
+    locked = __lockRead(fh_from, archive)
+    try:
+      bases.append(__readBaseInterval(fh_from, archive))
+    finally:
+      if locked:
+        __unlockRead(fh_from, archive)
+  sources = [(fh_from, base) for (fh_from, base) in zip(fhs_from, bases) if base]
+  if not sources: #nothing to copy
+    return 0
+
+  __lockArchive(fh_to, archive)
+  baseTo = __readBaseInterval(fh_to, archive) or sources[0][1]
+  # slot i of fh_to holds the same interval as slot i - shift of a source
+  shifts = [((base - baseTo) / step) % archive.points for (fh_from, base) in sources]
+
+  copied = 0
+  for first in xrange(0, archive.points, mergeBlockPoints):
+    points = min(mergeBlockPoints, archive.points - first)
+    blocks = []
+    for ((fh_from, base), shift) in zip(sources, shifts):
+      locked = __lockRead(fh_from, archive)
+      try:
+        blocks.append(__archive_read_slots(fh_from, archive, (first - shift) % archive.points, points))
+      finally:
+        if locked:
+          __unlockRead(fh_from, archive)
+    target = __archive_read_slots(fh_to, archive, first, points)
+
+    # the blocks in order of preference for an interval several files have
+    if mode == 'fill':
+      blocks.insert(0, target)
+      targetIndex = 0
+    else:
+      blocks.reverse()
+      blocks.append(target)
+      targetIndex = len(blocks) - 1
+    (copies, runs) = __merge_block(blocks, targetIndex)
+    for (runStart, packedString) in runs:
+      __archive_write_slots(fh_to, archive, first + runStart, packedString)
+    copied += copies
+  return copied
+
+def __merge_block(blocks, targetIndex):
+  """Compare blocks of packed points slot by slot. Each slot takes the latest
+interval of any block, from the first block holding it. Returns the number of
+slots that change in blocks[targetIndex] and the (index,packedString) runs to
+write there, unchanged slots closer than mergeGapPoints being written back
+along with their neighbours"""
+  if CAN_NUMPY:
+    series = numpy.vstack([numpy.frombuffer(block, dtype=pointDtype) for block in blocks])
+    intervals = series['interval']
+    newest = intervals.max(axis=0)
+    holders = (intervals == newest).argmax(axis=0)
+    indexes = numpy.flatnonzero((holders != targetIndex) & (newest != 0))
+    targetPoints = series[targetIndex]
+    changed = ((newest[indexes] != targetPoints['interval'][indexes]) |
+               (series['value'][holders[indexes], indexes] != targetPoints['value'][indexes]))
+    indexes = indexes[changed]
+    if not len(indexes):
+      return (0, [])
+    breaks = numpy.flatnonzero(numpy.diff(indexes) > mergeGapPoints)
+    starts = [indexes[0]] + indexes[breaks + 1].tolist()
+    ends = indexes[breaks].tolist() + [indexes[-1]]
+    runs = [(start, series[holders[start:end + 1], numpy.arange(start, end + 1)].tostring())
+            for (start, end) in zip(starts, ends)]
+    return (len(indexes), runs)
+
+  byteOrder,pointTypes = pointFormat[0],pointFormat[1:]
+  seriesFormat = byteOrder + (pointTypes * (len(blocks[0]) / pointSize))
+  series = [struct.unpack(seriesFormat, block) for block in blocks]
+  targetPoints = series[targetIndex]
+  holders = {}
+  for i in xrange(0, len(targetPoints), 2):
+    newest = max([points[i] for points in series])
+    if not newest:
+      continue
+    holder = 0
+    while series[holder][i] != newest:
+      holder += 1
+    points = series[holder]
+    if holder != targetIndex and (points[i] != targetPoints[i] or points[i+1] != targetPoints[i+1]):
+      holders[i / 2] = holder
+  if not holders:
+    return (0, [])
+
+  indexes = sorted(holders)
+  runs = []
+  runStart = previous = indexes[0]
+  for index in indexes[1:] + [None]:
+    if index is None or index - previous > mergeGapPoints:
+      packedString = ''.join([blocks[holders.get(i, targetIndex)][i * pointSize:(i + 1) * pointSize]
+                              for i in xrange(runStart, previous + 1)])
+      runs.append( (runStart, packedString) )
+      runStart = index
+    previous = index
+  return (len(indexes), runs)
+
+@__instrumented('diff')
 def diff(path_from, path_to, ignore_empty = False):
   """ Compare two whisper databases. Each file must have the same archive configuration """
   fh_from = open(path_from, 'rb')
-  fh_to = open(path_to, 'rb')
-  diffs = file_diff(fh_from, fh_to, ignore_empty)
-  fh_to.close()
-  fh_from.close()
-  return diffs
+  try:
+    fh_to = open(path_to, 'rb')
+    try:
+      return file_diff(fh_from, fh_to, ignore_empty)
+    finally:
+      fh_to.close()
+  finally:
+    fh_from.close()
 
+@__instrumented('diff')
 def file_diff(fh_from, fh_to, ignore_empty = False):
+  archive_diffs = []
+  for (archive_number, timeInfo, indexes, fromValues, toValues, compared) in \
+      __archive_diffs(fh_from, fh_to, ignore_empty):
+    (start, end, archive_step) = timeInfo
+    if CAN_NUMPY:
+      fromValues = fromValues[indexes].tolist()
+      toValues = toValues[indexes].tolist()
+      timestamps = (start + archive_step * indexes).tolist()
+      diffs = []
+      for (timestamp, fromValue, toValue) in itertools.izip(timestamps, fromValues, toValues):
+        if fromValue != fromValue:
+          fromValue = None
+        if toValue != toValue:
+          toValue = None
+        diffs.append( (timestamp, fromValue, toValue) )
+    else:
+      diffs = [(start + archive_step * i, fromValues[i], toValues[i]) for i in indexes]
+    archive_diffs.append( (archive_number, diffs, compared) )
+  return archive_diffs
+
+@__instrumented('diff')
+def diff_summary(path_from, path_to, ignore_empty = False):
+  """diff_summary(path_from,path_to,ignore_empty=False)
+
+Count the differences between two whisper databases with the same archive
+configuration without listing them, which is cheaper when only the counts are
+needed. Returns a list of (archive_number, differing, compared) tuples
+"""
+  fh_from = open(path_from, 'rb')
+  try:
+    fh_to = open(path_to, 'rb')
+    try:
+      return file_diff_summary(fh_from, fh_to, ignore_empty)
+    finally:
+      fh_to.close()
+  finally:
+    fh_from.close()
+
+@__instrumented('diff')
+def file_diff_summary(fh_from, fh_to, ignore_empty = False):
+  return [(archive_number, len(indexes), compared) for
+          (archive_number, timeInfo, indexes, fromValues, toValues, compared) in
+          __archive_diffs(fh_from, fh_to, ignore_empty)]
+
+def __archive_diffs(fh_from, fh_to, ignore_empty):
+  """Compare each archive of two files over the part of the retention that
+finer archives do not cover. Yields (archive_number, timeInfo, indexes,
+fromValues, toValues, compared) where indexes are the offsets in the values of
+the differing intervals and compared the number of intervals either file (both
+with ignore_empty) has a value for. Values and indexes are arrays when numpy
+is available"""
   headerFrom = __readHeader(fh_from)
   headerTo = __readHeader(fh_to)
 
-  if headerFrom['archives'] != headerTo['archives']:
+  if headerFrom.archives != headerTo.archives:
     # TODO: Add specific whisper-resize commands to right size things
     raise NotImplementedError("%s and %s archive configurations are unalike. " \
                                 "Resize the input before diffing" % (fh_from.name, fh_to.name))
 
-  archives = headerFrom['archives']
-  archives.sort(key=operator.itemgetter('retention'))
-
-  archive_diffs = []
+  archives = sorted(headerFrom.archives, key=operator.attrgetter('retention'))
 
   now = int(time.time())
   untilTime = now
   for archive_number, archive in enumerate(archives):
-    diffs = []
-    startTime = now - archive['retention']
-    (fromTimeInfo, fromValues) = __archive_fetch(fh_from, archive, startTime, untilTime)
-    (toTimeInfo, toValues) = __archive_fetch(fh_to, archive, startTime, untilTime)
-    (start, end, archive_step) = ( min(fromTimeInfo[0],toTimeInfo[0]), max(fromTimeInfo[1],toTimeInfo[1]), min(fromTimeInfo[2],toTimeInfo[2]) )
-
-    points = map(lambda s: (s * archive_step + start,fromValues[s],toValues[s]), range(0,(end - start) / archive_step))
-    if ignore_empty:
-      points = [p for p in points if p[1] != None and p[2] != None]
+    startTime = now - archive.retention
+    (timeInfo, fromValues) = __archive_fetch(fh_from, archive, startTime, untilTime, CAN_NUMPY)
+    (timeInfo, toValues) = __archive_fetch(fh_to, archive, startTime, untilTime, CAN_NUMPY)
+
+    if CAN_NUMPY:
+      fromKnown = fromValues == fromValues
+      toKnown = toValues == toValues
+      if ignore_empty:
+        compared = fromKnown & toKnown
+      else:
+        compared = fromKnown | toKnown
+      indexes = numpy.flatnonzero(compared & ((fromKnown != toKnown) | (fromValues != toValues)))
+      compared = int(compared.sum())
     else:
-      points = [p for p in points if p[1] != None or p[2] != None]
+      indexes = []
+      compared = 0
+      for (i, fromValue, toValue) in itertools.izip(itertools.count(), fromValues, toValues):
+        if fromValue is None and toValue is None:
+          continue
+        if ignore_empty and (fromValue is None or toValue is None):
+          continue
+        compared += 1
+        if fromValue != toValue:
+          indexes.append(i)
+
+    yield (archive_number, timeInfo, indexes, fromValues, toValues, compared)
+    untilTime = startTime
 
-    diffs = [p for p in points if p[1] != p[2]]
+def resize(path, archiveList, xFilesFactor=None, aggregationMethod=None, aggregate=False, newfile=None, chunkPoints=65536):
+  """resize(path,archiveList,xFilesFactor=None,aggregationMethod=None,aggregate=False,newfile=None,chunkPoints=65536)
 
-    archive_diffs.append( (archive_number, diffs, points.__len__()) )
-    untilTime = startTime
-  return archive_diffs
+path is a string
+archiveList is a list of archives, each of which is of the form (secondsPerPoint,numberOfPoints)
+xFilesFactor and aggregationMethod default to those of path
+aggregate is False to store the points of path the way update_many() would,
+each new archive being propagated from the finer ones, or True to compute every
+new archive from the finest data path has for each of its intervals, which
+suits archives of a different precision better
+newfile is a string, the path of a new database to write, leaving path alone.
+When None, path is replaced by the resized database through a temporary file
+renamed over it
+
+The old archives are read chunkPoints points at a time, so memory use does not
+grow with the size of the file
+"""
+  if chunkPoints < 1:
+    raise ValueError("chunkPoints must be at least 1, not %r" % (chunkPoints,))
+  if newfile is None:
+    target = path + '.tmp'
+    if os.path.exists(target):
+      os.unlink(target)
+  else:
+    target = newfile
+
+  fh_from = open(path, 'rb')
+  try:
+    header = __readHeader(fh_from)
+    if xFilesFactor is None:
+      xFilesFactor = header.xFilesFactor
+    if aggregationMethod is None:
+      aggregationMethod = header.aggregationMethod
+    create(target, archiveList, xFilesFactor, aggregationMethod)
+    try:
+      fh_to = open(target, 'r+b')
+      try:
+        now = int( time.time() )
+        if aggregate:
+          for archive in __readHeader(fh_to).archives:
+            __resize_aggregate(fh_from, header, fh_to, archive, xFilesFactor, aggregationMethod, now, chunkPoints)
+        else:
+          __resize_update(fh_from, header, fh_to, now, chunkPoints)
+        if AUTOFLUSH:
+          fh_to.flush()
+          os.fsync(fh_to.fileno())
+      finally:
+        fh_to.close()
+    except:
+      os.unlink(target)
+      raise
+  finally:
+    fh_from.close()
+
+  if newfile is None:
+    os.rename(target, path)
+    __headerCache.invalidate(path)
+
+def __resize_update(fh_from, header, fh_to, now, chunkPoints):
+  """Replay every old archive into fh_to with update_many, the coarsest first
+so finer points overwrite and propagate over it. Chunks hold whole intervals of
+the coarsest new archive, update_many giving the same result for an interval
+whichever chunk its points come in"""
+  alignment = max([archive.secondsPerPoint for archive in __readHeader(fh_to).archives])
+  for archive in sorted(header.archives, key=operator.attrgetter('secondsPerPoint'), reverse=True):
+    step = archive.secondsPerPoint
+    fromTime = now - archive.retention + step
+    chunkSeconds = chunkPoints * step
+    chunkSeconds += -chunkSeconds % alignment
+    for windowFrom in xrange(fromTime - (fromTime % alignment), now + 1, chunkSeconds):
+      chunks = __archive_chunks(fh_from, archive, max(fromTime, windowFrom - 1),
+                                min(now, windowFrom + chunkSeconds - 1), chunkSeconds / step + 1, False)
+      for ((start, end, step), values) in chunks:
+        points = [(timestamp, value) for (timestamp, value) in itertools.izip(xrange(start, end, step), values)
+                  if value is not None]
+        if points:
+          points.reverse() #newest first, as file_update_many expects
+          file_update_many(fh_to, points)
+
+def __resize_aggregate(fh_from, header, fh_to, archive, xFilesFactor, aggregationMethod, now, chunkPoints):
+  """Aggregate the data of fh_from into each interval of archive in fh_to.
+Each stretch of time is read from the finest old archive that covers it,
+oldest first, and an interval gets a value when at least xFilesFactor of the
+old points falling in it are known"""
+  step = archive.secondsPerPoint
+  firstInterval = now - archive.retention
+  firstInterval = firstInterval - (firstInterval % step) + step
+  untilTime = now - (now % step) + step - 1
+
+  # the old intervals each archive is read for, oldest first
+  segments = []
+  segmentUntil = now
+  for oldArchive in sorted(header.archives, key=operator.attrgetter('retention')):
+    segmentFrom = now - oldArchive.retention
+    segments.insert(0, (oldArchive, max(segmentFrom, firstInterval - 1), min(segmentUntil, untilTime)))
+    segmentUntil = segmentFrom
+
+  baseInterval = None
+  pendingTimes = pendingValues = None
+  for (oldArchive, fromTime, segmentUntil) in segments:
+    if fromTime >= segmentUntil:
+      continue
+    for ((start, end, oldStep), values) in __archive_chunks(fh_from, oldArchive, fromTime, segmentUntil, chunkPoints, CAN_NUMPY):
+      if CAN_NUMPY:
+        times = numpy.arange(start, end, oldStep)
+        if pendingTimes is not None:
+          times = numpy.concatenate((pendingTimes, times))
+          values = numpy.concatenate((pendingValues, values))
+      else:
+        times = range(start, end, oldStep)
+        if pendingTimes is not None:
+          times = pendingTimes + times
+          values = pendingValues + values
+      # the newest interval may go on in the next chunk
+      lastInterval = times[-1] - ((times[-1] - firstInterval) % step)
+      cut = bisect.bisect_left(times, lastInterval)
+      (pendingTimes, pendingValues) = (times[cut:], values[cut:])
+      baseInterval = __resize_write(fh_to, archive, baseInterval,
+        *__resize_buckets(times[:cut], values[:cut], firstInterval, step, xFilesFactor, aggregationMethod))
+
+  if pendingTimes is not None:
+    __resize_write(fh_to, archive, baseInterval,
+      *__resize_buckets(pendingTimes, pendingValues, firstInterval, step, xFilesFactor, aggregationMethod))
+
+def __resize_buckets(times, values, firstInterval, step, xFilesFactor, aggregationMethod):
+  """Aggregate the values of old points, ordered by time, into the intervals
+of step they fall in. Returns the intervals that get a value and their values"""
+  if not len(times):
+    return ([], [])
+  if CAN_NUMPY:
+    buckets = (times - firstInterval) // step
+    (intervals, starts) = numpy.unique(buckets, return_index=True)
+    counts = numpy.diff(numpy.append(starts, len(times)))
+    # one row of old values per interval, NaN padded to the longest
+    rows = numpy.repeat(numpy.arange(len(intervals)), counts)
+    columns = numpy.arange(len(times)) - numpy.repeat(starts, counts)
+    matrix = numpy.empty((len(intervals), counts.max()))
+    matrix.fill(numpy.nan)
+    matrix[rows, columns] = values
+    slots = numpy.zeros(matrix.shape, dtype=bool)
+    slots[rows, columns] = True
+    known = matrix == matrix
+    knownCounts = known.sum(axis=1)
+    keep = (knownCounts > 0) & (knownCounts >= xFilesFactor * counts)
+    aggregated = __aggregate_array(aggregationMethod, matrix[keep], known[keep], slots[keep])
+    return (firstInterval + step * intervals[keep], aggregated)
+
+  intervals = []
+  aggregated = []
+  bucketValues = []
+  for i in xrange(len(times)):
+    bucketValues.append(values[i])
+    if i + 1 < len(times) and (times[i + 1] - firstInterval) // step == (times[i] - firstInterval) // step:
+      continue
+    knownValues = [value for value in bucketValues if value is not None]
+    if knownValues and len(knownValues) >= xFilesFactor * len(bucketValues):
+      intervals.append(times[i] - ((times[i] - firstInterval) % step))
+      aggregated.append(aggregate(aggregationMethod, knownValues, bucketValues))
+    bucketValues = []
+  return (intervals, aggregated)
+
+def __resize_write(fh, archive, baseInterval, intervals, values):
+  """Write ascending intervals and their values to an archive being filled from
+its first slot, in a single write. Returns the archive's base interval"""
+  if not len(intervals):
+    return baseInterval
+  if baseInterval is None:
+    baseInterval = int(intervals[0])
+  step = archive.secondsPerPoint
+  fromIndex = (int(intervals[0]) - baseInterval) / step
+  points = (int(intervals[-1]) - int(intervals[0])) / step + 1
+  if CAN_NUMPY:
+    series = numpy.zeros(points, dtype=pointDtype)
+    indexes = (intervals - intervals[0]) // step
+    series['interval'][indexes] = intervals
+    series['value'][indexes] = values
+    packedString = series.tostring()
+  else:
+    slots = ['\0' * pointSize] * points
+    for (interval, value) in itertools.izip(intervals, values):
+      slots[(interval - intervals[0]) / step] = struct.pack(pointFormat, interval, value)
+    packedString = ''.join(slots)
+  __archive_write_slots(fh, archive, fromIndex, packedString)
+  return baseInterval
+
+class WhisperFile(object):
+  """WhisperFile(path,mode='r+b')
+
+A persistent handle on a whisper database.
+
+path is a string
+mode is 'r+b' for a writable handle or 'rb' for a read-only one
+
+The file is opened and memory-mapped once, and the parsed header and each
+archive's base interval are kept on the handle, so update, update_many and
+fetch read and write the mapped buffer directly instead of reopening the file
+and re-reading the header on every call. A WhisperFile can also be passed to
+any of the file_* functions in place of a file object.
+
+A handle stays bound to the file it opened; reopen it after the file has been
+replaced (by whisper-resize.py for instance).
+"""
+  def __init__(self, path, mode='r+b'):
+    self.name = path
+    self.mode = mode
+    self.header = None
+    self.baseIntervals = {}
+    self.fh = open(path, mode)
+    try:
+      size = os.fstat(self.fh.fileno()).st_size
+      if size < metadataSize:
+        raise CorruptWhisperFile("Unable to read header", path)
+      if '+' in mode:
+        access = mmap.ACCESS_WRITE
+      else:
+        access = mmap.ACCESS_READ
+      self.map = mmap.mmap(self.fh.fileno(), size, access=access)
+    except:
+      self.fh.close()
+      raise
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def fileno(self):
+    return self.fh.fileno()
+
+  def flush(self):
+    self.map.flush()
+
+  def close(self):
+    if self.map is not None:
+      self.map.close()
+      self.map = None
+    self.fh.close()
+
+  def baseInterval(self, archive):
+    """Return the interval stored in the first slot of archive.
+
+Once an archive has been written to its base interval only ever moves by whole
+multiples of the archive's retention, so the first non-zero value is cached.
+"""
+    baseInterval = self.baseIntervals.get(archive.offset)
+    if baseInterval:
+      return baseInterval
+
+    (baseInterval,baseValue) = pointStruct.unpack_from(self.map, archive.offset)
+    if baseInterval:
+      self.baseIntervals[archive.offset] = baseInterval
+    return baseInterval
+
+  def info(self):
+    """info()
+
+Returns the header of the file, see ``whisper.info``
+"""
+    return file_info(self)
+
+  def update(self, value, timestamp=None):
+    """update(value,timestamp=None)
+
+value is a float
+timestamp is either an int or float
+"""
+    try:
+      return file_update(self, float(value), timestamp)
+    finally:
+      self.__unlock()
+
+  def update_many(self, points):
+    """update_many(points)
+
+points is a list of (timestamp,value) points
+"""
+    if not points: return
+    points = [ (int(t),float(v)) for (t,v) in points]
+    points.sort(key=lambda p: p[0],reverse=True) #order points by timestamp, newest first
+    try:
+      return file_update_many(self, points)
+    finally:
+      self.__unlock()
+
+  def fetch(self, fromTime, untilTime=None, as_array=False, maxDataPoints=None, aggregationMethod=None, archive_number=None):
+    """fetch(fromTime,untilTime=None,as_array=False,maxDataPoints=None,aggregationMethod=None,archive_number=None)
+
+Returns a tuple of (timeInfo, valueList), see ``whisper.fetch``
+"""
+    return file_fetch(self, fromTime, untilTime, as_array, maxDataPoints, aggregationMethod, archive_number)
+
+  def iter_fetch(self, fromTime, untilTime=None, chunkPoints=65536, as_array=False):
+    """iter_fetch(fromTime,untilTime=None,chunkPoints=65536,as_array=False)
+
+Generates (timeInfo, valueList) chunks, see ``whisper.iter_fetch``
+"""
+    return file_iter_fetch(self, fromTime, untilTime, chunkPoints, as_array)
+
+  def __unlock(self):
+    # The write paths take an exclusive lock and leave it to be released when
+    # the file is closed, a persistent handle has to give it back itself
+    if LOCK and LOCK_RANGES:
+      fcntl.lockf( self.fh.fileno(), fcntl.LOCK_UN )
+    elif LOCK:
+      fcntl.flock( self.fh.fileno(), fcntl.LOCK_UN )
+    _writeLocked.pop(self, None)
+
+
+class FlushScheduler(object):
+  """FlushScheduler(maxUpdatesPerSecond=0)
+
+Decides which of its buffered metrics a WhisperWriteCache writes out when one
+of its flush policies triggers, and in which order. Subclasses implement
+order(); maxUpdatesPerSecond, if non-zero, caps the number of files written
+per second like carbon's MAX_UPDATES_PER_SECOND.
+"""
+  def __init__(self, maxUpdatesPerSecond=0):
+    self.maxUpdatesPerSecond = maxUpdatesPerSecond
+    self.allowance = maxUpdatesPerSecond
+    self.lastSchedule = time.time()
+
+  def order(self, pending):
+    """pending is a dict mapping paths to (pointCount, firstBufferedAt)
+
+Returns the paths of pending in the order they should be flushed
+"""
+    return list(pending)
+
+  def schedule(self, pending):
+    paths = self.order(pending)
+    if not self.maxUpdatesPerSecond:
+      return paths
+
+    now = time.time()
+    self.allowance = min(self.maxUpdatesPerSecond,
+      self.allowance + (now - self.lastSchedule) * self.maxUpdatesPerSecond)
+    self.lastSchedule = now
+    paths = paths[:int(self.allowance)]
+    self.allowance -= len(paths)
+    return paths
+
+
+class LargestFirstScheduler(FlushScheduler):
+  """Flush the metrics with the most buffered points first"""
+  def order(self, pending):
+    return sorted(pending, key=lambda path: pending[path][0], reverse=True)
+
+
+class OldestFirstScheduler(FlushScheduler):
+  """Flush the metrics that have been buffered the longest first"""
+  def order(self, pending):
+    return sorted(pending, key=lambda path: pending[path][1])
+
+
+class WhisperWriteCache(object):
+  """WhisperWriteCache(maxPoints=0,maxAge=0,maxMemory=0,scheduler=None,archiveList=None,xFilesFactor=None,aggregationMethod=None,workers=4)
+
+An in-process write-back cache in front of whisper files.
+
+maxPoints flushes once more than this many points are buffered in total
+maxAge flushes metrics whose oldest buffered point was stored this many seconds ago
+maxMemory flushes once the buffered points are estimated to use more than this many bytes
+scheduler is a FlushScheduler choosing what a policy flush writes (defaults to LargestFirstScheduler)
+archiveList, xFilesFactor and aggregationMethod are used to create missing files on flush (see ``whisper.update_many_files``)
+workers is the number of threads used to write files on flush
+
+A limit of 0 disables that policy. The policies are only checked when points
+are buffered, nothing runs in the background: a metric that stops receiving
+points stays buffered past maxAge until the next write or an explicit flush(),
+so callers should call flush() periodically. Points are buffered per path and
+deduplicated by the interval of the path's highest-precision archive, the last
+value stored for an interval wins. fetch() merges the buffered points into what
+is on disk so reads see data that has not been flushed yet.
+"""
+  # Rough in-memory cost of a buffered point
+  pointBytes = 120
+
+  def __init__(self, maxPoints=0, maxAge=0, maxMemory=0, scheduler=None,
+               archiveList=None, xFilesFactor=None, aggregationMethod=None, workers=4):
+    self.maxPoints = maxPoints
+    self.maxAge = maxAge
+    self.maxMemory = maxMemory
+    self.scheduler = scheduler or LargestFirstScheduler()
+    self.archiveList = archiveList
+    self.xFilesFactor = xFilesFactor
+    self.aggregationMethod = aggregationMethod
+    self.workers = workers
+    self.lock = threading.Lock()
+    self.flushed = threading.Condition(self.lock)
+    self.buffers = {}   # path -> {interval: value}
+    self.flushing = {}  # path -> {interval: value}, being written right now
+    self.firstBuffered = {}
+    self.steps = {}
+    self.size = 0
+    self.lastAgeCheck = time.time()
+    self.errors = {}
+
+  def __len__(self):
+    return self.size
+
+  def update(self, path, value, timestamp=None):
+    """update(path,value,timestamp=None)
+
+Buffers a single point, see ``whisper.update``
+"""
+    if timestamp is None:
+      timestamp = time.time()
+    self.update_many(path, [(timestamp, value)])
+
+  def update_many(self, path, points):
+    """update_many(path,points)
+
+Buffers a list of (timestamp,value) points, see ``whisper.update_many``
+"""
+    if not points: return
+    step = self.__step(path)
+    self.lock.acquire()
+    try:
+      buffer = self.buffers.get(path)
+      if buffer is None:
+        buffer = self.buffers[path] = {}
+        self.firstBuffered[path] = time.time()
+      before = len(buffer)
+      for (timestamp, value) in points:
+        timestamp = int(timestamp)
+        buffer[timestamp - (timestamp % step)] = float(value)
+      self.size += len(buffer) - before
+    finally:
+      self.lock.release()
+
+    self.__checkPolicies()
+
+  def fetch(self, path, fromTime, untilTime=None):
+    """fetch(path,fromTime,untilTime=None)
+
+Returns a tuple of (timeInfo, valueList) like ``whisper.fetch`` with the
+buffered points of path laid over the data on disk. Buffered points are only
+merged when the range is served by the highest-precision archive.
+"""
+    step = self.__step(path)
+    if os.path.exists(path):
+      result = fetch(path, fromTime, untilTime)
+    else:
+      #Nothing written yet, serve the buffered points on their own
+      now = int(time.time())
+      if untilTime is None:
+        untilTime = now
+      fromTime = int(fromTime)
+      untilTime = int(untilTime)
+      if fromTime > untilTime:
+        raise InvalidTimeInterval("Invalid time interval: from time '%s' is after until time '%s'" % (fromTime, untilTime))
+      if fromTime > now:
+        return None
+      if untilTime > now:
+        untilTime = now
+      fromInterval = fromTime - (fromTime % step) + step
+      untilInterval = untilTime - (untilTime % step) + step
+      result = ((fromInterval, untilInterval, step), [None] * ((untilInterval - fromInterval) / step))
+
+    if result is None or result[0][2] != step:
+      return result
+
+    ((fromInterval, untilInterval, step), valueList) = result
+    self.lock.acquire()
+    try:
+      for buffer in (self.flushing.get(path, {}), self.buffers.get(path, {})):
+        for (interval, value) in buffer.items():
+          if fromInterval <= interval < untilInterval:
+            valueList[(interval - fromInterval) / step] = value
+    finally:
+      self.lock.release()
+    return result
+
+  def flush(self, paths=None):
+    """flush(paths=None)
+
+Writes the buffered points of paths, or of every buffered path, to disk.
+Returns a dict mapping each path written to None or to the exception that
+stopped its update, see ``whisper.update_many_files``. The points of a path
+whose update failed are buffered again for the next flush to retry. Waits
+for other threads to finish writing any of the paths first, so the writes to
+a file happen in the order its points were flushed
+"""
+    self.lock.acquire()
+    try:
+      if paths is None:
+        paths = list(self.buffers)
+      while [path for path in paths if path in self.flushing]:
+        self.flushed.wait()
+      updates = {}
+      for path in paths:
+        buffer = self.buffers.pop(path, None)
+        if not buffer:
+          continue
+        firstBuffered = self.firstBuffered.pop(path)
+        self.size -= len(buffer)
+        self.flushing[path] = buffer
+        updates[path] = (buffer, firstBuffered)
+    finally:
+      self.lock.release()
+
+    if not updates:
+      return {}
+
+    results = None
+    try:
+      results = update_many_files(dict((path, buffer.items()) for (path, (buffer, firstBuffered)) in updates.items()),
+        self.archiveList, self.xFilesFactor, self.aggregationMethod, self.workers)
+    finally:
+      self.lock.acquire()
+      try:
+        for (path, (buffer, firstBuffered)) in updates.items():
+          del self.flushing[path]
+          if results is None or results.get(path) is not None:
+            self.__rebuffer(path, buffer, firstBuffered)
+        if results is not None:
+          for (path, error) in results.items():
+            if error is None:
+              self.errors.pop(path, None)
+            else:
+              self.errors[path] = error
+        self.flushed.notifyAll()
+      finally:
+        self.lock.release()
+    return results
+
+  def __rebuffer(self, path, buffer, firstBuffered):
+    """Put back the points of a failed flush, under the lock. Points buffered
+since the flush started are newer and win"""
+    current = self.buffers.get(path)
+    if current is None:
+      self.buffers[path] = buffer
+      self.firstBuffered[path] = firstBuffered
+      self.size += len(buffer)
+      return
+    before = len(current)
+    for (interval, value) in buffer.items():
+      current.setdefault(interval, value)
+    self.size += len(current) - before
+    self.firstBuffered[path] = min(firstBuffered, self.firstBuffered[path])
+
+  def __step(self, path):
+    step = self.steps.get(path)
+    if step is None:
+      if os.path.exists(path) or not self.archiveList:
+        step = info(path)['archives'][0]['secondsPerPoint']
+      else:
+        step = min([secondsPerPoint for (secondsPerPoint, points) in self.archiveList])
+      self.steps[path] = step
+    return step
+
+  def __checkPolicies(self):
+    now = time.time()
+    self.lock.acquire()
+    try:
+      pending = None
+      overLimit = ((self.maxPoints and self.size > self.maxPoints) or
+                   (self.maxMemory and self.size * self.pointBytes > self.maxMemory))
+      if overLimit:
+        pending = dict((path, (len(buffer), self.firstBuffered[path]))
+                       for (path, buffer) in self.buffers.items())
+      elif self.maxAge and now - self.lastAgeCheck >= 1:
+        self.lastAgeCheck = now
+        pending = dict((path, (len(self.buffers[path]), firstBuffered))
+                       for (path, firstBuffered) in self.firstBuffered.items()
+                       if now - firstBuffered >= self.maxAge)
+      if not pending:
+        return
+
+      paths = self.scheduler.schedule(pending)
+      if overLimit:
+        #Only write as much as it takes to get back under the limits
+        remaining = self.size
+        for (i, path) in enumerate(paths):
+          remaining -= pending[path][0]
+          if ((not self.maxPoints or remaining <= self.maxPoints) and
+              (not self.maxMemory or remaining * self.pointBytes <= self.maxMemory)):
+            paths = paths[:i+1]
+            break
+    finally:
+      self.lock.release()
+
+    if paths:
+      self.flush(paths)